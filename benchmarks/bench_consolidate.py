@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark for consolidate_dataset: client side vs aggregation
+
+    python benchmarks/bench_consolidate.py
+
+    # aggregation path require a MongoDB server (>= 3.4.4):
+    USE_MONGO_SERVER=1 MONGODB_URL=mongodb://localhost/widukind_bench python benchmarks/bench_consolidate.py
+"""
+
+import os
+import time
+import random
+
+import bson
+import mongomock
+
+from widukind_common import constants
+from widukind_common import utils
+from widukind_common.tasks import consolidate
+
+def generate_dataset(db, count_series=10000, count_codes=500, count_values=50):
+    rand = random.Random(0)
+
+    countries = ["C%04d" % i for i in range(count_codes)]
+    units = ["U%04d" % i for i in range(count_codes)]
+    obs_status = ["E", "P", "B", "M"]
+
+    dataset = {
+        "enable": True,
+        "provider_name": "BENCH",
+        "dataset_code": "d1",
+        "name": "bench",
+        "slug": "bench-d1",
+        "dimension_keys": ["FREQ", "COUNTRY", "UNIT"],
+        "attribute_keys": ["OBS_STATUS"],
+        "concepts": {"FREQ": "Frequency", "COUNTRY": "Country",
+                     "UNIT": "Unit", "OBS_STATUS": "Status"},
+        "codelists": {
+            "FREQ": {"A": "Annual", "M": "Monthly"},
+            # half codes are not used by series
+            "COUNTRY": {c: c for c in countries + ["X%04d" % i for i in range(count_codes)]},
+            "UNIT": {u: u for u in units + ["Y%04d" % i for i in range(count_codes)]},
+            "OBS_STATUS": {s: s for s in obs_status + ["Z"]},
+        },
+    }
+    db[constants.COL_DATASETS].insert_one(dataset)
+
+    series_list = []
+    for i in range(count_series):
+        series_list.append({
+            "provider_name": "BENCH",
+            "dataset_code": "d1",
+            "key": "S%s" % i,
+            "slug": "bench-d1-s%s" % i,
+            "dimensions": {"FREQ": "A", "COUNTRY": rand.choice(countries), "UNIT": rand.choice(units)},
+            "attributes": None,
+            "values": [{"value": str(j),
+                        "attributes": {"OBS_STATUS": rand.choice(obs_status)} if j % 3 == 0 else None}
+                       for j in range(count_values)],
+        })
+        if len(series_list) >= 1000:
+            db[constants.COL_SERIES].insert_many(series_list)
+            series_list = []
+    if series_list:
+        db[constants.COL_SERIES].insert_many(series_list)
+
+def bench_payload(db, query, old_codelists):
+    """BSON bytes shipped to the client by each path"""
+    projection = {"_id": False, "dimensions": True, "attributes": True, "values.attributes": True}
+    series_size = 0
+    codelists = consolidate._series_codelists(db[constants.COL_SERIES].find(query, projection),
+                                              old_codelists)
+    for doc in db[constants.COL_SERIES].find(query, projection):
+        series_size += len(bson.BSON.encode(doc))
+    distinct_size = sum(len(bson.BSON.encode({"_id": k, "codes": list(v)})) for k, v in codelists.items())
+    print("payload   : series %.1f KB - distinct codes %.1f KB" % (series_size / 1024, distinct_size / 1024))
+
+def run(db, use_aggregate):
+    start = time.time()
+    query, query_modify = consolidate.consolidate_dataset("BENCH", "d1", db=db, execute=False,
+                                                          use_aggregate=use_aggregate)
+    return query_modify, time.time() - start
+
+def main():
+    if 'USE_MONGO_SERVER' in os.environ:
+        db = utils.get_mongo_db()
+        db[constants.COL_DATASETS].delete_many({"provider_name": "BENCH"})
+        db[constants.COL_SERIES].delete_many({"provider_name": "BENCH"})
+    else:
+        db = mongomock.MongoClient()["widukind_bench"]
+
+    generate_dataset(db)
+    old_codelists = db[constants.COL_DATASETS].find_one({"provider_name": "BENCH"})["codelists"]
+
+    bench_payload(db, {"provider_name": "BENCH", "dataset_code": "d1"}, old_codelists)
+
+    query_modify, duration = run(db, use_aggregate=False)
+    print("client    : %.3fs" % duration)
+
+    if 'USE_MONGO_SERVER' in os.environ:
+        query_modify_aggregate, duration = run(db, use_aggregate=True)
+        print("aggregate : %.3fs - same result: %s" % (duration, query_modify == query_modify_aggregate))
+        db[constants.COL_DATASETS].delete_many({"provider_name": "BENCH"})
+        db[constants.COL_SERIES].delete_many({"provider_name": "BENCH"})
+    else:
+        print("aggregate : require USE_MONGO_SERVER ($objectToArray not supported by mongomock)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark for series_to_dataframe: per observation loop vs preallocated arrays
+
+    python benchmarks/bench_dataframe.py
+"""
+
+import time
+import random
+
+import pandas
+
+from widukind_common import dataframe
+
+def generate_series(count_series=20000, count_values=60, freq="M"):
+    rand = random.Random(0)
+    first = pandas.Period("1990-01", freq=freq)
+    series_list = []
+    for i in range(count_series):
+        start = first + rand.randint(0, 120)
+        length = rand.randint(count_values // 2, count_values)
+        periods = pandas.period_range(start, periods=length, freq=freq)
+        series_list.append({
+            "slug": "bench-d1-s%s" % i,
+            "key": "S%s" % i,
+            "frequency": freq,
+            "start_date": periods[0].ordinal,
+            "end_date": periods[-1].ordinal,
+            "values": [{"period": str(p), "value": "NaN" if j % 17 == 0 else "%.2f" % rand.random()}
+                       for j, p in enumerate(periods)],
+        })
+    return series_list
+
+def series_to_dataframe_legacy(series_list, frequency):
+    """Naive loader: one pandas.Series per document, appended per observation"""
+    columns = {}
+    for s in series_list:
+        index = []
+        values = []
+        for v in s["values"]:
+            index.append(pandas.Period(v["period"], freq=frequency))
+            try:
+                values.append(float(v["value"]))
+            except ValueError:
+                values.append(float("nan"))
+        columns[s["slug"]] = pandas.Series(values, index=pandas.PeriodIndex(index))
+    return pandas.DataFrame(columns)
+
+def main():
+    series_list = generate_series()
+    dmin = min(s["start_date"] for s in series_list)
+    dmax = max(s["end_date"] for s in series_list)
+
+    start = time.time()
+    df_legacy = series_to_dataframe_legacy(series_list, "M")
+    duration_legacy = time.time() - start
+    print("legacy    : %s series in %.3fs" % (len(series_list), duration_legacy))
+
+    start = time.time()
+    df = dataframe.series_to_dataframe(series_list, "M", dmin, dmax)
+    duration = time.time() - start
+    print("ordinals  : %s series in %.3fs - x%.1f" % (len(series_list), duration, duration_legacy / duration))
+
+    print("same result: %s" % df.equals(df_legacy.reindex(df.index)[df.columns]))
+
+if __name__ == "__main__":
+    main()
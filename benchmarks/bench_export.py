@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark for dataset export row alignment
+
+    python benchmarks/bench_export.py
+"""
+
+import time
+import random
+
+import pandas
+import gridfs
+
+from widukind_common.tasks import export_files
+
+def generate_series(count_series=100000, freq="A"):
+    rand = random.Random(0)
+    first = pandas.Period("1960", freq=freq).ordinal
+    for i in range(count_series):
+        start_date = first + rand.randint(0, 40)
+        count_values = rand.randint(1, 20)
+        yield {
+            "key": "S%s" % i,
+            "frequency": freq,
+            "dimensions": {"FREQ": freq, "GEO": "G%s" % (i % 50)},
+            "start_date": start_date,
+            "end_date": start_date + count_values - 1,
+            "values": [{"value": str(j)} for j in range(count_values)],
+        }
+
+def export_row_legacy(s, dimension_keys, pDmin, pDmax, freq):
+    """row_process of export_dataset before ordinal arithmetic"""
+    row = [s['key']]
+    for c in dimension_keys:
+        if c in s['dimensions']:
+            row.append(s['dimensions'][c])
+        else:
+            row.append('')
+    p_start_date = pandas.Period(ordinal=s['start_date'], freq=freq)
+    p_end_date = pandas.Period(ordinal=s['end_date'], freq=freq)
+    row.extend([None for d in pandas.period_range(pDmin, p_start_date-1, freq=freq)])
+    row.extend([val["value"] for val in s['values']])
+    row.extend([None for d in pandas.period_range(p_end_date+1, pDmax, freq=freq)])
+    return row
+
+def main(count_series=100000, freq="A"):
+    series = list(generate_series(count_series, freq))
+    dimension_keys = ["FREQ", "GEO"]
+    dmin = min(s["start_date"] for s in series)
+    dmax = max(s["end_date"] for s in series)
+    pDmin = pandas.Period(ordinal=dmin, freq=freq)
+    pDmax = pandas.Period(ordinal=dmax, freq=freq)
+
+    start = time.time()
+    rows_legacy = [export_row_legacy(s, dimension_keys, pDmin, pDmax, freq) for s in series]
+    duration_legacy = time.time() - start
+    print("period_range : %s series in %.3fs" % (count_series, duration_legacy))
+
+    start = time.time()
+    rows = [export_files.export_row(s, dimension_keys, dmin, dmax) for s in series]
+    duration = time.time() - start
+    print("ordinals     : %s series in %.3fs - x%.0f - same rows: %s" % (count_series, duration,
+                                                                          duration_legacy / duration,
+                                                                          rows == rows_legacy))
+
+
+def bench_formats(count_series=100000, freq="A"):
+    import io
+
+    series = list(generate_series(count_series, freq))
+    dimension_keys = ["FREQ", "GEO"]
+    dmin = min(s["start_date"] for s in series)
+    dmax = max(s["end_date"] for s in series)
+    dataset = {"dimension_keys": dimension_keys}
+    headers = export_files.export_headers(dataset, freq, dmin, dmax)
+
+    for export_format in sorted(export_files.EXPORT_WRITERS.keys()):
+        writer_class = export_files.get_export_writer(export_format)
+        fp = io.StringIO() if writer_class.encoding else io.BytesIO()
+        start = time.time()
+        writer = writer_class(fp)
+        writer.writerow(headers)
+        for s in series:
+            writer.writerow(export_files.export_row(s, dimension_keys, dmin, dmax))
+        writer.close()
+        size = len(fp.getvalue())
+        print("%-7s : %s series in %.3fs - %.1f KB" % (export_format, count_series, time.time() - start,
+                                                       size / 1024))
+
+class GridInSink(object):
+    """Count writes and bytes like a GridIn without MongoDB"""
+    chunk_size = 255 * 1024
+
+    def __init__(self):
+        self.count_writes = 0
+        self.length = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        self.count_writes += 1
+        self.length += len(data)
+
+def iter_rows(size_mb, freq="A"):
+    series = list(generate_series(10000, freq))
+    dimension_keys = ["FREQ", "GEO"]
+    dmin = min(s["start_date"] for s in series)
+    dmax = max(s["end_date"] for s in series)
+    rows = [export_files.export_row(s, dimension_keys, dmin, dmax) for s in series]
+    fp = GridInSink()
+    export_files.write_csv(fp, rows)
+    yield export_files.export_headers({"dimension_keys": dimension_keys}, freq, dmin, dmax)
+    for i in range(max(1, int(size_mb * 1024 * 1024 / fp.length))):
+        for row in rows:
+            yield row
+
+def bench_gridfs_writer(size_mb=200):
+    import os
+    import csv
+    import io
+
+    rows = list(iter_rows(size_mb))
+
+    # before: one grid_in.write by line
+    sink = GridInSink()
+    start = time.time()
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+    for row in rows:
+        writer.writerow(row)
+        sink.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+    print("by line     : %.1f MB in %.3fs - %s writes" % (sink.length / 1024 / 1024, time.time() - start,
+                                                        sink.count_writes))
+
+    for compress in [False, True]:
+        sink = GridInSink()
+        start = time.time()
+        fp = export_files.GridFSBufferedWriter(sink, compress=compress)
+        export_files.write_csv(fp, rows)
+        fp.close()
+        print("chunks%-5s : %.1f MB in %.3fs - %s writes - %.1f MB stored" % (" gzip" if compress else "",
+                                                                             fp.size / 1024 / 1024,
+                                                                             time.time() - start,
+                                                                             sink.count_writes,
+                                                                             sink.length / 1024 / 1024))
+
+    if 'USE_MONGO_SERVER' in os.environ:
+        from widukind_common import utils
+        db = utils.get_mongo_db()
+        for compress in [False, True]:
+            start = time.time()
+            _id = export_files.record_export_file(db, rows, slug="bench", prefix="bench",
+                                                  compress=compress)
+            print("gridfs%-5s : %.3fs" % (" gzip" if compress else "", time.time() - start))
+            gridfs.GridFS(db).delete(_id)
+
+if __name__ == "__main__":
+    main()
+    bench_formats()
+    bench_gridfs_writer()
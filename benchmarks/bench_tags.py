@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for tags tokenizer
+
+    python benchmarks/bench_tags.py
+"""
+
+import time
+
+from widukind_common import constants
+from widukind_common import tags as tags_utils
+
+def _translate(s):
+    if not s or len(s.strip()) < tags_utils.TAGS_MIN_CHAR:
+        return
+    return s.translate(tags_utils.TABLE_MAP).strip().lower().split()
+
+def str_to_tags_legacy(value_str):
+    tags = _translate(value_str)
+    if tags:
+        return [a for a in tags if not a.isdigit() and not a in [None] + constants.TAGS_EXCLUDE_WORDS + ["-", "_", " "] and len(a.strip()) >= tags_utils.TAGS_MIN_CHAR]
+    return []
+
+def generate_values(count_series=20000):
+    """Values as seen by generate_tags_series for one dataset"""
+    provider = ["Eurostat", "Eurostat, the statistical office of the European Union", "Europe"]
+    dataset = ["GDP and main components (output, expenditure and income)", "nama_10_gdp"]
+    concepts = ["Frequency", "Unit of measure", "National accounts indicator (ESA 2010)", "Geopolitical entity (reporting)"]
+    units = ["Current prices, million euro", "Chain linked volumes (2010), million euro", "Percentage change on previous period"]
+    geos = ["France", "Germany (until 1990 former territory of the FRG)", "Belgium", "Euro area (19 countries)"]
+    for i in range(count_series):
+        for value in provider + dataset + concepts:
+            yield value
+        yield units[i % len(units)]
+        yield geos[i % len(geos)]
+        yield "A.CP_MEUR.B1GQ.%s" % i
+        yield "Gross domestic product at market prices - %s" % geos[i % len(geos)]
+        yield "Annually"
+
+def run(func, values):
+    start = time.time()
+    count = 0
+    for value in values:
+        count += len(func(value))
+    return count, time.time() - start
+
+def bench_completion(count_tags=200000, count_queries=100000):
+    import random
+    import string
+
+    rand = random.Random(0)
+    docs = set()
+    while len(docs) < count_tags:
+        name = "".join(rand.choice(string.ascii_lowercase) for i in range(rand.randint(3, 12)))
+        docs.add((name, rand.randint(0, 100000)))
+
+    completer = tags_utils.TagsCompleter(None, refresh_interval=3600)
+    completer.load(docs)
+
+    prefixes = [name[:rand.randint(1, 4)] for name, count in rand.sample(sorted(docs), count_queries)]
+
+    start = time.time()
+    for prefix in prefixes:
+        completer.complete(prefix, limit=10)
+    duration = time.time() - start
+    print("completion: %s queries on %s tags in %.3fs - %.1f us/query" % (count_queries, count_tags,
+                                                                          duration, duration * 1e6 / count_queries))
+
+def main():
+    values = list(generate_values())
+
+    count, duration = run(str_to_tags_legacy, values)
+    print("legacy    : %s tokens in %.3fs - %d tokens/sec" % (count, duration, count / duration))
+
+    tags_utils.TOKENIZER.cache_clear()
+    count, duration = run(tags_utils.TOKENIZER.tokenize, values)
+    print("tokenizer : %s tokens in %.3fs - %d tokens/sec" % (count, duration, count / duration))
+    print(tags_utils.TOKENIZER.cache_info())
+
+    bench_completion()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark for packed series values: BSON size and decoding latency
+
+    python benchmarks/bench_values_codec.py
+"""
+
+import time
+import random
+
+import bson
+import pandas
+
+from widukind_common import utils
+
+def generate_series(count_series=5000, count_values=240, freq="M"):
+    rand = random.Random(0)
+    periods = pandas.period_range(pandas.Period("1990-01", freq=freq), periods=count_values, freq=freq)
+    periods_str = [str(p) for p in periods]
+    series_list = []
+    for i in range(count_series):
+        series_list.append({
+            "provider_name": "BENCH",
+            "dataset_code": "d1",
+            "key": "S%s" % i,
+            "slug": "bench-d1-s%s" % i,
+            "frequency": freq,
+            "start_date": periods[0].ordinal,
+            "end_date": periods[-1].ordinal,
+            "dimensions": {"FREQ": freq},
+            "values": [{"period": p, "value": "NaN" if j % 50 == 0 else "%.3f" % (rand.random() * 1000),
+                        "attributes": {"OBS_STATUS": "E"} if j % 20 == 0 else None}
+                       for j, p in enumerate(periods_str)],
+        })
+    return series_list
+
+def timed(func, docs):
+    start = time.time()
+    for doc in docs:
+        func(doc)
+    return time.time() - start
+
+def main():
+    series_list = generate_series()
+
+    start = time.time()
+    packed_list = [utils.series_pack(s) for s in series_list]
+    print("encode       : %.3fs" % (time.time() - start))
+
+    raw_docs = [bson.BSON.encode(s) for s in series_list]
+    raw_packed = [bson.BSON.encode(s) for s in packed_list]
+    size, size_packed = sum(map(len, raw_docs)), sum(map(len, raw_packed))
+    print("bson size    : %.1f MB -> %.1f MB (%.1f%%)" % (size / 1e6, size_packed / 1e6, size_packed * 100.0 / size))
+
+    duration = timed(lambda b: bson.BSON(b).decode(), raw_docs)
+    print("bson decode  : values %.3fs" % duration)
+    duration = timed(lambda b: bson.BSON(b).decode(), raw_packed)
+    print("bson decode  : packed %.3fs" % duration)
+    duration = timed(lambda b: utils.series_values_floats(bson.BSON(b).decode()[utils.VALUES_PACKED]), raw_packed)
+    print("+ floats     : %.3fs" % duration)
+    duration = timed(lambda b: utils.series_values_strings(bson.BSON(b).decode()[utils.VALUES_PACKED]), raw_packed)
+    print("+ strings    : %.3fs" % duration)
+    duration = timed(lambda b: utils.series_unpack(bson.BSON(b).decode()), raw_packed)
+    print("+ unpack     : %.3fs" % duration)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Load series in pandas DataFrame
+
+>>> df = load_dataset_dataframe(db, "INSEE", "IPI-2010-A21")
+>>> df = load_series_dataframe(db, slugs=["insee-ipi-2010-a21-001654489"])
+"""
+
+import logging
+
+import numpy
+import pandas
+
+from widukind_common import constants
+from widukind_common import utils
+
+logger = logging.getLogger(__name__)
+
+SERIES_DATAFRAME_PROJECTION = {
+    "_id": False,
+    "slug": True,
+    "key": True,
+    "frequency": True,
+    "start_date": True,
+    "end_date": True,
+    "values.value": True,
+    "values_packed.data": True,
+}
+
+def series_to_dataframe(series_list, frequency, dmin, dmax, count=None, column="slug"):
+    """Return DataFrame - one column by series - index: PeriodIndex dmin...dmax
+
+    series_list: iterable of series documents of the same frequency
+    dmin/dmax: first and last period ordinals of all series
+    count: count of series (default: len(series_list))
+    column: field of series used for columns names
+
+    Values are converted to float64 (not numbers are NaN). Packed series
+    (utils.series_pack) are read from the float64 array without decoding.
+    """
+    if count is None:
+        series_list = list(series_list)
+        count = len(series_list)
+
+    count_periods = dmax - dmin + 1
+    columns = []
+    positions = []
+    flat_values = []
+
+    for s in series_list:
+        if len(columns) >= count:
+            logger.warning("series ignored (added after count) [%s]" % s.get(column))
+            break
+        packed = s.get(utils.VALUES_PACKED)
+        if packed:
+            values = numpy.frombuffer(bytes(packed["data"]), dtype="<f8")
+        else:
+            values = [v["value"] for v in s["values"]]
+        '''values beyond dmax are ignored'''
+        start = s["start_date"] - dmin
+        length = min(len(values), count_periods - start)
+        columns.append(s[column])
+        if packed:
+            positions.append((start, values, length))
+        else:
+            positions.append((start, len(flat_values), length))
+            flat_values.extend(values[:length])
+
+    '''one conversion for all values'''
+    data = pandas.to_numeric(numpy.array(flat_values, dtype=object), errors="coerce")
+    data = numpy.asarray(data, dtype="float64")
+
+    matrix = numpy.full((count_periods, len(columns)), numpy.nan, dtype="float64")
+    for j, (start, offset, length) in enumerate(positions):
+        if isinstance(offset, numpy.ndarray):
+            matrix[start:start + length, j] = offset[:length]
+        else:
+            matrix[start:start + length, j] = data[offset:offset + length]
+
+    index = pandas.period_range(start=pandas.Period(ordinal=dmin, freq=frequency),
+                                periods=count_periods, freq=frequency)
+    return pandas.DataFrame(matrix, index=index, columns=columns)
+
+def load_series_dataframe(db, query=None, slugs=None, frequency=None, column="slug",
+                          batch_size=500):
+    """Return DataFrame of series matching query and/or in slugs
+
+    frequency is required if series have several frequencies.
+    """
+    conditions = []
+    if slugs:
+        conditions.append({"slug": {"$in": list(slugs)}})
+    if query:
+        conditions.append(query)
+    if frequency:
+        conditions.append({"frequency": frequency})
+    if not conditions:
+        raise ValueError("query or slugs is required")
+    query = conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    bounds = utils.series_date_bounds(db, query)
+    if not bounds:
+        return pandas.DataFrame()
+
+    if len(bounds) > 1:
+        raise ValueError("series with several frequencies %s - frequency is required" % sorted(bounds.keys()))
+
+    frequency = list(bounds.keys())[0]
+    bounds = bounds[frequency]
+
+    cursor = db[constants.COL_SERIES].find(query, SERIES_DATAFRAME_PROJECTION).batch_size(batch_size)
+
+    return series_to_dataframe(cursor, frequency, bounds["start_date"], bounds["end_date"],
+                               count=bounds["count"], column=column)
+
+def load_dataset_dataframe(db, provider_name, dataset_code, frequency=None, column="key"):
+    """Return DataFrame of all series of a dataset - columns: series keys"""
+    query = {"provider_name": provider_name, "dataset_code": dataset_code}
+    return load_series_dataframe(db, query=query, frequency=frequency, column=column)
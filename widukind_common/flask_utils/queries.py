@@ -11,6 +11,7 @@ from pymongo import ReadPreference
 from pymongo.cursor import Cursor
 
 from widukind_common import constants
+from widukind_common.tags import tags_conditions, SEARCH_MODE_REGEX, SEARCH_MODE_EXPAND
 
 __all__ = [
     'col_providers',
@@ -65,7 +66,8 @@ def complex_queries_series(query=OrderedDict(),
                                         'dataset',
                                         'per_page',
                                         'page',
-                                        'format']):
+                                        'format'],
+                           tags_search_mode=SEARCH_MODE_REGEX):
 
     tags = request.args.get('tags', None)
 
@@ -81,8 +83,13 @@ def complex_queries_series(query=OrderedDict(),
             search_fields.append((r[0], r[1][0]))
 
     if tags and len(tags.split()) > 0:
-        tags = tags.split()
-        conditions = [{"tags": {"$regex": ".*%s.*" % value.lower()}} for value in tags]
+        tags = [value.lower() for value in tags.split()]
+        db = None
+        if tags_search_mode == SEARCH_MODE_EXPAND:
+            db = current_app.widukind_db
+        conditions = [{"tags": c} for c in tags_conditions(tags,
+                                                           search_mode=tags_search_mode,
+                                                           db=db)]
         #query = {"$and": conditions}
         #tags_regexp = [re.compile('.*%s.*' % e, re.IGNORECASE) for e in tags]
         #query["tags"] = {"$all": tags_regexp}
@@ -5,6 +5,11 @@ import logging
 from pprint import pprint
 import re
 import string
+import bisect
+import heapq
+from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import pandas
 
@@ -13,18 +18,62 @@ from pymongo.errors import BulkWriteError
 from pymongo import UpdateOne
 
 from widukind_common import constants
+from widukind_common.utils import get_mongo_client, client_mongo_url
 
 TAGS_REPLACE_CHARS = []
 TAGS_REPLACE_CHARS.extend([s for s in string.punctuation if not s in ["-", "_"]])
 TABLE_MAP = str.maketrans("".join(TAGS_REPLACE_CHARS), "".join([" " for v in TAGS_REPLACE_CHARS]))
 TAGS_MIN_CHAR = 2
+TAGS_CACHE_SIZE = 100000
 
 logger = logging.getLogger(__name__)
 
-def _translate(s):
-    if not s or len(s.strip()) < TAGS_MIN_CHAR:
-        return
-    return s.translate(TABLE_MAP).strip().lower().split()
+class TagsTokenizer(object):
+    """Split and filter words of a string - memoized on the raw string
+
+    Providers names, concepts and codelists labels are repeated for each
+    series of a dataset: the result of each distinct string is kept in a
+    LRU cache.
+
+    >>> tokenizer = TagsTokenizer()
+    >>> tokenizer.tokenize("Bank's of France")
+    ('bank', 'france')
+    """
+
+    def __init__(self, exclude_words=None, min_char=TAGS_MIN_CHAR,
+                 cache_size=TAGS_CACHE_SIZE):
+        if exclude_words is None:
+            exclude_words = constants.TAGS_EXCLUDE_WORDS
+        self.exclude_words = frozenset(exclude_words) | frozenset(["-", "_"])
+        self.min_char = min_char
+        self.tokenize = lru_cache(maxsize=cache_size)(self._tokenize)
+
+    def _tokenize(self, value_str):
+        if not value_str or len(value_str.strip()) < self.min_char:
+            return ()
+        exclude_words = self.exclude_words
+        min_char = self.min_char
+        return tuple([a for a in value_str.translate(TABLE_MAP).lower().split()
+                      if len(a) >= min_char and not a in exclude_words and not a.isdigit()])
+
+    def __call__(self, value_str):
+        return list(self.tokenize(value_str))
+
+    def tags(self, values):
+        """Return sorted list of unique tags from an iterable of strings"""
+        tokenize = self.tokenize
+        tags = set()
+        for value in values:
+            tags.update(tokenize(value))
+        return sorted(tags)
+
+    def cache_clear(self):
+        self.tokenize.cache_clear()
+
+    def cache_info(self):
+        return self.tokenize.cache_info()
+
+TOKENIZER = TagsTokenizer()
 
 def str_to_tags(value_str):
     """Split and filter word - return array of word (to lower)
@@ -41,11 +90,7 @@ def str_to_tags(value_str):
     >>> utils.str_to_tags("Bank's")
     ['bank']
     """
-    tags = _translate(value_str)
-
-    if tags:
-        return [a for a in tags if not a.isdigit() and not a in [None] + constants.TAGS_EXCLUDE_WORDS + ["-", "_", " "] and len(a.strip()) >= TAGS_MIN_CHAR]
-    return []
+    return TOKENIZER(value_str)
 
 def get_categories_tags_for_dataset(db, provider_name, dataset_code):
     tags = []
@@ -63,7 +108,6 @@ def get_categories_tags_for_dataset(db, provider_name, dataset_code):
 def generate_tags_categories(db, doc, doc_provider):
 
     select_for_tags = []
-    tags = []
 
     select_for_tags.append(doc_provider['name'])
     select_for_tags.append(doc_provider['long_name'])
@@ -83,10 +127,7 @@ def generate_tags_categories(db, doc, doc_provider):
             _tags = generate_tags_categories(db, parent, doc_provider)
             select_for_tags.extend(_tags)
 
-    for value in select_for_tags:
-        tags.extend(str_to_tags(value))
-
-    return sorted(list(set(tags)))
+    return TOKENIZER.tags(select_for_tags)
 
 def generate_tags_dataset(db, doc, doc_provider, categories_tags=[]):
     """Split and filter datas for return array of tags
@@ -99,7 +140,6 @@ def generate_tags_dataset(db, doc, doc_provider, categories_tags=[]):
     """
 
     select_for_tags = []
-    tags = []
     select_for_tags.append(doc_provider['name'])
     select_for_tags.append(doc_provider['long_name'])
     select_for_tags.append(doc_provider['region'])
@@ -127,123 +167,108 @@ def generate_tags_dataset(db, doc, doc_provider, categories_tags=[]):
             for value in doc['codelists'][key].values():
                 select_for_tags.append(value)
 
-    for value in select_for_tags:
-        tags.extend(str_to_tags(value))
-
-    return sorted(list(set(tags)))
+    return TOKENIZER.tags(select_for_tags)
 
-def generate_tags_series(doc, doc_provider, doc_dataset, categories_tags=[]):
-    """Split and filter datas for return array of tags
+class SeriesTagsBuilder(object):
+    """Tags dictionary of one dataset, shared by all its series
 
-    Used in update_tags()
+    Provider and dataset tags, concepts and codelists labels are tokenized
+    once by dataset. Tags of a series are an union of precomputed frozensets.
 
-    :param pymongo.database.Database db: MongoDB Database instance
-    :param doc dict: Document MongoDB
-    :param doc_provider dict: Document MongoDB
+    >>> builder = SeriesTagsBuilder(doc_provider, doc_dataset)
+    >>> tags = builder(doc_series)
     """
 
-    select_for_tags = []
-    tags = []
+    def __init__(self, doc_provider, doc_dataset, tokenizer=None):
+        self.tokenizer = tokenizer or TOKENIZER
+        self.concepts = doc_dataset.get('concepts') or {}
+        self.codelists = doc_dataset.get('codelists') or {}
 
-    #if categories_tags:
-    #    tags = categories_tags
+        self.base_tags = self._to_tags([doc_provider['name'],
+                                        doc_provider['long_name'],
+                                        doc_provider['region'],
+                                        doc_dataset['name'],
+                                        doc_dataset['dataset_code']])
 
-    select_for_tags.append(doc_provider['name'])
-    select_for_tags.append(doc_provider['long_name'])
-    select_for_tags.append(doc_provider['region'])
-    select_for_tags.append(doc_dataset['name'])
-    select_for_tags.append(doc['dataset_code'])
-    select_for_tags.append(doc['key'])
-    select_for_tags.append(doc['name'])
+        self.concepts_tags = {}
+        for key, concept in self.concepts.items():
+            if concept:
+                self.concepts_tags[key] = self._to_tags([concept])
 
-    def search_dataset_codelists(key, value):
-        if key in doc_dataset.get('codelists'):
-            codes = doc_dataset['codelists'].get(key)
-            if codes and value in codes:
-                return codes.get(value)
+        self.codes_tags = {}
 
-    if 'notes' in doc and doc['notes'] and len(doc['notes']) > 0:
-        select_for_tags.append(doc['notes'])
+        self.frequencies_tags = {}
+        for frequency, value in constants.FREQUENCIES_DICT.items():
+            self.frequencies_tags[frequency] = self._to_tags([value])
 
-    for field in ["dimensions", "attributes"]:
-        if not doc.get(field):
-            continue
+    def _to_tags(self, values):
+        tokenize = self.tokenizer.tokenize
+        tags = set()
+        for value in values:
+            tags.update(tokenize(value))
+        return frozenset(tags)
+
+    def code_tags(self, key, code):
+        """Tags for one dimension or attribute code - label of codelist if exist"""
+        try:
+            return self.codes_tags[(key, code)]
+        except KeyError:
+            pass
 
-        for key, code in doc[field].items():
+        codes = self.codelists.get(key)
+        code_value = None
+        if codes and code in codes:
+            code_value = codes.get(code)
 
-            concept = doc_dataset.get('concepts').get(key)
-            if concept:
-                select_for_tags.append(concept)
+        tags = self._to_tags([code_value or code])
+        self.codes_tags[(key, code)] = tags
+        return tags
 
-            code_value = search_dataset_codelists(key, code)
-            if code_value:
-                select_for_tags.append(code_value)
-            else:
-                select_for_tags.append(code)
+    def __call__(self, doc):
+        tokenize = self.tokenizer.tokenize
+
+        tags = set(self.base_tags)
+        tags.update(tokenize(doc['dataset_code']))
+        tags.update(tokenize(doc['key']))
+        tags.update(tokenize(doc['name']))
 
-    if doc['frequency'] in constants.FREQUENCIES_DICT:
-        select_for_tags.append(constants.FREQUENCIES_DICT[doc['frequency']])
+        if 'notes' in doc and doc['notes'] and len(doc['notes']) > 0:
+            tags.update(tokenize(doc['notes']))
 
-    for value in select_for_tags:
-        tags.extend(str_to_tags(value))
+        concepts_tags = self.concepts_tags
+        for field in ["dimensions", "attributes"]:
+            if not doc.get(field):
+                continue
+
+            for key, code in doc[field].items():
+                if key in concepts_tags:
+                    tags.update(concepts_tags[key])
+                tags.update(self.code_tags(key, code))
 
-    return sorted(list(set(tags)))
+        if doc['frequency'] in self.frequencies_tags:
+            tags.update(self.frequencies_tags[doc['frequency']])
 
-def generate_tags_series_async(doc, doc_provider, doc_dataset):
+        return sorted(tags)
+
+def generate_tags_series(doc, doc_provider, doc_dataset, categories_tags=[],
+                         tags_builder=None):
     """Split and filter datas for return array of tags
 
     Used in update_tags()
 
-    :param pymongo.database.Database db: MongoDB Database instance
     :param doc dict: Document MongoDB
     :param doc_provider dict: Document MongoDB
+    :param doc_dataset dict: Document MongoDB
+    :param SeriesTagsBuilder tags_builder: Precomputed tags of the dataset
     """
 
-    tags = []
-
     #if categories_tags:
     #    tags = categories_tags
 
-    yield doc_provider['name']
-    yield doc_provider['long_name']
-    yield doc_provider['region']
-    yield doc['dataset_code']
-    yield doc['name']
-    yield doc['key']
-    yield doc['name']
-
-    def search_dataset_concepts(key):
-        if doc_dataset.get('concepts'):
-            return doc_dataset.get('concepts').get(key)
-
-    def search_dataset_codelists(key, value):
-        if key in doc_dataset.get('codelists'):
-            codes = doc_dataset['codelists'].get(key)
-            if codes:
-                return codes.get(value)
-
-    if 'notes' in doc and doc['notes'] and len(doc['notes']) > 0:
-        yield doc['notes']
-
-    for field in ["dimensions", "attributes"]:
-        if not doc.get(field):
-            continue
-
-        for key, code in doc[field].items():
-
-            concept = search_dataset_concepts(key)
-            if concept:
-                yield concept
-
-            code_value = search_dataset_codelists(key, code)
-            if code_value:
-                yield code_value
-            else:
-                yield code
-
-    if doc['frequency'] in constants.FREQUENCIES_DICT:
-        yield constants.FREQUENCIES_DICT[doc['frequency']]
+    if not tags_builder:
+        tags_builder = SeriesTagsBuilder(doc_provider, doc_dataset)
 
+    return tags_builder(doc)
 
 def bulk_result_aggregate(bulk_result):
     """Aggregate array of bulk execute to unique dict
@@ -336,8 +361,58 @@ def update_tags_categories(db, provider_name=None,
 
     return bulk_result_aggregate([])
 
+def _tags_watermark_id(provider_name, target):
+    return "tags.%s.%s" % (target, provider_name)
+
+def get_tags_watermark(db, provider_name, target=constants.COL_SERIES):
+    """Return last_update of the most recent dataset tagged for provider"""
+    doc = db[constants.COL_COUNTERS].find_one({"_id": _tags_watermark_id(provider_name, target)})
+    if doc:
+        return doc.get("last_update")
+
+def set_tags_watermark(db, provider_name, last_update, target=constants.COL_SERIES):
+    """Record the watermark of provider - never go back"""
+    query = {"_id": _tags_watermark_id(provider_name, target)}
+    update = {"$max": {"last_update": last_update}}
+    return db[constants.COL_COUNTERS].update_one(query, update, upsert=True)
+
+def _datasets_query(provider_name, dataset_code=None, last_update_since=None):
+    query = {'provider_name': provider_name, "enable": True}
+
+    if dataset_code:
+        query["dataset_code"] = dataset_code
+
+    if last_update_since:
+        query["last_update"] = {"$gt": last_update_since}
+
+    return query
+
+def _incremental_range(db, provider_name, dataset_code=None,
+                       target=constants.COL_SERIES):
+    """Return (watermark, new watermark) for incremental mode
+
+    The new watermark is the max last_update of datasets to process -
+    computed before processing.
+    """
+    since = get_tags_watermark(db, provider_name, target=target)
+    query = _datasets_query(provider_name, dataset_code=dataset_code,
+                            last_update_since=since)
+    doc = db[constants.COL_DATASETS].find_one(query, {"last_update": True},
+                                              sort=[("last_update", DESCENDING)])
+    if doc:
+        return since, doc.get("last_update")
+    return since, None
+
+def _commit_watermark(db, provider_name, last_update, dataset_code=None,
+                      dry_mode=False, target=constants.COL_SERIES):
+    """Only a complete run of provider move the watermark"""
+    if dry_mode or dataset_code or not last_update:
+        return
+    set_tags_watermark(db, provider_name, last_update, target=target)
+
 def update_tags_datasets(db, provider_name=None, dataset_code=None,
-                         max_bulk=100, update_only=False, dry_mode=False):
+                         max_bulk=100, update_only=False, dry_mode=False,
+                         incremental=False):
 
     doc_provider = db[constants.COL_PROVIDERS].find_one({"enable": True,
                                                          "name": provider_name})
@@ -346,15 +421,19 @@ def update_tags_datasets(db, provider_name=None, dataset_code=None,
         logger.error("Provider [%s] not found or disable." % provider_name)
         return
 
-    query = {'provider_name': provider_name, "enable": True}
+    since, watermark = None, None
+    if incremental:
+        since, watermark = _incremental_range(db, provider_name,
+                                              dataset_code=dataset_code,
+                                              target=constants.COL_DATASETS)
+
+    query = _datasets_query(provider_name, dataset_code=dataset_code,
+                            last_update_since=since)
     projection = {"doc_href": False, "dimension_list": False, "attribute_list": False}
 
     if update_only:
         query["tags.0"] = {"$exists": False}
 
-    if dataset_code:
-        query["dataset_code"] = dataset_code
-
     bulk = db[constants.COL_DATASETS].initialize_unordered_bulk_op()
     bulk_list = []
     bulk_results = []
@@ -389,28 +468,55 @@ def update_tags_datasets(db, provider_name=None, dataset_code=None,
             bulk.find({'_id': b[0]}).update_one({"$set": {'tags': b[1]}})
         bulk_results.append(run_bulk(bulk))
 
+    if incremental:
+        _commit_watermark(db, provider_name, watermark,
+                          dataset_code=dataset_code, dry_mode=dry_mode,
+                          target=constants.COL_DATASETS)
+
     return bulk_result_aggregate(bulk_results)
 
+SERIES_TAGS_PROJECTION = {"_id": True, "dataset_code": True, "key": True,
+                          "name": True, "notes": True, "frequency": True,
+                          "dimensions": True, "attributes": True,
+                          "tags": True}
+
+def is_tags_changed(doc, tags):
+    """Return True if tags differ from the tags stored in doc"""
+    old_tags = doc.get("tags")
+    if not old_tags:
+        return bool(tags)
+    return sorted(old_tags) != tags
+
 def _update_tags_series_unit(db,
                             provider=None, dataset=None, categories_tags=[],
-                            update_only=False, dry_mode=False):
+                            update_only=False, dry_mode=False, id_range=None):
 
     provider_name = dataset["provider_name"]
     dataset_code = dataset["dataset_code"]
 
     series_query = {'provider_name': provider_name,
                     "dataset_code": dataset_code}
-    series_projection = {"values": False}
+    series_projection = SERIES_TAGS_PROJECTION
 
     if update_only:
         series_query["tags.0"] = {"$exists": False}
 
+    if id_range:
+        series_query["_id"] = {}
+        if id_range[0] is not None:
+            series_query["_id"]["$gte"] = id_range[0]
+        if id_range[1] is not None:
+            series_query["_id"]["$lt"] = id_range[1]
+
+    tags_builder = SeriesTagsBuilder(provider, dataset)
+
     for doc in db[constants.COL_SERIES].find(series_query,
                                              series_projection,
                                              #no_cursor_timeout=True
                                              ):
 
-        tags = generate_tags_series(doc, provider, dataset)#, categories_tags)
+        tags = generate_tags_series(doc, provider, dataset,
+                                    tags_builder=tags_builder)#, categories_tags)
 
         if logger.isEnabledFor(logging.DEBUG):
             msg = "update tags for series[%s] - dataset[%s] - provider[%s] - tags%s"
@@ -422,7 +528,8 @@ def _update_tags_series_unit(db,
         yield doc, tags
 
 def _update_tags_series(db, provider_name=None, dataset_code=None,
-                       update_only=False, dry_mode=False):
+                       update_only=False, dry_mode=False,
+                       last_update_since=None):
 
     doc_provider = db[constants.COL_PROVIDERS].find_one({"enable": True,
                                                          "name": provider_name})
@@ -431,13 +538,11 @@ def _update_tags_series(db, provider_name=None, dataset_code=None,
         logger.error("Provider [%s] not found or disable." % provider_name)
         return
 
-    dataset_query = {'provider_name': provider_name, "enable": True}
+    dataset_query = _datasets_query(provider_name, dataset_code=dataset_code,
+                                    last_update_since=last_update_since)
     dataset_projection = {"doc_href": False,
                           "dimension_list": False, "attribute_list": False}
 
-    if dataset_code:
-        dataset_query["dataset_code"] = dataset_code
-
     dataset_ids = db[constants.COL_DATASETS].find(dataset_query).distinct("_id")
 
     for _id in dataset_ids:
@@ -447,17 +552,43 @@ def _update_tags_series(db, provider_name=None, dataset_code=None,
             yield doc, tags
 
 def _update_tags_series_sync(db, provider_name=None, dataset_code=None,
-                            max_bulk=100, update_only=False, dry_mode=False):
+                            max_bulk=100, update_only=False, dry_mode=False,
+                            incremental=False, update_counters=False):
 
     bulk_list = []
     bulk_results = []
+    count_skipped = 0
+    count_changed = 0
+    tags_delta = TagsDelta(provider_name)
+
+    doc_provider = db[constants.COL_PROVIDERS].find_one({"enable": True,
+                                                         "name": provider_name})
+
+    if not doc_provider:
+        '''before the watermark: a disabled provider must not move it'''
+        logger.error("Provider [%s] not found or disable." % provider_name)
+        return
+
+    since, watermark = None, None
+    if incremental:
+        since, watermark = _incremental_range(db, provider_name,
+                                              dataset_code=dataset_code)
 
     for doc, tags in _update_tags_series(db, provider_name=provider_name,
                                          dataset_code=dataset_code,
-                                         update_only=update_only, dry_mode=dry_mode):
+                                         update_only=update_only, dry_mode=dry_mode,
+                                         last_update_since=since):
+
+        if not is_tags_changed(doc, tags):
+            count_skipped += 1
+            continue
+
+        count_changed += 1
 
         if not dry_mode and tags:
             bulk_list.append(UpdateOne({'_id': doc["_id"]}, {"$set": {'tags': tags}}))
+            if update_counters:
+                tags_delta.add(doc["dataset_code"], doc.get("tags"), tags)
 
         elif dry_mode and tags:
             print("--------------------------------")
@@ -476,10 +607,16 @@ def _update_tags_series_sync(db, provider_name=None, dataset_code=None,
             result = db[constants.COL_SERIES].bulk_write(bulk_list)
             bulk_results.append(result)
             bulk_list = []
+            tags_delta.apply(db, max_bulk=max_bulk)
 
     if not dry_mode and len(bulk_list) > 0:
         result = db[constants.COL_SERIES].bulk_write(bulk_list)
         bulk_results.append(result)
+        tags_delta.apply(db, max_bulk=max_bulk)
+
+    if incremental:
+        _commit_watermark(db, provider_name, watermark,
+                          dataset_code=dataset_code, dry_mode=dry_mode)
 
     bulk_dict = {
         "nUpserted": 0,
@@ -487,6 +624,8 @@ def _update_tags_series_sync(db, provider_name=None, dataset_code=None,
         "nMatched": 0, #matched_count
         "nRemoved": 0,
         "nInserted": 0,
+        "nSkipped": count_skipped,
+        "nChanged": count_changed,
     }
     for b in bulk_results:
         bulk_dict["nMatched"] += b.matched_count
@@ -495,7 +634,8 @@ def _update_tags_series_sync(db, provider_name=None, dataset_code=None,
     return bulk_dict
 
 def _update_tags_series_async_gevent(db, provider_name=None, dataset_code=None,
-                               max_bulk=100, update_only=False, dry_mode=False):
+                               max_bulk=100, update_only=False, dry_mode=False,
+                               incremental=False):
 
 
     import gevent
@@ -505,8 +645,8 @@ def _update_tags_series_async_gevent(db, provider_name=None, dataset_code=None,
     pool = Pool(10)
     queue = Queue()
 
-    count_errors = 0
     count_success = 0
+    counters = {"skipped": 0, "errors": 0}
 
     def _queue_process():
 
@@ -544,18 +684,21 @@ def _update_tags_series_async_gevent(db, provider_name=None, dataset_code=None,
         logger.error("Provider [%s] not found or disable." % provider_name)
         return
 
-    dataset_query = {'provider_name': provider_name, "enable": True}
+    since, watermark = None, None
+    if incremental:
+        since, watermark = _incremental_range(db, provider_name,
+                                              dataset_code=dataset_code)
+
+    dataset_query = _datasets_query(provider_name, dataset_code=dataset_code,
+                                    last_update_since=since)
     dataset_projection = {"doc_href": False,
                           "dimension_list": False, "attribute_list": False}
 
-    if dataset_code:
-        dataset_query["dataset_code"] = dataset_code
-
     def _series_list_process(doc_dataset):
 
         series_query = { "provider_name": doc_dataset["provider_name"],
                          "dataset_code": doc_dataset["dataset_code"]}
-        series_projection = {"values": False}
+        series_projection = SERIES_TAGS_PROJECTION
 
         if update_only:
             series_query["tags.0"] = {"$exists": False}
@@ -564,32 +707,46 @@ def _update_tags_series_async_gevent(db, provider_name=None, dataset_code=None,
 
         pool_series = Pool(200)
 
-        def _serie_process(doc):
-            select_for_tags = [tag for tag in generate_tags_series_async(doc, doc_provider, doc_dataset)]
-
-            tags = []
-            for value in select_for_tags:
-                tags.extend(str_to_tags(value))
+        tags_builder = SeriesTagsBuilder(doc_provider, doc_dataset)
 
-            queue.put((doc["_id"], sorted(list(set(tags)))))
+        def _serie_process(doc):
+            tags = tags_builder(doc)
+            if is_tags_changed(doc, tags):
+                queue.put((doc["_id"], tags))
+            else:
+                counters["skipped"] += 1
 
+        greenlets = []
         for doc in db[constants.COL_SERIES].find(series_query, series_projection):
-            pool_series.spawn(_serie_process, doc)
+            greenlets.append(pool_series.spawn(_serie_process, doc))
 
         pool_series.join()
 
+        failed = [g for g in greenlets if not g.successful()]
+        if failed:
+            raise Exception("dataset[%s] - series errors[%s]: %s" % (doc_dataset["dataset_code"],
+                                                                    len(failed), failed[0].exception))
+
     def _process_ds():
         count_ds = 0
+        greenlets = []
 
-        for doc_dataset in db[constants.COL_DATASETS].find(dataset_query,
-                                                           dataset_projection):
+        try:
+            for doc_dataset in db[constants.COL_DATASETS].find(dataset_query,
+                                                               dataset_projection):
 
-            count_ds += 1
-            pool.spawn(_series_list_process, doc_dataset)
+                count_ds += 1
+                greenlets.append(pool.spawn(_series_list_process, doc_dataset))
 
-        pool.join()
+            pool.join()
+        finally:
+            queue.put((None, None))
 
-        queue.put((None, None))
+        '''exceptions of greenlets are not raised by join'''
+        for g in greenlets:
+            if not g.successful():
+                counters["errors"] += 1
+                logger.error("update tags series error: %s" % g.exception)
         return count_ds
 
     queue_green = gevent.spawn(_queue_process)
@@ -598,45 +755,295 @@ def _update_tags_series_async_gevent(db, provider_name=None, dataset_code=None,
         gevent.joinall([ds_green, queue_green])
     except KeyboardInterrupt:
         pass
+    else:
+        for g in [ds_green, queue_green]:
+            if not g.successful():
+                counters["errors"] += 1
+                logger.error("update tags series error: %s" % g.exception)
+
+        '''watermark only if all datasets are processed'''
+        if incremental and not counters["errors"]:
+            _commit_watermark(db, provider_name, watermark,
+                              dataset_code=dataset_code, dry_mode=dry_mode)
+        elif incremental:
+            logger.error("watermark not updated - errors[%s]" % counters["errors"])
 
     count_stats = dict(
         count_ds = ds_green.value,
-        count_series = queue_green.value[0],
-        count_errors = count_errors,
+        count_series = queue_green.value[0] if queue_green.value else 0,
+        count_errors = counters["errors"],
         count_success = count_success,
-        count_modified = queue_green.value[1]
+        count_modified = queue_green.value[1] if queue_green.value else 0,
+        count_skipped = counters["skipped"]
     )
 
-    msg = "modified[%(count_modified)s] - errors[%(count_errors)s] - success[%(count_success)s] - datasets[%(count_ds)s] - series[%(count_series)s]"
+    msg = "modified[%(count_modified)s] - skipped[%(count_skipped)s] - errors[%(count_errors)s] - success[%(count_success)s] - datasets[%(count_ds)s] - series[%(count_series)s]"
     logger.info(msg % count_stats)
 
+_PROCESS_CLIENTS = {}
+
+def _series_id_ranges(db, doc_dataset, update_only=False, max_series=10000):
+    """Split series of one dataset in [start, end[ ranges of _id
+
+    Return a list of (start, end) - None for unbounded side
+    """
+    series_query = {"provider_name": doc_dataset["provider_name"],
+                    "dataset_code": doc_dataset["dataset_code"]}
+
+    if update_only:
+        series_query["tags.0"] = {"$exists": False}
+
+    bounds = []
+    cursor = db[constants.COL_SERIES].find(series_query, {"_id": True})
+    for i, doc in enumerate(cursor.sort("_id", ASCENDING)):
+        if i > 0 and i % max_series == 0:
+            bounds.append(doc["_id"])
+
+    starts = [None] + bounds
+    ends = bounds + [None]
+    return list(zip(starts, ends))
+
+def _update_tags_series_worker(db, doc_provider, doc_dataset, id_range=None,
+                               update_only=False):
+    """Generate tags for one range of series
+
+    Return list of (_id, key, tags, old_tags) for changed series and
+    the count of unchanged series.
+    """
+    results = []
+    count_skipped = 0
+    for doc, tags in _update_tags_series_unit(db, doc_provider, doc_dataset,
+                                              update_only=update_only,
+                                              id_range=id_range):
+        if is_tags_changed(doc, tags):
+            results.append((doc["_id"], doc["key"], tags, doc.get("tags")))
+        else:
+            count_skipped += 1
+    return results, count_skipped
+
+def _update_tags_series_process_task(mongo_url, db_name, doc_provider,
+                                     doc_dataset, id_range=None,
+                                     update_only=False):
+    """Run in child process - one MongoClient by process"""
+
+    if not mongo_url in _PROCESS_CLIENTS:
+        _PROCESS_CLIENTS[mongo_url] = get_mongo_client(mongo_url)
+    db = _PROCESS_CLIENTS[mongo_url][db_name]
+
+    return _update_tags_series_worker(db, doc_provider, doc_dataset,
+                                      id_range=id_range,
+                                      update_only=update_only)
+
+def _update_tags_series_async_process(db, provider_name=None, dataset_code=None,
+                                      max_bulk=100, update_only=False,
+                                      dry_mode=False, max_workers=None,
+                                      max_series=10000, mongo_url=None,
+                                      incremental=False, update_counters=False):
+    """Generate tags in a pool of process and write from the current process
+
+    Datasets with more than max_series series are splitted in _id ranges.
+
+    mongo_url: URL used by child processes - default: URL of db client
+    (required if db is not from get_mongo_client)
+    """
+
+    mongo_url = mongo_url or client_mongo_url(db.client)
+    if not mongo_url:
+        raise ValueError("mongo_url is required - db is not from get_mongo_client")
+
+    doc_provider = db[constants.COL_PROVIDERS].find_one({"enable": True,
+                                                         "name": provider_name})
+
+    if not doc_provider:
+        logger.error("Provider [%s] not found or disable." % provider_name)
+        return
+
+    since, watermark = None, None
+    if incremental:
+        since, watermark = _incremental_range(db, provider_name,
+                                              dataset_code=dataset_code)
+
+    dataset_query = _datasets_query(provider_name, dataset_code=dataset_code,
+                                    last_update_since=since)
+    dataset_projection = {"doc_href": False,
+                          "dimension_list": False, "attribute_list": False}
+
+    bulk_list = []
+    bulk_results = []
+    count_ds = 0
+    count_changed = 0
+    count_skipped = 0
+    tags_delta = TagsDelta(provider_name)
+
+    def _process_requests(requests):
+        if not dry_mode and requests:
+            bulk_results.append(db[constants.COL_SERIES].bulk_write(requests,
+                                                                    ordered=False))
+            tags_delta.apply(db, max_bulk=max_bulk)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for doc_dataset in db[constants.COL_DATASETS].find(dataset_query,
+                                                           dataset_projection):
+            count_ds += 1
+            for id_range in _series_id_ranges(db, doc_dataset,
+                                              update_only=update_only,
+                                              max_series=max_series):
+                future = executor.submit(_update_tags_series_process_task,
+                                         mongo_url, db.name,
+                                         doc_provider, doc_dataset,
+                                         id_range=id_range,
+                                         update_only=update_only)
+                futures[future] = doc_dataset["dataset_code"]
+
+        for future in as_completed(futures):
+            results, skipped = future.result()
+            count_skipped += skipped
+            for _id, key, tags, old_tags in results:
+                count_changed += 1
+
+                if dry_mode and tags:
+                    print("--------------------------------")
+                    print("dataset[%s] - series[%s] - tags[%s]" % (futures[future],
+                                                                   key, ", ".join(tags)))
+                    print("--------------------------------")
+                elif tags:
+                    bulk_list.append(UpdateOne({'_id': _id}, {"$set": {'tags': tags}}))
+                    if update_counters:
+                        tags_delta.add(futures[future], old_tags, tags)
+
+                if len(bulk_list) >= max_bulk:
+                    _process_requests(bulk_list)
+                    bulk_list = []
+
+    _process_requests(bulk_list)
+
+    if incremental:
+        _commit_watermark(db, provider_name, watermark,
+                          dataset_code=dataset_code, dry_mode=dry_mode)
+
+    bulk_dict = {
+        "nUpserted": 0,
+        "nModified": 0, #modified_count
+        "nMatched": 0, #matched_count
+        "nRemoved": 0,
+        "nInserted": 0,
+        "nSkipped": count_skipped,
+        "nChanged": count_changed,
+    }
+    for b in bulk_results:
+        bulk_dict["nMatched"] += b.matched_count
+        bulk_dict["nModified"] += b.modified_count
+
+    msg = "modified[%s] - skipped[%s] - datasets[%s] - series[%s]"
+    logger.info(msg % (bulk_dict["nModified"], count_skipped, count_ds,
+                       count_changed + count_skipped))
+
+    return bulk_dict
+
 def update_tags_series(db, provider_name=None, dataset_code=None, max_bulk=100,
-                       update_only=False, dry_mode=False, async_mode=None):
+                       update_only=False, dry_mode=False, async_mode=None,
+                       max_workers=None, mongo_url=None, incremental=False,
+                       update_counters=False):
+    """Generate and record tags of series
+
+    :param bool incremental: Only series of datasets with last_update more
+    recent than the watermark of the provider - the watermark is updated
+    after a complete run (without dataset_code).
+    :param bool update_counters: Apply added/removed tags to counters of
+    tags collection (not available with gevent)
+    """
 
     if not async_mode:
         return _update_tags_series_sync(db,
                                         provider_name=provider_name,
                                         dataset_code=dataset_code, max_bulk=max_bulk,
                                         update_only=update_only,
-                                        dry_mode=dry_mode)
+                                        dry_mode=dry_mode,
+                                        incremental=incremental,
+                                        update_counters=update_counters)
     elif async_mode == "gevent":
         return _update_tags_series_async_gevent(db,
                                         provider_name=provider_name,
                                         dataset_code=dataset_code, max_bulk=max_bulk,
                                         update_only=update_only,
-                                        dry_mode=dry_mode)
+                                        dry_mode=dry_mode,
+                                        incremental=incremental)
+    elif async_mode == "process":
+        return _update_tags_series_async_process(db,
+                                        provider_name=provider_name,
+                                        dataset_code=dataset_code, max_bulk=max_bulk,
+                                        update_only=update_only,
+                                        dry_mode=dry_mode,
+                                        max_workers=max_workers,
+                                        mongo_url=mongo_url,
+                                        incremental=incremental,
+                                        update_counters=update_counters)
     else:
         raise Exception("not supported async mode[%s]" % async_mode)
 
+SEARCH_MODE_REGEX = "regex"
+SEARCH_MODE_EXACT = "exact"
+SEARCH_MODE_PREFIX = "prefix"
+SEARCH_MODE_EXPAND = "expand"
+
+SEARCH_MODES = [
+    SEARCH_MODE_REGEX,
+    SEARCH_MODE_EXACT,
+    SEARCH_MODE_PREFIX,
+    SEARCH_MODE_EXPAND,
+]
+
+def expand_tags(db, tag, limit=1000):
+    """Return names of tags collection starting with tag (use name_idx)"""
+    query = {"name": {"$regex": "^%s" % re.escape(tag)}}
+    cursor = db[constants.COL_TAGS].find(query, {"_id": False, "name": True})
+    return [doc["name"] for doc in cursor.limit(limit)]
+
+def tags_conditions(tags, search_mode=SEARCH_MODE_REGEX, db=None,
+                    expand_limit=1000):
+    """Return one condition on tags field by tag
+
+    - regex: unanchored regex - collection scan
+    - exact: exact tag
+    - prefix: anchored regex - use index on tags
+    - expand: $in with tags names starting with tag, from tags collection
+    """
+    conditions = []
+    for tag in tags:
+        if search_mode == SEARCH_MODE_REGEX:
+            conditions.append(re.compile(r'.*%s.*' % tag))
+        elif search_mode == SEARCH_MODE_EXACT:
+            conditions.append(tag)
+        elif search_mode == SEARCH_MODE_PREFIX:
+            conditions.append(re.compile(r'^%s' % re.escape(tag)))
+        elif search_mode == SEARCH_MODE_EXPAND:
+            conditions.append({"$in": expand_tags(db, tag, limit=expand_limit)})
+        else:
+            raise ValueError("not supported search mode[%s]" % search_mode)
+    return conditions
+
+def tags_query(tags, search_mode=SEARCH_MODE_REGEX, db=None):
+    """Return query for documents with all tags - same as $all"""
+    conditions = tags_conditions(tags, search_mode=search_mode, db=db)
+    if not conditions:
+        return {"tags": {"$in": []}}
+    if len(conditions) == 1:
+        return {"tags": conditions[0]}
+    return {"$and": [{"tags": c} for c in conditions]}
+
 def search_tags(db, provider_name=None, dataset_code=None,
                 frequency=None,
                 projection=None,
                 search_tags=None, search_type=None,
                 start_date=None, end_date=None,
                 sort=None, sort_desc=False,
-                skip=None, limit=None):
+                skip=None, limit=None,
+                search_mode=SEARCH_MODE_REGEX):
     """Search in datasets or series by tags field
 
+    search_mode: regex (default), exact, prefix or expand - see tags_conditions()
+
     >>> from dlstats import utils
     >>> db = utils.get_mongo_db()
 
@@ -655,8 +1062,7 @@ def search_tags(db, provider_name=None, dataset_code=None,
     '''Convert search tag to lower case and strip tag'''
     tags = str_to_tags(search_tags)
 
-    tags_regexp = [re.compile(r'.*%s.*' % e) for e in tags] #, re.IGNORECASE
-    query = {"tags": {"$all": tags_regexp}}
+    query = tags_query(tags, search_mode=search_mode, db=db)
 
     if provider_name:
 
@@ -713,6 +1119,96 @@ def search_tags(db, provider_name=None, dataset_code=None,
 
     return cursor, query
 
+class TagsCompleter(object):
+    """Prefix completion of tags names ranked by count
+
+    Names and counts of tags collection are kept in a sorted snapshot
+    refreshed every refresh_interval seconds - completion use bisect and
+    never query MongoDB. The snapshot (names, counts, cache) is replaced
+    as one tuple and read once by complete(): safe with concurrent load().
+
+    >>> completer = TagsCompleter(db, count_field="count_series")
+    >>> completer.complete("fra", limit=2)
+    [{'name': 'france', 'count': 1520}, {'name': 'francs', 'count': 12}]
+    """
+
+    def __init__(self, db, count_field="count", refresh_interval=300,
+                 cache_size=1000):
+        self.db = db
+        self.count_field = count_field
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self.snapshot = ([], [], {})
+        self.loaded = None
+
+    def load(self, docs):
+        """Load snapshot from iterable of (name, count)"""
+        docs = sorted(docs)
+        names = [doc[0] for doc in docs]
+        counts = [doc[1] or 0 for doc in docs]
+        self.snapshot = (names, counts, {})
+        self.loaded = time.time()
+
+    def refresh(self):
+        query = {"enable": {"$ne": False}}
+        projection = {"_id": False, "name": True, self.count_field: True}
+        cursor = self.db[constants.COL_TAGS].find(query, projection)
+        self.load([(doc["name"], doc.get(self.count_field)) for doc in cursor])
+
+    def is_expired(self, now=None):
+        if self.loaded is None:
+            return True
+        now = now or time.time()
+        return now - self.loaded >= self.refresh_interval
+
+    def complete(self, prefix, limit=10):
+        """Return list of {"name", "count"} - a copy of the cached result"""
+        if self.is_expired():
+            self.refresh()
+
+        prefix = (prefix or "").strip().lower()
+        if not prefix:
+            return []
+
+        names, counts, cache = self.snapshot
+
+        cache_key = (prefix, limit)
+        if cache_key in cache:
+            return [dict(doc) for doc in cache[cache_key]]
+
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + "\uffff", lo=start)
+
+        if end - start <= limit:
+            indexes = sorted(range(start, end), key=lambda i: -counts[i])
+        else:
+            indexes = heapq.nlargest(limit, range(start, end), key=counts.__getitem__)
+
+        result = [{"name": names[i], "count": counts[i]} for i in indexes]
+
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[cache_key] = result
+        return [dict(doc) for doc in result]
+
+_TAGS_COMPLETERS = {}
+
+def complete_tags(db, prefix, limit=10, count_field="count", refresh_interval=300):
+    """Return tags starting with prefix, ranked by count_field
+
+    One TagsCompleter snapshot is kept by server, database and count_field.
+    """
+    '''not id(client): a new client can reuse the id of a closed one'''
+    server = client_mongo_url(db.client) or db.client.address
+    key = (server, db.name, count_field)
+    if not key in _TAGS_COMPLETERS:
+        _TAGS_COMPLETERS[key] = TagsCompleter(db, count_field=count_field,
+                                              refresh_interval=refresh_interval)
+    completer = _TAGS_COMPLETERS[key]
+    completer.db = db
+    completer.refresh_interval = refresh_interval
+    return completer.complete(prefix, limit=limit)
+
 def search_series_tags(db, **kwargs):
     return search_tags(db, search_type=constants.COL_SERIES, **kwargs)
 
@@ -722,15 +1218,11 @@ def search_datasets_tags(db, **kwargs):
     kwargs.setdefault("projection", projection)
     return search_tags(db, search_type=constants.COL_DATASETS, **kwargs)
 
-def _aggregate_tags(db, source_col, target_col, add_match=None, max_bulk=20):
-
-    bulk = db[target_col].initialize_unordered_bulk_op()
-    count = 0
-
-    match = {"tags.0": {"$exists": True}}
-    if add_match:
-        match.update(add_match)
-
+def _aggregate_tags_pipeline(match, with_slug=True):
+    """with_slug: collect slugs by tag - only used for datasets (one
+    slug by series would exceed the document limit on large collections).
+    Without slugs, counts by provider and dataset are pushed in providers.
+    """
     pipeline = [
       {"$match": match},
       {'$project': { '_id': 0, 'tags': 1, 'provider_name': 1, 'dataset_code': 1, 'slug': 1}},
@@ -740,10 +1232,95 @@ def _aggregate_tags(db, source_col, target_col, add_match=None, max_bulk=20):
       {"$group": {"_id": "$tag", "count": {"$sum": "$count"}, "slug":{ "$addToSet": "$slug" }, "provider_name":{ "$addToSet": "$provider_name" }, "dataset_code":{ "$addToSet": "$dataset_code" } }},
       #{"$sort": SON([("count", -1), ("_id", -1)])}
     ]
+    if not with_slug:
+        pipeline[1] = {'$project': { '_id': 0, 'tags': 1, 'provider_name': 1, 'dataset_code': 1}}
+        pipeline[3] = {"$group": {"_id": {"tag": "$tags", 'provider_name': "$provider_name", 'dataset_code': "$dataset_code"}, "count": {"$sum": 1}}}
+        pipeline[4] = {'$project': { 'tag': "$_id.tag", 'count': 1, "provider_name": "$_id.provider_name", 'dataset_code': "$_id.dataset_code"}}
+        del pipeline[5]["$group"]["slug"]
+        pipeline[5]["$group"]["providers"] = {"$push": {"provider_name": "$provider_name", "count": "$count"}}
+    return pipeline
+
+def _aggregate_tags_partitions(db, source_col, match, partition_by):
+    """Return list of match query - one by provider or by dataset"""
+
+    if partition_by == "provider_name":
+        providers = db[source_col].distinct("provider_name", match)
+        return [{"$and": [match, {"provider_name": provider_name}]}
+                for provider_name in sorted(providers)]
+
+    elif partition_by == "dataset_code":
+        '''from source collection: series without dataset document are kept'''
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"p": "$provider_name", "d": "$dataset_code"}}},
+        ]
+        cursor = db[source_col].aggregate(pipeline, allowDiskUse=True)
+        datasets = sorted([(doc["_id"].get("p"), doc["_id"].get("d")) for doc in cursor],
+                          key=lambda k: (str(k[0]), str(k[1])))
+        return [{"$and": [match, {"provider_name": provider_name,
+                                  "dataset_code": dataset_code}]}
+                for provider_name, dataset_code in datasets]
+
+    raise ValueError("not supported partition_by[%s]" % partition_by)
+
+def _aggregate_tags_partition(db, source_col, match):
+    pipeline = _aggregate_tags_pipeline(match,
+                                        with_slug=source_col == constants.COL_DATASETS)
+    return list(db[source_col].aggregate(pipeline, allowDiskUse=True))
+
+def _aggregate_tags_merge(results, with_slug=True):
+    """Merge results of partitions by tag"""
+    fields = ["provider_name", "dataset_code"]
+    if with_slug:
+        fields.append("slug")
+    merged = {}
+    for result in results:
+        for doc in result:
+            if not doc["_id"] in merged:
+                merged[doc["_id"]] = {"_id": doc["_id"], "count": 0}
+                for field in fields:
+                    merged[doc["_id"]][field] = set()
+            tag = merged[doc["_id"]]
+            tag["count"] += doc["count"]
+            for field in fields:
+                tag[field].update(doc[field])
+            if not with_slug:
+                tag.setdefault("providers", []).extend(doc["providers"])
+
+    for tag in merged.values():
+        for field in fields:
+            tag[field] = sorted(tag[field])
+        yield tag
+
+def _aggregate_tags(db, source_col, target_col, add_match=None, max_bulk=20,
+                    partition_by=None, max_workers=None):
+    """Aggregate tags of datasets or series in tags collection
+
+    :param str partition_by: None, "provider_name" or "dataset_code" - run
+    one aggregation by partition in a thread pool and merge results
+    before update.
+    :param int max_workers: Size of the thread pool
+    """
 
-    bulk_result = []
+    bulk = db[target_col].initialize_unordered_bulk_op()
+    count = 0
 
-    result = db[source_col].aggregate(pipeline, allowDiskUse=True)
+    match = {"tags.0": {"$exists": True}}
+    if add_match:
+        match.update(add_match)
+
+    bulk_result = []
+    with_slug = source_col == constants.COL_DATASETS
+
+    if partition_by:
+        partitions = _aggregate_tags_partitions(db, source_col, match, partition_by)
+        with ThreadPoolExecutor(max_workers=max_workers or 4) as executor:
+            results = executor.map(lambda m: _aggregate_tags_partition(db, source_col, m),
+                                   partitions)
+            result = list(_aggregate_tags_merge(results, with_slug=with_slug))
+    else:
+        result = db[source_col].aggregate(_aggregate_tags_pipeline(match, with_slug=with_slug),
+                                          allowDiskUse=True)
 
     for doc in result:
         if doc["_id"] in constants.TAGS_EXCLUDE_WORDS or doc["_id"].isdigit():
@@ -763,6 +1340,12 @@ def _aggregate_tags(db, source_col, target_col, add_match=None, max_bulk=20):
             update["$inc"]["count_datasets"] = doc['count']
         elif source_col == constants.COL_SERIES:
             update["$inc"]["count_series"] = doc['count']
+            '''seed counters by provider (see reconcile_tags_series)'''
+            providers_counts = Counter()
+            for p in doc.get("providers") or []:
+                providers_counts[p["provider_name"]] += p["count"]
+            for provider_name, provider_count in providers_counts.items():
+                update["$inc"]["count_series_providers.%s" % provider_name] = provider_count
 
         bulk.find({'name': doc['_id']}).upsert().update_one(update)
         count += 1
@@ -778,17 +1361,164 @@ def _aggregate_tags(db, source_col, target_col, add_match=None, max_bulk=20):
 
     return bulk_result_aggregate(bulk_result)
 
-def aggregate_tags_datasets(db, max_bulk=20):
+def aggregate_tags_datasets(db, max_bulk=20, partition_by=None, max_workers=None):
     return _aggregate_tags(db,
                            constants.COL_DATASETS,
                            constants.COL_TAGS,
                            #add_match={"enable": True, "provider_name": "INSEE", "dataset_code": {"$in": ["IPI-2010-A10", "IPI-2010-A17"]}},
-                           max_bulk=max_bulk)
+                           max_bulk=max_bulk,
+                           partition_by=partition_by,
+                           max_workers=max_workers)
 
-def aggregate_tags_series(db, max_bulk=20):
+def aggregate_tags_series(db, max_bulk=20, partition_by=None, max_workers=None):
     #FIXME: dataset enable !
     return _aggregate_tags(db,
                            constants.COL_SERIES,
                            constants.COL_TAGS,
                            #add_match={"provider_name": "INSEE", "dataset_code": {"$in": ["IPI-2010-A10", "IPI-2010-A17"]}},
-                           max_bulk=max_bulk)
+                           max_bulk=max_bulk,
+                           partition_by=partition_by,
+                           max_workers=max_workers)
+
+class TagsDelta(object):
+    """Added/removed tags of series of one provider
+
+    Applied with $inc to counters of tags collection:
+    count, count_series and count_series_providers.<provider_name>
+    """
+
+    def __init__(self, provider_name):
+        self.provider_name = provider_name
+        self.counts = Counter()
+        self.datasets = {}
+
+    def add(self, dataset_code, old_tags, new_tags):
+        old_tags = set(old_tags or [])
+        new_tags = set(new_tags or [])
+
+        for tag in new_tags - old_tags:
+            self.counts[tag] += 1
+            self.datasets.setdefault(tag, set()).add(dataset_code)
+
+        for tag in old_tags - new_tags:
+            self.counts[tag] -= 1
+
+    def __len__(self):
+        return len([n for n in self.counts.values() if n])
+
+    def requests(self):
+        provider_field = "count_series_providers.%s" % self.provider_name
+        for tag, count in self.counts.items():
+            if not count:
+                continue
+
+            update = {"$inc": {"count": count,
+                               "count_series": count,
+                               provider_field: count}}
+            if count > 0:
+                update["$set"] = {"enable": True}
+                update["$addToSet"] = {
+                    "provider_name": self.provider_name,
+                    "dataset_code": {"$each": sorted(self.datasets[tag])},
+                }
+
+            yield UpdateOne({"name": tag}, update, upsert=count > 0)
+
+    def apply(self, db, max_bulk=100):
+        """Write counters and reset delta"""
+        bulk_list = []
+        bulk_results = []
+
+        for request in self.requests():
+            bulk_list.append(request)
+            if len(bulk_list) >= max_bulk:
+                bulk_results.append(db[constants.COL_TAGS].bulk_write(bulk_list, ordered=False))
+                bulk_list = []
+
+        if bulk_list:
+            bulk_results.append(db[constants.COL_TAGS].bulk_write(bulk_list, ordered=False))
+
+        self.counts = Counter()
+        self.datasets = {}
+        return bulk_results
+
+def reconcile_tags_series(db, provider_name, max_bulk=100, batch_size=1000):
+    """Recompute exact counters of series tags for one provider
+
+    Series of provider are streamed (tags only) and
+    count_series_providers.<provider_name> is replaced by the exact count.
+    count_series and count are adjusted by the difference with the previous
+    counter of the provider - counts of other providers are kept.
+
+    Tags without counters by provider (aggregated before they were seeded
+    by aggregate_tags_series) are only seeded: their count_series already
+    include the series of the provider.
+    """
+
+    provider_field = "count_series_providers.%s" % provider_name
+
+    counts = Counter()
+    query = {"provider_name": provider_name, "tags.0": {"$exists": True}}
+    projection = {"_id": False, "tags": True}
+    cursor = db[constants.COL_SERIES].find(query, projection).batch_size(batch_size)
+    for doc in cursor:
+        counts.update(doc["tags"])
+
+    '''tags with old counter for this provider'''
+    old_tags = db[constants.COL_TAGS].find({provider_field: {"$exists": True}},
+                                           {"name": True}).distinct("name")
+
+    all_tags = sorted(set(counts.keys()) | set(old_tags))
+
+    bulk_list = []
+    bulk_results = []
+
+    for i in range(0, len(all_tags), batch_size):
+        names = all_tags[i:i + batch_size]
+        docs = {}
+        for doc in db[constants.COL_TAGS].find({"name": {"$in": names}},
+                                               {"name": True,
+                                                "count_series": True,
+                                                "count_series_providers": True}):
+            docs[doc["name"]] = doc
+
+        for name in names:
+            doc = docs.get(name) or {}
+            count = counts.get(name, 0)
+
+            update = {}
+            if doc.get("count_series") and not "count_series_providers" in doc:
+                '''not seeded: count of the provider unknown'''
+                diff = 0
+            else:
+                diff = count - (doc.get("count_series_providers") or {}).get(provider_name, 0)
+            if diff:
+                update["$inc"] = {"count_series": diff, "count": diff}
+
+            if count:
+                update["$set"] = {provider_field: count, "enable": True}
+                update["$addToSet"] = {"provider_name": provider_name}
+            else:
+                update["$unset"] = {provider_field: True}
+
+            bulk_list.append(UpdateOne({"name": name}, update, upsert=count > 0))
+
+            if len(bulk_list) >= max_bulk:
+                bulk_results.append(db[constants.COL_TAGS].bulk_write(bulk_list, ordered=False))
+                bulk_list = []
+
+    if bulk_list:
+        bulk_results.append(db[constants.COL_TAGS].bulk_write(bulk_list, ordered=False))
+
+    bulk_dict = {
+        "nUpserted": 0,
+        "nModified": 0,
+        "nMatched": 0,
+        "count_tags": len(all_tags),
+    }
+    for b in bulk_results:
+        bulk_dict["nUpserted"] += b.upserted_count
+        bulk_dict["nMatched"] += b.matched_count
+        bulk_dict["nModified"] += b.modified_count
+
+    return bulk_dict
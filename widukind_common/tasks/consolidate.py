@@ -3,8 +3,10 @@
 import logging
 import json
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pymongo
+from pymongo import UpdateOne
 
 from widukind_common import utils
 from widukind_common import constants
@@ -13,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 def _run_bulk(db, bulk_requests):
     try:
-        return bulk_requests.execute()
+        return db[constants.COL_DATASETS].bulk_write(bulk_requests, ordered=False)
     except pymongo.errors.BulkWriteError as err:
         logger.critical(str(err.details))
     except Exception as err:
@@ -22,7 +24,23 @@ def _run_bulk(db, bulk_requests):
 def hash_dict(d):
     return hashlib.sha1(json.dumps(d, sort_keys=True).encode()).hexdigest()
 
-def consolidate_all_dataset(provider_name=None, db=None, max_bulk=20):
+def _consolidate_dataset_task(provider_name, dataset_code, db, use_aggregate, skip_unchanged):
+    query, query_modify = consolidate_dataset(provider_name, dataset_code, db=db, execute=False,
+                                              use_aggregate=use_aggregate,
+                                              skip_unchanged=skip_unchanged)
+    return dataset_code, query, query_modify
+
+def consolidate_all_dataset(provider_name=None, db=None, max_bulk=20,
+                            max_workers=None, use_aggregate=False, skip_unchanged=False):
+    """Consolidate all datasets of a provider
+
+    max_workers: consolidate datasets in a thread pool. Updates are
+    collected and written by the calling thread in unordered bulks.
+    An error of a dataset is raised as without pool.
+
+    skip_unchanged: only consolidate datasets changed since last
+    consolidation (see consolidate_dataset).
+    """
 
     db = db or utils.get_mongo_db()
 
@@ -32,29 +50,39 @@ def consolidate_all_dataset(provider_name=None, db=None, max_bulk=20):
     cursor = db[constants.COL_DATASETS].find(query, projection)
     dataset_codes = [doc["dataset_code"] for doc in cursor]
 
-    bulk_requests = db[constants.COL_DATASETS].initialize_unordered_bulk_op()
-    bulk_size = 0
+    bulk_requests = []
     results = []
 
-    for dataset_code in dataset_codes:
+    if max_workers and max_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(_consolidate_dataset_task, provider_name, dataset_code, db,
+                                   use_aggregate, skip_unchanged)
+                   for dataset_code in dataset_codes]
+        consolidated = (future.result() for future in as_completed(futures))
+    else:
+        executor = None
+        consolidated = (_consolidate_dataset_task(provider_name, dataset_code, db, use_aggregate, skip_unchanged)
+                        for dataset_code in dataset_codes)
 
-        query, query_modify = consolidate_dataset(provider_name, dataset_code, db=db, execute=False)
+    try:
+        for dataset_code, query, query_modify in consolidated:
 
-        if not query:
-            logger.warning("bypass dataset [%s]" % dataset_code)
-            continue
+            if not query:
+                logger.warning("bypass dataset [%s]" % dataset_code)
+                continue
 
-        bulk_size += 1
-        bulk_requests.find(query).update_one(query_modify)
+            bulk_requests.append(UpdateOne(query, query_modify))
 
-        if bulk_size > max_bulk:
-            result = _run_bulk(db, bulk_requests)
-            if result:
-                results.append(result)
-            bulk_requests = db[constants.COL_DATASETS].initialize_unordered_bulk_op()
-            bulk_size = 0
+            if len(bulk_requests) > max_bulk:
+                result = _run_bulk(db, bulk_requests)
+                if result:
+                    results.append(result)
+                bulk_requests = []
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
 
-    if bulk_size > 0:
+    if bulk_requests:
         result = _run_bulk(db, bulk_requests)
         if result:
             results.append(result)
@@ -64,22 +92,233 @@ def consolidate_all_dataset(provider_name=None, db=None, max_bulk=20):
         "modified_count": 0,
     }
     for r in results:
-        results_details["matched_count"] += r["nMatched"]
-        results_details["modified_count"] += r["nModified"]
+        results_details["matched_count"] += r.matched_count
+        results_details["modified_count"] += r.modified_count
 
     return results_details
 
-def consolidate_dataset(provider_name=None, dataset_code=None, db=None, execute=True):
+class ConsolidateAccumulator(object):
+    """Collect distinct codes from series documents fed incrementally
+
+    >>> accumulator = ConsolidateAccumulator(dataset)
+    >>> for series in cursor:
+    ...     accumulator.add(series)
+    >>> accumulator.query_modify()
+
+    Observations attributes are only collected for the keys of the dataset
+    codelists and until all codes of the codelist have been seen. For packed
+    series (utils.series_pack), they are read from values_packed.obs.
+    """
+
+    def __init__(self, dataset):
+        self.old_codelists = dataset.get("codelists") or {}
+        self.old_concepts = dataset.get("concepts") or {}
+        self.old_dimension_keys = dataset.get("dimension_keys") or []
+        self.old_attribute_keys = dataset.get("attribute_keys") or []
+
+        self.codelists = {}
+        self.count_series = 0
+        self._obs_remaining = {k: set(values) for k, values in self.old_codelists.items()}
+
+    def _add_codes(self, codes):
+        codelists = self.codelists
+        for k, v in codes.items():
+            if k in codelists:
+                codelists[k].add(v)
+            else:
+                codelists[k] = {v}
+
+    def add(self, series):
+        self.count_series += 1
+
+        self._add_codes(series.get("dimensions"))
+
+        if series.get("attributes"):
+            self._add_codes(series.get("attributes"))
+
+        remaining = self._obs_remaining
+        if not remaining:
+            return
+
+        observations = series.get("values")
+        if observations is None and series.get(utils.VALUES_PACKED):
+            observations = (series[utils.VALUES_PACKED].get("obs") or {}).values()
+
+        codelists = self.codelists
+        for v in observations or []:
+            attributes = v.get("attributes")
+            if not attributes:
+                continue
+            for k1, v1 in attributes.items():
+                if not k1 in remaining: continue
+                if k1 in codelists:
+                    codelists[k1].add(v1)
+                else:
+                    codelists[k1] = {v1}
+                remaining[k1].discard(v1)
+                if not remaining[k1]:
+                    '''all codes of this codelist are used'''
+                    del remaining[k1]
+            if not remaining:
+                break
+
+    def update(self, codelists):
+        """Merge distinct codes computed elsewhere (aggregation)"""
+        for k, codes in codelists.items():
+            self.codelists.setdefault(k, set()).update(codes)
+
+    def query_modify(self):
+        """Return the $set update for the dataset or None if not changed"""
+        old_codelists = self.old_codelists
+        old_concepts = self.old_concepts
+        old_dimension_keys = self.old_dimension_keys
+        old_attribute_keys = self.old_attribute_keys
+        codelists = self.codelists
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for k, v in old_codelists.items():
+                logger.debug("BEFORE - codelist[%s]: %s" % (k, len(v)))
+            logger.debug("BEFORE - concepts[%s]" % list(old_concepts.keys()))
+            logger.debug("BEFORE - dimension_keys[%s]" % old_dimension_keys)
+            logger.debug("BEFORE - attribute_keys[%s]" % old_attribute_keys)
+
+        new_codelists = {}
+        new_concepts = {}
+
+        for k, values in old_codelists.items():
+            '''if entry in codelists from series'''
+            if k in codelists:
+                codes = codelists[k]
+                '''codelist values from dataset used by series (dataset order)'''
+                new_codelists[k] = {v1: label for v1, label in values.items() if v1 in codes}
+                new_concepts[k] = old_concepts.get(k)
+
+        '''original ordered for dimension_keys'''
+        dimension_keys = [k for k in old_dimension_keys if k in new_codelists]
+        '''original ordered for attribute_keys'''
+        attribute_keys = [k for k in old_attribute_keys if k in new_codelists and not k in old_dimension_keys]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for k, v in new_codelists.items():
+                logger.debug("AFTER - codelist[%s]: %s" % (k, len(v)))
+            logger.debug("AFTER - concepts[%s]" % list(new_concepts.keys()))
+            logger.debug("AFTER - dimension_keys[%s]" % dimension_keys)
+            logger.debug("AFTER - attribute_keys[%s]" % attribute_keys)
+
+        '''verify change in codelists and concepts'''
+        if new_codelists == old_codelists and new_concepts == old_concepts:
+            return None
+
+        return {"$set": {
+            "codelists": new_codelists or None,
+            "concepts": new_concepts or None,
+            "dimension_keys": dimension_keys or None,
+            "attribute_keys": attribute_keys or None,
+        }}
+
+def _series_codelists(cursor, old_codelists):
+    """Distinct codes of dimensions, attributes and observations attributes
+    from series documents (client side)
+    """
+    accumulator = ConsolidateAccumulator({"codelists": old_codelists})
+    for series in cursor:
+        accumulator.add(series)
+    return accumulator.codelists
+
+def _series_codelists_pipelines(query, old_codelists):
+    """Aggregation pipelines for distinct codes - require MongoDB >= 3.4.4"""
+
+    pipelines = [[
+        {"$match": query},
+        {"$project": {"_id": False, "codes": {"$concatArrays": [
+            {"$objectToArray": {"$ifNull": ["$dimensions", {}]}},
+            {"$objectToArray": {"$ifNull": ["$attributes", {}]}},
+        ]}}},
+        {"$unwind": "$codes"},
+        {"$group": {"_id": "$codes.k", "codes": {"$addToSet": "$codes.v"}}},
+    ]]
+
+    if old_codelists:
+        '''observations attributes: only keys present in dataset codelists'''
+        pipelines.append([
+            {"$match": query},
+            {"$project": {"_id": False, "values.attributes": True}},
+            {"$unwind": "$values"},
+            {"$match": {"values.attributes": {"$type": "object"}}},
+            {"$project": {"codes": {"$objectToArray": "$values.attributes"}}},
+            {"$unwind": "$codes"},
+            {"$match": {"codes.k": {"$in": list(old_codelists.keys())}}},
+            {"$group": {"_id": "$codes.k", "codes": {"$addToSet": "$codes.v"}}},
+        ])
+        '''packed series: observations fields in values_packed.obs'''
+        pipelines.append([
+            {"$match": {"$and": [query, {"values_packed.obs": {"$type": "object"}}]}},
+            {"$project": {"_id": False, "obs": {"$objectToArray": "$values_packed.obs"}}},
+            {"$unwind": "$obs"},
+            {"$match": {"obs.v.attributes": {"$type": "object"}}},
+            {"$project": {"codes": {"$objectToArray": "$obs.v.attributes"}}},
+            {"$unwind": "$codes"},
+            {"$match": {"codes.k": {"$in": list(old_codelists.keys())}}},
+            {"$group": {"_id": "$codes.k", "codes": {"$addToSet": "$codes.v"}}},
+        ])
+
+    return pipelines
+
+def _series_codelists_aggregate(db, query, old_codelists):
+    """Distinct codes computed by MongoDB - only distinct sets are returned"""
+    codelists = {}
+    for pipeline in _series_codelists_pipelines(query, old_codelists):
+        for doc in db[constants.COL_SERIES].aggregate(pipeline, allowDiskUse=True):
+            codelists.setdefault(doc["_id"], set()).update(doc["codes"])
+    return codelists
+
+def dataset_hash(codelists, concepts):
+    """Fingerprint of dataset codelists and concepts"""
+    return hash_dict({"codelists": codelists or None, "concepts": concepts or None})
+
+def consolidate_state(db, dataset, series_query):
+    """Series and dataset state used to detect changes since last consolidation"""
+    last_series = db[constants.COL_SERIES].find_one(series_query, {"_id": True},
+                                                    sort=[("_id", pymongo.DESCENDING)])
+    return {
+        "series_count": db[constants.COL_SERIES].count_documents(series_query),
+        "max_id": last_series and last_series["_id"],
+        "last_update": dataset.get("last_update"),
+        "hash": dataset_hash(dataset.get("codelists"), dataset.get("concepts")),
+    }
+
+def is_consolidated(dataset, state):
+    """Return True if series and dataset codelists/concepts not changed since
+    last consolidation of the dataset"""
+    previous = dataset.get("consolidate")
+    if not previous:
+        return False
+    for field in ["series_count", "max_id", "last_update", "hash"]:
+        if previous.get(field) != state[field]:
+            return False
+    return True
+
+def consolidate_dataset(provider_name=None, dataset_code=None, db=None, execute=True,
+                        use_aggregate=False, skip_unchanged=False):
+    """Remove from dataset codelists and concepts the entries not used by series
+
+    use_aggregate: compute distinct codes with an aggregation on the server
+    (MongoDB >= 3.4.4) instead of loading all series.
+
+    skip_unchanged: record a consolidation state in the dataset (consolidate
+    field) and bypass the dataset if series count, last series _id, dataset
+    last_update and the hash of codelists/concepts written by the
+    consolidation are unchanged.
+    """
     db = db or utils.get_mongo_db()
 
     logger.info("START consolidate provider[%s] - dataset[%s]" % (provider_name, dataset_code))
 
     query = {"provider_name": provider_name, "dataset_code": dataset_code}
-    projection = {"_id": False, "dimensions": True, "attributes": True, "values.attributes": True}
+    series_query = dict(query)
 
-    cursor = db[constants.COL_SERIES].find(query, projection)
-
-    projection = {"_id": True, "concepts": True, "codelists": True, "dimension_keys": True, "attribute_keys": True}
+    projection = {"_id": True, "concepts": True, "codelists": True, "dimension_keys": True, "attribute_keys": True,
+                  "last_update": True, "consolidate": True}
     dataset = db[constants.COL_DATASETS].find_one(query, projection)
     if dataset is None:
         if execute:
@@ -87,95 +326,43 @@ def consolidate_dataset(provider_name=None, dataset_code=None, db=None, execute=
         else:
             return None, None
 
-    old_codelists = dataset.get("codelists") or {}
-    old_concepts = dataset.get("concepts") or {}
-    old_dimension_keys = dataset.get("dimension_keys") or []
-    old_attribute_keys = dataset.get("attribute_keys") or []
-
-    codelists = {}
+    state = None
+    if skip_unchanged:
+        state = consolidate_state(db, dataset, series_query)
+        if is_consolidated(dataset, state):
+            logger.info("unchanged since last consolidate provider[%s] - dataset[%s]" % (provider_name, dataset_code))
+            if execute:
+                return None
+            else:
+                return None, None
 
-    for series in cursor:
-        for k, v in series.get("dimensions").items():
-            if not k in codelists: codelists[k] = []
-            if not v in codelists[k]: codelists[k].append(v)
+    accumulator = ConsolidateAccumulator(dataset)
 
-        if series.get("attributes"):
-            for k, v in series.get("attributes").items():
-                if not k in codelists: codelists[k] = []
-                if not v in codelists[k]: codelists[k].append(v)
-
-        for v in series.get("values"):
-            if v.get("attributes"):
-                for k1, v1 in v.get("attributes").items():
-                    if not k1 in old_codelists: continue
-                    if not k1 in codelists: codelists[k1] = []
-                    if not v1 in codelists[k1]: codelists[k1].append(v1)
-
-    if logger.isEnabledFor(logging.DEBUG):
-        for k, v in old_codelists.items():
-            logger.debug("BEFORE - codelist[%s]: %s" % (k, len(v)))
-        logger.debug("BEFORE - concepts[%s]" % list(old_concepts.keys()))
-        logger.debug("BEFORE - dimension_keys[%s]" % old_dimension_keys)
-        logger.debug("BEFORE - attribute_keys[%s]" % old_attribute_keys)
-
-    new_codelists = {}
-    new_concepts = {}
-    new_dimension_keys = []
-    new_attribute_keys = []
-
-    for k, values in old_codelists.items():
-        '''if entry in codelists from series'''
-        if k in codelists:
-            new_values = {}
-            for v1 in codelists[k]:
-                '''if codelist value in codelists from dataset'''
-                if v1 in values:
-                    new_values[v1] = values[v1]
-
-            new_codelists[k] = new_values
-            new_concepts[k] = old_concepts.get(k)
-
-            if k in old_dimension_keys:
-                '''unordered dimension_keys'''
-                new_dimension_keys.append(k)
-            elif k in old_attribute_keys:
-                '''unordered attribute_keys'''
-                new_attribute_keys.append(k)
-
-    '''original ordered for dimension_keys'''
-    dimension_keys = [k for k in old_dimension_keys if k in new_dimension_keys]
-    '''original ordered for attribute_keys'''
-    attribute_keys = [k for k in old_attribute_keys if k in new_attribute_keys]
-
-    if logger.isEnabledFor(logging.DEBUG):
-        for k, v in new_codelists.items():
-            logger.debug("AFTER - codelist[%s]: %s" % (k, len(v)))
-        logger.debug("AFTER - concepts[%s]" % list(new_concepts.keys()))
-        logger.debug("AFTER - dimension_keys[%s]" % dimension_keys)
-        logger.debug("AFTER - attribute_keys[%s]" % attribute_keys)
-
-    '''verify change in codelists'''
-    #is_modify = hash_dict(new_codelists) == hash_dict(old_codelists)
-    is_modify = new_codelists != old_codelists
-
-    '''verify change in concepts'''
-    #if not is_modify and hash_dict(new_concepts) != hash_dict(old_concepts):
-    if is_modify is False and new_concepts != old_concepts:
-        is_modify = True
-
-    if is_modify is False:
+    if use_aggregate:
+        accumulator.update(_series_codelists_aggregate(db, series_query, accumulator.old_codelists))
+    else:
+        projection = {"_id": False, "dimensions": True, "attributes": True, "values.attributes": True,
+                      "values_packed.obs": True}
+        for series in db[constants.COL_SERIES].find(series_query, projection):
+            accumulator.add(series)
+
+    query_modify = accumulator.query_modify()
+
+    if state:
+        if query_modify:
+            state["hash"] = dataset_hash(query_modify["$set"]["codelists"],
+                                         query_modify["$set"]["concepts"])
+        state["created"] = utils.utcnow()
+        query_modify = query_modify or {"$set": {}}
+        query_modify["$set"]["consolidate"] = state
+
+    if query_modify is None:
         if execute:
             return None
         else:
             return None, None
 
     query = {"_id": dataset["_id"]}
-    query_modify = {"$set": {
-        "codelists": new_codelists or None,
-        "concepts": new_concepts or None,
-        "dimension_keys": dimension_keys or None,
-        "attribute_keys": attribute_keys or None,
-    }}
 
     if execute:
         return db[constants.COL_DATASETS].update_one(query, query_modify).modified_count
@@ -1,18 +1,35 @@
 # -*- coding: utf-8 -*-
 
-import tempfile
+import io
+import itertools
+import hashlib
+import zlib
 import time
 import logging
 import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy
 import pandas
 import gridfs
+from pymongo import DESCENDING
 
-from widukind_common.utils import get_mongo_db
+try:
+    import pyarrow
+    import pyarrow.parquet
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+from widukind_common.utils import get_mongo_db, series_date_bounds
+from widukind_common import utils
 from widukind_common import constants
 
 logger = logging.getLogger(__name__)
 
+FS_FILES = "fs.files"
+FS_CHUNKS = "fs.chunks"
+
 def generate_filename(provider_name=None, dataset_code=None, key=None, 
                       slug=None, prefix=None):
     """Generate filename for file (csv, pdf, ...)
@@ -33,122 +50,383 @@ def export_series(series):
     """Export one serie (Period and Frequency only)
     """
     #series = dict (doc mongo)
+    if utils.VALUES_PACKED in series:
+        series = utils.series_unpack(dict(series))
     values = []
     values.append(["Period", "Value"])
     for val in series['values']:
         values.append([val["period"], val["value"]])
     return values
 
-def export_dataset(db, dataset):
-    """Export all series for one Dataset
+def dataset_date_bounds(db, dataset):
+    """Return first and last period ordinals of series by frequency
     
-    Return array - one line by serie    
+    >>> dataset_date_bounds(db, dataset)
+    {'A': {'start_date': 25, 'end_date': 44, 'count': 2}}
     """
-    #TODO: Utiliser une queue Redis car trop de code en RAM ?
+    query = {'provider_name': dataset['provider_name'], 
+             "dataset_code": dataset['dataset_code']}
+    return series_date_bounds(db, query)
+
+EXPORT_SERIES_PROJECTION = {
+    "_id": False,
+    "key": True,
+    "frequency": True,
+    "dimensions": True,
+    "start_date": True,
+    "end_date": True,
+    "values.value": True,
+    "values_packed.data": True,
+    "values_packed.raw": True,
+}
+
+def export_row(s, dimension_keys, dmin, dmax):
+    """One line of dataset export - series values aligned on dmin...dmax
     
-    start = time.time()
+    start_date/end_date/dmin/dmax are period ordinals of the same frequency:
+    count of empty cells is a difference of ordinals.
+    """
+    row = [s['key']]
+    
+    dimensions = s['dimensions']
+    for c in dimension_keys:
+        row.append(dimensions.get(c, ''))
+    
+    # Les None sont pour les périodes qui n'ont pas de valeur correspondantes
+    if s['start_date'] > dmin:
+        row.extend([None] * (s['start_date'] - dmin))
+    
+    if utils.VALUES_PACKED in s:
+        row.extend(utils.series_values_strings(s[utils.VALUES_PACKED]))
+    else:
+        row.extend([val["value"] for val in s['values']])
+
+    if dmax > s['end_date']:
+        row.extend([None] * (dmax - s['end_date']))
     
+    return row
+
+def period_headers(freq, dmin, dmax):
+    pDmin = pandas.Period(ordinal=dmin, freq=freq)
+    pDmax = pandas.Period(ordinal=dmax, freq=freq)
+    return [str(p) for p in pandas.period_range(pDmin, pDmax, freq=freq)]
+
+def export_headers(dataset, freq, dmin, dmax):
     headers = ['key'] + dataset['dimension_keys']
     #['key', 'freq', 'geo', 'na_item', 'nace_r2', 'unit']
+    headers += period_headers(freq, dmin, dmax)
+    #['key', 'freq', 'geo', 'na_item', 'nace_r2', 'unit', '1995', '1996', '1997', '1998', '1999', '2000', '2001', '2002', '2003', '2004', '2005', '2006', '2007', '2008', '2009', '2010', '2011', '2012', '2013', '2014']
+    return headers
+
+def iter_export_dataset_by_frequency(db, dataset, bounds=None, frequencies=None):
+    """Export all series for one Dataset grouped by frequency
     
-    # revient à 0 et -1 ?
-    dmin = float('inf')
-    dmax = -float('inf')
+    Generator - yield (frequency, line): headers of each frequency first,
+    then one line by serie in a single pass on series.
+    """
+    start = time.time()
+
+    '''first and last dates of all series by frequency (server side)'''
+    if bounds is None:
+        bounds = dataset_date_bounds(db, dataset)
 
     query = {'provider_name': dataset['provider_name'], 
              "dataset_code": dataset['dataset_code']}
-    series_list = db[constants.COL_SERIES].find(query)
-    
-    for s in series_list:
-        #collect la première et dernière date trouvé
-        """
-        Permet d'avoir ensuite une plage de date la plus ancienne à la plus récente
-        car chaque série n'a pas toujours les mêmes dates
-        """
-        if s['start_date'] < dmin:
-            dmin = s['start_date']
-        if s['end_date'] > dmax:
-            dmax = s['end_date']
+
+    if frequencies:
+        bounds = {freq: b for freq, b in bounds.items() if freq in frequencies}
+        query["frequency"] = {"$in": list(frequencies)}
+
+    if not bounds:
+        return
+
+    for freq in sorted(bounds.keys()):
+        yield freq, export_headers(dataset, freq, bounds[freq]["start_date"], bounds[freq]["end_date"])
+
+    dimension_keys = dataset['dimension_keys']
+    count = 0
+    for s in db[constants.COL_SERIES].find(query, EXPORT_SERIES_PROJECTION):
         freq = s['frequency']
-        
-    series_list.rewind()
+        if not freq in bounds:
+            '''series added after bounds computation'''
+            continue
+        count += 1
+        yield freq, export_row(s, dimension_keys, bounds[freq]["start_date"], bounds[freq]["end_date"])
 
-    pDmin = pandas.Period(ordinal=dmin, freq=freq);
-    pDmax = pandas.Period(ordinal=dmax, freq=freq);
-    headers += list(pandas.period_range(pDmin, pDmax, freq=freq).to_native_types())
-    #['key', 'freq', 'geo', 'na_item', 'nace_r2', 'unit', '1995', '1996', '1997', '1998', '1999', '2000', '2001', '2002', '2003', '2004', '2005', '2006', '2007', '2008', '2009', '2010', '2011', '2012', '2013', '2014']
+    end = time.time() - start
+    logger.info("export_dataset - %s - series[%s] : %.3f" % (dataset['dataset_code'], count, end))
 
-    elements = [headers]
+def iter_export_dataset(db, dataset, frequency=None):
+    """Export all series for one Dataset
     
-    series_list.rewind()
+    Generator - yield headers and one line by serie
     
-    def row_process(s):
-        row = [s['key']]
-        
-        for c in dataset['dimension_keys']:
-            if c in s['dimensions']:
-                row.append(s['dimensions'][c])
-            else:
-                row.append('')        
-        
-        p_start_date = pandas.Period(ordinal=s['start_date'], freq=freq)        
-        p_end_date = pandas.Period(ordinal=s['end_date'], freq=freq)
-        
-        """
-        pDmin : pandas.Period() la plus ancienne
-        p_start_date-1 : périod en cours -1
-            >>> p_start_date -1
-            Period('1994', 'A-DEC')
-            Bug: ne renvoi rien si
-                p_start_date -1 devient identique à pDmin
-        """
-
-        # Les None sont pour les périodes qui n'ont pas de valeur correspondantes
-        _row = [None for d in pandas.period_range(pDmin, p_start_date-1, freq=freq)]
-        row.extend(_row)
-        
-        _row = [val["value"] for val in s['values']]
-        row.extend(_row)
+    Only series of frequency are exported. frequency is required if the
+    dataset has several frequencies (ValueError) - see
+    iter_export_dataset_by_frequency for mixed datasets.
+    """
+    bounds = dataset_date_bounds(db, dataset)
+    if not bounds:
+        yield ['key'] + dataset['dimension_keys']
+        return
 
-        _row = [None for d in pandas.period_range(p_end_date+1, pDmax, freq=freq)]
-        row.extend(_row)
-        
-        return row
-    
-    for s in series_list:
-        elements.append(row_process(s))
+    frequencies = None
+    if frequency:
+        frequencies = [frequency]
+    elif len(bounds) > 1:
+        '''periods of other frequencies can not be aligned on the same columns'''
+        raise ValueError("export_dataset - %s - multiple frequencies %s - frequency is required" % (dataset['dataset_code'],
+                                                                                                  sorted(bounds.keys())))
+
+    for freq, row in iter_export_dataset_by_frequency(db, dataset, bounds=bounds, 
+                                                      frequencies=frequencies):
+        yield row
+
+EXPORT_SERIES_BULK_HEADERS = ["slug", "provider_name", "dataset_code", "key"]
+
+def series_bulk_query(slugs=None, query=None):
+    """Query for series in list of slugs and/or matching query (tags, dimensions...)"""
+    if not slugs and not query:
+        raise ValueError("slugs or query is required")
+    conditions = []
+    if slugs:
+        conditions.append({"slug": {"$in": list(slugs)}})
+    if query:
+        conditions.append(query)
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+def iter_export_series_bulk(db, slugs=None, query=None, batch_size=500, bounds=None):
+    """Export many series aligned on a common period index by frequency
     
+    Generator - yield (frequency, line): headers of each frequency first,
+    then one line by serie from a single cursor read by batch_size.
+    """
+    start = time.time()
+    query = series_bulk_query(slugs=slugs, query=query)
+
+    if bounds is None:
+        bounds = series_date_bounds(db, query)
+
+    for freq in sorted(bounds.keys()):
+        yield freq, EXPORT_SERIES_BULK_HEADERS + period_headers(freq, bounds[freq]["start_date"], 
+                                                                bounds[freq]["end_date"])
+
+    projection = dict(EXPORT_SERIES_PROJECTION, slug=True, provider_name=True, dataset_code=True)
+    cursor = db[constants.COL_SERIES].find(query, projection).batch_size(batch_size)
+    count = 0
+    for s in cursor:
+        freq = s['frequency']
+        if not freq in bounds:
+            continue
+        count += 1
+        row = [s["slug"], s["provider_name"], s["dataset_code"]]
+        row += export_row(s, [], bounds[freq]["start_date"], bounds[freq]["end_date"])
+        yield freq, row
+
     end = time.time() - start
-    logger.info("export_dataset - %s : %.3f" % (dataset['dataset_code'], end))
+    logger.info("export_series_bulk - series[%s] : %.3f" % (count, end))
+
+
+def export_dataset(db, dataset, frequency=None):
+    """Export all series for one Dataset
     
-    return elements
+    Return array - one line by serie (see iter_export_dataset)
+    """
+    return list(iter_export_dataset(db, dataset, frequency=frequency))
 
+CSV_BUFFER_SIZE = 256 * 1024
 
-def record_csv_file(db, values, 
-                    provider_name=None, dataset_code=None, key=None, 
-                    slug=None, prefix=None):
-    """record gridfs and return mongo id of gridfs entry
+class BufferedCSVWriter(object):
+    """CSV writer to file-like object (GridIn) by blocks of buffer_size characters
     """
+    extension = "csv"
+    content_type = "text/csv"
+    encoding = "utf8"
+
+    def __init__(self, fp, buffer_size=CSV_BUFFER_SIZE):
+        self.fp = fp
+        self.buffer_size = buffer_size
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        self.count = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.count += 1
+        if self.buf.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf.tell():
+            self.fp.write(self.buf.getvalue())
+            self.buf.seek(0)
+            self.buf.truncate()
+
+    def close(self):
+        self.flush()
+
+def _float_column(values):
+    """Return float64 array (None and "" as NaN) or None if a value is not a number"""
+    try:
+        return numpy.array([numpy.nan if v is None or v == "" else v for v in values], 
+                           dtype="float64")
+    except (TypeError, ValueError):
+        return None
+
+class ColumnarExportWriter(object):
+    """Base of columnar writers - first row is headers
     
-    fs = gridfs.GridFS(db)
+    Rows are collected and written in fp by close() of subclasses. The
+    label_columns first columns (key, dimensions...) are always strings,
+    next columns with only numbers are float64.
+    
+    All rows of the file are kept in memory until close() (about
+    series x periods values, plus the columns copy): use csv for the
+    largest datasets.
+    """
+    extension = None
+    content_type = "application/octet-stream"
+    encoding = None
+
+    def __init__(self, fp, label_columns=1):
+        self.fp = fp
+        self.label_columns = label_columns
+        self.headers = None
+        self.rows = []
+        self.count = 0
+
+    def writerow(self, row):
+        self.count += 1
+        if self.headers is None:
+            self.headers = [str(h) for h in row]
+        else:
+            self.rows.append(row)
+
+    def columns(self):
+        """Yield (name, float64 array or list of str)"""
+        transposed = list(itertools.zip_longest(*self.rows))
+        for i, name in enumerate(self.headers or []):
+            values = transposed[i] if i < len(transposed) else [None] * len(self.rows)
+            data = _float_column(values) if i >= self.label_columns else None
+            if data is None:
+                data = [None if v is None else str(v) for v in values]
+            yield name, data
 
-    tmp_filepath = tempfile.mkstemp(suffix=".csv", 
-                                    prefix='widukind_%s' % prefix, 
-                                    text=True)[1]
+class NPZExportWriter(ColumnarExportWriter):
+    """NumPy compressed archive - no pickle
     
-    #TODO: utf8 ?
-    #TODO: headers
-    with open(tmp_filepath, 'w', newline='', encoding='utf8') as fp:
-        writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-        for v in values:
-            writer.writerow(v)
+    columns: names of columns - c0...cN: columns data
+    """
+    extension = "npz"
+    content_type = "application/x-npz"
 
-    filename = "%s.csv" % generate_filename(provider_name=provider_name, 
-                                            dataset_code=dataset_code, 
-                                            key=key,
-                                            slug=slug, 
-                                            prefix=prefix)
+    def close(self):
+        arrays = {}
+        names = []
+        for i, (name, data) in enumerate(self.columns()):
+            names.append(name)
+            if not isinstance(data, numpy.ndarray):
+                data = numpy.array(["" if v is None else v for v in data], dtype=str)
+            arrays["c%s" % i] = data
+        buf = io.BytesIO()
+        numpy.savez_compressed(buf, columns=numpy.array(names, dtype=str), **arrays)
+        self.fp.write(buf.getvalue())
+
+def read_npz_export(fp):
+    """Return list of (name, array) from a NPZExportWriter file"""
+    with numpy.load(fp, allow_pickle=False) as data:
+        return [(str(name), data["c%s" % i]) for i, name in enumerate(data["columns"])]
 
+EXPORT_WRITERS = {
+    "csv": BufferedCSVWriter,
+    "npz": NPZExportWriter,
+}
+
+if HAVE_PYARROW:
+
+    class ParquetExportWriter(ColumnarExportWriter):
+        """Parquet file (snappy) - require pyarrow"""
+        extension = "parquet"
+        content_type = "application/x-parquet"
+
+        def close(self):
+            table = pyarrow.table({name: pyarrow.array(data, type=pyarrow.float64()
+                                                             if isinstance(data, numpy.ndarray)
+                                                             else pyarrow.string())
+                                   for name, data in self.columns()})
+            sink = pyarrow.BufferOutputStream()
+            pyarrow.parquet.write_table(table, sink, compression="snappy")
+            self.fp.write(sink.getvalue().to_pybytes())
+
+    EXPORT_WRITERS["parquet"] = ParquetExportWriter
+
+def get_export_writer(export_format):
+    if not export_format in EXPORT_WRITERS:
+        raise ValueError("export format not available [%s] - choices: %s" % (export_format,
+                                                                              sorted(EXPORT_WRITERS.keys())))
+    return EXPORT_WRITERS[export_format]
+
+def _new_writer(writer_class, fp, label_columns):
+    if issubclass(writer_class, ColumnarExportWriter):
+        return writer_class(fp, label_columns=label_columns)
+    return writer_class(fp)
+
+def write_csv(fp, values, buffer_size=CSV_BUFFER_SIZE):
+    """Write rows in file-like object (GridIn) by blocks of buffer_size characters
+    
+    Return count of rows
+    """
+    writer = BufferedCSVWriter(fp, buffer_size=buffer_size)
+    for v in values:
+        writer.writerow(v)
+    writer.close()
+    return writer.count
+
+class GridFSBufferedWriter(object):
+    """Write to GridIn by whole chunks of bytes - optional gzip compression
+    
+    Accept str (encoded) or bytes - close() must be called before
+    grid_in.close()
+    """
+
+    def __init__(self, grid_in, compress=False, encoding="utf8", compresslevel=6):
+        self.grid_in = grid_in
+        self.chunk_size = grid_in.chunk_size
+        self.encoding = encoding
+        self.buf = bytearray()
+        self.size = 0
+        self.compressor = None
+        if compress:
+            '''wbits=31: gzip header and trailer'''
+            self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode(self.encoding)
+        self.size += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self._write_chunks(data)
+
+    def _write_chunks(self, data):
+        self.buf += data
+        if len(self.buf) >= self.chunk_size:
+            end = len(self.buf) - len(self.buf) % self.chunk_size
+            self.grid_in.write(bytes(self.buf[:end]))
+            del self.buf[:end]
+
+    def close(self):
+        if self.compressor:
+            self._write_chunks(self.compressor.flush())
+            self.compressor = None
+        if self.buf:
+            self.grid_in.write(bytes(self.buf))
+            self.buf = bytearray()
+
+def _new_export_file(fs, filename, writer_class, prefix=None, provider_name=None, 
+                     dataset_code=None, key=None, slug=None, compress=False, **extra_metadata):
     metadata = {
         "doc_type": prefix,
         'provider_name': provider_name,
@@ -157,27 +435,229 @@ def record_csv_file(db, values,
     }
     if key: 
         metadata['key'] = key
+    metadata.update(extra_metadata)
+    if compress:
+        filename = "%s.gz" % filename
+        metadata["contentEncoding"] = "gzip"
+
+    kwargs = {}
+    if writer_class.encoding:
+        kwargs["encoding"] = writer_class.encoding
 
-    grid_in = fs.new_file(filename=filename, 
-                          contentType="text/csv", 
-                          metadata=metadata,
-                          encoding='utf8')
+    return fs.new_file(filename=filename, 
+                       contentType=writer_class.content_type, 
+                       metadata=metadata,
+                       **kwargs)
+
+def record_export_file(db, values, export_format="csv",
+                       provider_name=None, dataset_code=None, key=None, 
+                       slug=None, prefix=None, metadata=None, compress=False,
+                       label_columns=1):
+    """record gridfs and return mongo id of gridfs entry
+    
+    values: list or iterator of rows - written without temporary file
+    export_format: key of EXPORT_WRITERS
+    metadata: dict of extra metadata
+    compress: gzip content (metadata.contentEncoding)
+    label_columns: count of first columns never converted to numbers
+    (columnar formats)
+    """
+    writer_class = get_export_writer(export_format)
     
-    with open(tmp_filepath, 'r') as fp:
-        rows = iter(fp)
-        for row in rows:
-            grid_in.write(row)
+    fs = gridfs.GridFS(db)
+
+    filename = "%s.%s" % (generate_filename(provider_name=provider_name, 
+                                            dataset_code=dataset_code, 
+                                            key=key,
+                                            slug=slug, 
+                                            prefix=prefix), 
+                          writer_class.extension)
+
+    grid_in = _new_export_file(fs, filename, writer_class, prefix=prefix, 
+                               provider_name=provider_name, dataset_code=dataset_code,
+                               key=key, slug=slug, format=export_format, 
+                               compress=compress, **(metadata or {}))
+    
+    try:
+        fp = GridFSBufferedWriter(grid_in, compress=compress)
+        writer = _new_writer(writer_class, fp, label_columns)
+        for v in values:
+            writer.writerow(v)
+        writer.close()
+        fp.close()
+    except Exception:
+        grid_in.abort()
+        raise
         
     grid_in.close()
     return grid_in._id
 
-def export_file_csv_series_unit(doc=None, 
-                                provider=None, dataset_code=None, key=None, 
-                                slug=None):
-    """Create CSV File from one series and record in MongoDB GridFS
+def record_csv_file(db, values, 
+                    provider_name=None, dataset_code=None, key=None, 
+                    slug=None, prefix=None):
+    """record gridfs and return mongo id of gridfs entry
+    """
+    return record_export_file(db, values, export_format="csv",
+                              provider_name=provider_name, dataset_code=dataset_code, 
+                              key=key, slug=slug, prefix=prefix)
+
+def record_export_files_by_frequency(db, values, export_format="csv", 
+                                     provider_name=None, dataset_code=None, 
+                                     slug=None, prefix=None, metadata=None, compress=False,
+                                     label_columns=1):
+    """record one gridfs entry by frequency and return dict of mongo id by frequency
+    
+    values: iterator of (frequency, row) - see iter_export_dataset_by_frequency
+    label_columns: see record_export_file
+    """
+    writer_class = get_export_writer(export_format)
+    fs = gridfs.GridFS(db)
+    filename = generate_filename(provider_name=provider_name, 
+                                 dataset_code=dataset_code, 
+                                 slug=slug, 
+                                 prefix=prefix)
+    files = {}
+    buffers = {}
+    writers = {}
+
+    try:
+        for freq, row in values:
+            if not freq in writers:
+                files[freq] = _new_export_file(fs, "%s-%s.%s" % (filename, freq.lower(), 
+                                                                 writer_class.extension),
+                                               writer_class,
+                                               prefix=prefix, provider_name=provider_name, 
+                                               dataset_code=dataset_code, slug=slug, 
+                                               format=export_format, frequency=freq,
+                                               compress=compress, **(metadata or {}))
+                buffers[freq] = GridFSBufferedWriter(files[freq], compress=compress)
+                writers[freq] = _new_writer(writer_class, buffers[freq], label_columns)
+            writers[freq].writerow(row)
+
+        for freq, writer in writers.items():
+            writer.close()
+            buffers[freq].close()
+    except Exception:
+        for grid_in in files.values():
+            grid_in.abort()
+        raise
+
+    for grid_in in files.values():
+        grid_in.close()
+
+    return {freq: grid_in._id for freq, grid_in in files.items()}
+
+def record_csv_files_by_frequency(db, values, 
+                                  provider_name=None, dataset_code=None, 
+                                  slug=None, prefix=None):
+    """record one CSV gridfs entry by frequency and return dict of mongo id by frequency
     """
+    return record_export_files_by_frequency(db, values, export_format="csv",
+                                            provider_name=provider_name, 
+                                            dataset_code=dataset_code, 
+                                            slug=slug, prefix=prefix)
 
-    db = get_mongo_db()
+def dataset_version(db, dataset):
+    """Fingerprint of dataset content: last_update, count and last _id of series"""
+    query = {'provider_name': dataset['provider_name'], 
+             "dataset_code": dataset['dataset_code']}
+    last_series = db[constants.COL_SERIES].find_one(query, {"_id": True},
+                                                    sort=[("_id", DESCENDING)])
+    last_update = dataset.get("last_update")
+    version = "%s|%s|%s" % (last_update and last_update.isoformat(),
+                            db[constants.COL_SERIES].count_documents(query),
+                            last_series and last_series["_id"])
+    return hashlib.sha1(version.encode()).hexdigest()
+
+def find_export_files(db, provider_name, dataset_code, version, 
+                      export_format="csv", prefix="dataset", compress=False):
+    """Return ids of gridfs entries of a dataset version (sorted by frequency)"""
+    query = {
+        "metadata.doc_type": prefix,
+        "metadata.provider_name": provider_name,
+        "metadata.dataset_code": dataset_code,
+        "metadata.format": export_format,
+        "metadata.version": version,
+        "metadata.contentEncoding": "gzip" if compress else {"$exists": False},
+    }
+    docs = db[FS_FILES].find(query, {"_id": True, "metadata.frequency": True})
+    docs = sorted(docs, key=lambda doc: doc["metadata"].get("frequency") or "")
+    return [doc["_id"] for doc in docs]
+
+def remove_export_versions(db, provider_name, dataset_code, export_format="csv", 
+                           prefix="dataset", keep_versions=1):
+    """Remove gridfs entries of superseded versions of a dataset export
+    
+    Keep the keep_versions most recent versions - return count of removed files
+    """
+    query = {
+        "metadata.doc_type": prefix,
+        "metadata.provider_name": provider_name,
+        "metadata.dataset_code": dataset_code,
+        "metadata.format": export_format,
+        "metadata.version": {"$exists": True},
+    }
+    projection = {"_id": True, "metadata.version": True, "uploadDate": True}
+
+    versions = []
+    ids = {}
+    for doc in db[FS_FILES].find(query, projection).sort([("uploadDate", DESCENDING)]):
+        version = doc["metadata"]["version"]
+        if not version in ids:
+            versions.append(version)
+            ids[version] = []
+        ids[version].append(doc["_id"])
+
+    removed = [_id for version in versions[keep_versions:] for _id in ids[version]]
+    if removed:
+        db[FS_CHUNKS].delete_many({"files_id": {"$in": removed}})
+        db[FS_FILES].delete_many({"_id": {"$in": removed}})
+        logger.info("remove export - %s - %s - versions[%s] files[%s]" % (provider_name, dataset_code,
+                                                                        len(versions) - keep_versions,
+                                                                        len(removed)))
+    return len(removed)
+
+def export_file_series_bulk(slugs=None, query=None, name="basket", 
+                            export_format="csv", batch_size=500, db=None):
+    """Create one File from many series and record in MongoDB GridFS
+    
+    Return mongo id of gridfs entry or list of ids (one by frequency, sorted
+    by frequency) if series have several frequencies.
+    """
+    db = db or get_mongo_db()
+
+    series_query = series_bulk_query(slugs=slugs, query=query)
+    bounds = series_date_bounds(db, series_query)
+    if not bounds:
+        raise Exception("Series not found for slugs[%s] - query[%s]" % (slugs, query))
+
+    values = iter_export_series_bulk(db, query=series_query, batch_size=batch_size, 
+                                     bounds=bounds)
+    metadata = {"count_series": sum([b["count"] for b in bounds.values()])}
+
+    if len(bounds) > 1:
+        ids = record_export_files_by_frequency(db, values, 
+                                               export_format=export_format,
+                                               slug=name, 
+                                               prefix="series-bulk",
+                                               metadata=metadata,
+                                               label_columns=len(EXPORT_SERIES_BULK_HEADERS))
+        return [ids[freq] for freq in sorted(ids.keys())]
+
+    return record_export_file(db, (row for freq, row in values), 
+                              export_format=export_format,
+                              slug=name, 
+                              prefix="series-bulk",
+                              metadata=metadata,
+                              label_columns=len(EXPORT_SERIES_BULK_HEADERS))
+
+def export_file_series_unit(doc=None, 
+                            provider=None, dataset_code=None, key=None, 
+                            slug=None, export_format="csv", db=None):
+    """Create File from one series and record in MongoDB GridFS
+    """
+
+    db = db or get_mongo_db()
 
     if not doc:
         if slug:
@@ -201,20 +681,39 @@ def export_file_csv_series_unit(doc=None,
         msg = "Series not found for provider[%s] - dataset[%s] - key[%s] - slug[%s]"
         raise Exception(msg % (provider, dataset_code, key, slug))
     
-    return record_csv_file(db, export_series(doc), 
-                           provider_name=doc['provider_name'],
-                           dataset_code=doc["dataset_code"],
-                           key=doc["key"],
-                           slug=doc["slug"], 
-                           prefix="series")
+    return record_export_file(db, export_series(doc), 
+                              export_format=export_format,
+                              provider_name=doc['provider_name'],
+                              dataset_code=doc["dataset_code"],
+                              key=doc["key"],
+                              slug=doc["slug"], 
+                              prefix="series")
 
-def export_file_csv_dataset_unit(doc=None, 
-                                 provider=None, dataset_code=None,
-                                 slug=None):
-    """Create CSV File from one Dataset and record in MongoDB GridFS
+def export_file_csv_series_unit(doc=None, 
+                                provider=None, dataset_code=None, key=None, 
+                                slug=None):
+    """Create CSV File from one series and record in MongoDB GridFS
     """
+    return export_file_series_unit(doc=doc, provider=provider, dataset_code=dataset_code, 
+                                   key=key, slug=slug, export_format="csv")
 
-    db = get_mongo_db()
+def export_file_dataset_unit(doc=None, 
+                             provider=None, dataset_code=None,
+                             slug=None, export_format="csv",
+                             use_cache=False, keep_versions=1, compress=False, db=None):
+    """Create File from one Dataset and record in MongoDB GridFS
+    
+    Return mongo id of gridfs entry or list of ids (one by frequency, sorted
+    by frequency) if series of the dataset have several frequencies.
+    
+    use_cache: return existing files if dataset version (see dataset_version)
+    is already exported and remove files of superseded versions (keep
+    keep_versions most recent versions).
+    
+    compress: gzip content of files
+    """
+
+    db = db or get_mongo_db()
     
     if not doc:
         if slug:
@@ -235,20 +734,76 @@ def export_file_csv_dataset_unit(doc=None,
         raise Exception("Dataset not found for provider[%s] - dataset[%s] - slug[%s]" % (provider, 
                                                                                          dataset_code,
                                                                                          slug))
+
+    result, hit = _export_dataset_unit(db, doc, export_format=export_format,
+                                       use_cache=use_cache, keep_versions=keep_versions,
+                                       compress=compress)
+    return result
+
+def _export_dataset_unit(db, doc, export_format="csv", use_cache=False,
+                         keep_versions=1, compress=False):
+    """Export one dataset document - return (result, True if cache hit)
     
-    values = export_dataset(db, doc)
-    
-    return record_csv_file(db, values, 
-                           provider_name=doc['provider_name'],
-                           dataset_code=doc["dataset_code"],
-                           slug=doc["slug"], 
-                           prefix="dataset")
+    See export_file_dataset_unit
+    """
+    metadata = None
+    if use_cache:
+        version = dataset_version(db, doc)
+        ids = find_export_files(db, doc['provider_name'], doc["dataset_code"], version,
+                                export_format=export_format, compress=compress)
+        if ids:
+            logger.info("export cache - %s - %s - version[%s]" % (doc['provider_name'],
+                                                                  doc["dataset_code"],
+                                                                  version))
+            return (ids[0] if len(ids) == 1 else ids), True
+        metadata = {"version": version}
 
-def export_file_csv_dataset(provider=None, dataset_code=None, slug=None):
-    """Create CSV File from one or more Dataset and record in MongoDB GridFS
+    bounds = dataset_date_bounds(db, doc)
+    if len(bounds) > 1:
+        '''mixed frequencies: one file by frequency'''
+        values = iter_export_dataset_by_frequency(db, doc, bounds=bounds)
+        ids = record_export_files_by_frequency(db, values, 
+                                               export_format=export_format,
+                                               provider_name=doc['provider_name'],
+                                               dataset_code=doc["dataset_code"],
+                                               slug=doc["slug"], 
+                                               prefix="dataset",
+                                               metadata=metadata,
+                                               compress=compress,
+                                               label_columns=1 + len(doc['dimension_keys']))
+        result = [ids[freq] for freq in sorted(ids.keys())]
+    else:
+        values = iter_export_dataset(db, doc)
+        result = record_export_file(db, values, 
+                                    export_format=export_format,
+                                    provider_name=doc['provider_name'],
+                                    dataset_code=doc["dataset_code"],
+                                    slug=doc["slug"], 
+                                    prefix="dataset",
+                                    metadata=metadata,
+                                    compress=compress,
+                                    label_columns=1 + len(doc['dimension_keys']))
+
+    if use_cache:
+        remove_export_versions(db, doc['provider_name'], doc["dataset_code"],
+                               export_format=export_format, keep_versions=keep_versions)
+
+    return result, False
+
+def export_file_csv_dataset_unit(doc=None, 
+                                 provider=None, dataset_code=None,
+                                 slug=None):
+    """Create CSV File from one Dataset and record in MongoDB GridFS
+    """
+    return export_file_dataset_unit(doc=doc, provider=provider, dataset_code=dataset_code,
+                                    slug=slug, export_format="csv")
+
+def export_file_dataset(provider=None, dataset_code=None, slug=None, export_format="csv",
+                        db=None):
+    """Create File from one or more Dataset and record in MongoDB GridFS
     """
     
-    db = get_mongo_db()
+    db = db or get_mongo_db()
     projection = {'concepts': False, "codelists": False}
     
     query = {}
@@ -260,5 +815,99 @@ def export_file_csv_dataset(provider=None, dataset_code=None, slug=None):
 
     datasets = db[constants.COL_DATASETS].find(query, projection)
 
-    return [export_file_csv_dataset_unit(doc=doc) for doc in datasets]
+    return [export_file_dataset_unit(doc=doc, export_format=export_format, db=db) for doc in datasets]
+
+def export_file_csv_dataset(provider=None, dataset_code=None, slug=None):
+    """Create CSV File from one or more Dataset and record in MongoDB GridFS
+    """
+    return export_file_dataset(provider=provider, dataset_code=dataset_code, slug=slug,
+                               export_format="csv")
+
+def _export_dataset_task(db, doc, export_format, keep_versions, compress):
+    """Export one dataset for export_datasets_job - return result dict"""
+    start = time.time()
+    result = {
+        "provider_name": doc["provider_name"],
+        "dataset_code": doc["dataset_code"],
+        "slug": doc["slug"],
+        "ids": None,
+        "skipped": False,
+        "error": None,
+    }
+    try:
+        ids, hit = _export_dataset_unit(db, doc, export_format=export_format,
+                                        use_cache=True, keep_versions=keep_versions,
+                                        compress=compress)
+        '''cache hit: already exported (previous run)'''
+        result["skipped"] = hit
+        result["ids"] = ids if isinstance(ids, list) else [ids]
+    except Exception as err:
+        logger.critical("export dataset [%s] error: %s" % (doc["slug"], str(err)))
+        result["error"] = str(err)
+
+    result["duration"] = time.time() - start
+    return result
+
+def _log_progress(count, total, result):
+    if result["error"]:
+        status = "error"
+    elif result["skipped"]:
+        status = "skipped"
+    else:
+        status = "exported"
+    logger.info("export [%s/%s] - %s - %s : %.3f" % (count, total, result["slug"], 
+                                                     status, result["duration"]))
+
+def export_datasets_job(provider_name=None, slugs=None, export_format="csv", 
+                        max_workers=4, keep_versions=1, progress=_log_progress, 
+                        compress=False, db=None):
+    """Export datasets of a provider (or list of slugs) in a thread pool
+    
+    Datasets with an export of the current version (see dataset_version)
+    are skipped: a job can be restarted after a crash.
+    
+    progress: callable(count, total, result) called after each dataset
+    
+    Return dict of stats with result of each dataset
+    """
+    if not provider_name and not slugs:
+        raise ValueError("provider_name or slugs is required")
+
+    db = db or get_mongo_db()
+    start = time.time()
+
+    if slugs:
+        query = {"slug": {"$in": list(slugs)}}
+    else:
+        query = {"provider_name": provider_name}
+    projection = {'concepts': False, "codelists": False}
+
+    datasets = list(db[constants.COL_DATASETS].find(query, projection))
+    total = len(datasets)
+
+    stats = {
+        "count": total,
+        "exported": 0,
+        "skipped": 0,
+        "errors": 0,
+        "datasets": [],
+    }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_export_dataset_task, db, doc, export_format, keep_versions, compress)
+                   for doc in datasets]
+        for count, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            stats["datasets"].append(result)
+            if result["error"]:
+                stats["errors"] += 1
+            elif result["skipped"]:
+                stats["skipped"] += 1
+            else:
+                stats["exported"] += 1
+            if progress:
+                progress(count, total, result)
 
+    stats["duration"] = time.time() - start
+    logger.info("export job - datasets[%(count)s] - exported[%(exported)s] - skipped[%(skipped)s] - errors[%(errors)s] : %(duration).3f" % stats)
+    return stats
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+from pymongo import DESCENDING, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure, PyMongoError
+
+from widukind_common import constants
+from widukind_common import tags as tags_utils
+
+logger = logging.getLogger(__name__)
+
+WATCH_OPERATIONS = ["insert", "update", "replace"]
+
+def is_tags_event(event):
+    """Return True if update event only modify tags field
+
+    Used to ignore changes made by the watcher itself.
+    """
+    if event.get("operationType") != "update":
+        return False
+
+    description = event.get("updateDescription") or {}
+    if description.get("removedFields"):
+        return False
+
+    fields = (description.get("updatedFields") or {}).keys()
+    if not fields:
+        return False
+
+    for field in fields:
+        if field != "tags" and not field.startswith("tags."):
+            return False
+    return True
+
+def change_streams_available(db):
+    return isinstance(db[constants.COL_SERIES], Collection) \
+        and hasattr(Collection, "watch")
+
+class TagsWatcher(object):
+    """Re-generate tags of modified series and datasets
+
+    Use change streams on series and datasets (MongoDB >= 3.6 replica set)
+    or poll datasets by last_update if change streams are not available
+    (standalone server, mongomock). In polling mode, series inserted or
+    updated without a change of last_update of their dataset are not
+    re-tagged.
+
+    Change streams are reopened after an error (resume tokens), with an
+    exponential delay from reconnect_delay to reconnect_max_delay seconds.
+    On a flush error, pending documents are kept and the flush is retried
+    with the same delays.
+
+    Events are debounced: pending documents are processed when no event
+    was received since debounce seconds or when max_batch documents are
+    pending.
+
+    >>> watcher = TagsWatcher(get_mongo_db(), debounce=5)
+    >>> watcher.run()
+    """
+
+    def __init__(self, db, debounce=2.0, max_batch=1000, max_bulk=100,
+                 poll_interval=10.0, since=None, use_change_streams=True,
+                 reconnect_delay=1.0, reconnect_max_delay=60.0):
+        self.db = db
+        self.debounce = debounce
+        self.max_batch = max_batch
+        self.max_bulk = max_bulk
+        self.poll_interval = poll_interval
+        self.use_change_streams = use_change_streams
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+
+        self.pending_series = set()
+        self.pending_datasets = set()
+        self.last_event = None
+        self.last_poll = None
+        self.since = since
+        self.resume_tokens = {}
+        self.streams = None
+        self.reopen_at = None
+        self.reopen_delay = None
+        self.flush_at = None
+        self.flush_delay = None
+        self.stopped = False
+
+    def count_pending(self):
+        return len(self.pending_series) + len(self.pending_datasets)
+
+    def add_event(self, col_name, _id):
+        if col_name == constants.COL_DATASETS:
+            self.pending_datasets.add(_id)
+        else:
+            self.pending_series.add(_id)
+        self.last_event = time.time()
+
+    def is_ready(self, now=None):
+        if not self.count_pending():
+            return False
+        if self.count_pending() >= self.max_batch:
+            return True
+        now = now or time.time()
+        return now - self.last_event >= self.debounce
+
+    def _flush_datasets(self, dataset_ids):
+        """Re-tag datasets and all theirs series (concepts and codelists
+        are shared by series)
+
+        Return list of (provider_name, dataset_code) processed and count of
+        modified series.
+        """
+        processed = []
+        count_modified = 0
+        query = {"_id": {"$in": list(dataset_ids)}}
+        projection = {"provider_name": True, "dataset_code": True}
+        for doc in self.db[constants.COL_DATASETS].find(query, projection):
+            provider_name = doc["provider_name"]
+            dataset_code = doc["dataset_code"]
+            tags_utils.update_tags_datasets(self.db, provider_name=provider_name,
+                                            dataset_code=dataset_code,
+                                            max_bulk=self.max_bulk)
+            result = tags_utils.update_tags_series(self.db, provider_name=provider_name,
+                                                   dataset_code=dataset_code,
+                                                   max_bulk=self.max_bulk)
+            if result:
+                count_modified += result["nModified"]
+            processed.append((provider_name, dataset_code))
+        return processed, count_modified
+
+    def _flush_series(self, series_ids, bypass_datasets=[]):
+        providers = {}
+        datasets = {}
+        builders = {}
+        requests = []
+        count_modified = 0
+
+        projection = dict(tags_utils.SERIES_TAGS_PROJECTION,
+                          provider_name=True)
+        query = {"_id": {"$in": list(series_ids)}}
+
+        for doc in self.db[constants.COL_SERIES].find(query, projection):
+            ds_key = (doc["provider_name"], doc["dataset_code"])
+            if ds_key in bypass_datasets:
+                continue
+
+            if not ds_key in builders:
+                if not doc["provider_name"] in providers:
+                    providers[doc["provider_name"]] = self.db[constants.COL_PROVIDERS].find_one({"enable": True,
+                                                                                                "name": doc["provider_name"]})
+                doc_provider = providers[doc["provider_name"]]
+
+                dataset_query = {"provider_name": ds_key[0], "dataset_code": ds_key[1],
+                                 "enable": True}
+                datasets[ds_key] = self.db[constants.COL_DATASETS].find_one(dataset_query)
+
+                if not doc_provider or not datasets[ds_key]:
+                    builders[ds_key] = None
+                else:
+                    builders[ds_key] = tags_utils.SeriesTagsBuilder(doc_provider,
+                                                                    datasets[ds_key])
+
+            tags_builder = builders[ds_key]
+            if not tags_builder:
+                continue
+
+            tags = tags_builder(doc)
+            if tags and tags_utils.is_tags_changed(doc, tags):
+                requests.append(UpdateOne({'_id': doc["_id"]}, {"$set": {'tags': tags}}))
+
+            if len(requests) >= self.max_bulk:
+                count_modified += self.db[constants.COL_SERIES].bulk_write(requests, ordered=False).modified_count
+                requests = []
+
+        if requests:
+            count_modified += self.db[constants.COL_SERIES].bulk_write(requests, ordered=False).modified_count
+
+        return count_modified
+
+    def flush(self):
+        """Process pending documents - return stats dict
+
+        On error, documents are added back to pending documents.
+        """
+        dataset_ids = self.pending_datasets
+        series_ids = self.pending_series
+        self.pending_datasets = set()
+        self.pending_series = set()
+
+        processed = []
+        count_modified = 0
+        try:
+            if dataset_ids:
+                processed, count_modified = self._flush_datasets(dataset_ids)
+
+            if series_ids:
+                count_modified += self._flush_series(series_ids,
+                                                     bypass_datasets=processed)
+        except Exception:
+            self.pending_datasets |= dataset_ids
+            self.pending_series |= series_ids
+            raise
+
+        stats = {
+            "count_datasets": len(processed),
+            "count_series": len(series_ids),
+            "count_modified": count_modified,
+        }
+        logger.info("flush tags - datasets[%(count_datasets)s] - series[%(count_series)s] - modified[%(count_modified)s]" % stats)
+        return stats
+
+    def poll(self):
+        """Add datasets with last_update more recent than previous poll
+
+        Series are not polled: only series of datasets with a new
+        last_update are re-tagged.
+        """
+        col = self.db[constants.COL_DATASETS]
+
+        if self.last_poll is None and self.since is None:
+            '''first poll: only next changes'''
+            doc = col.find_one({"last_update": {"$exists": True}},
+                               {"last_update": True},
+                               sort=[("last_update", DESCENDING)])
+            self.since = doc and doc["last_update"]
+            self.last_poll = time.time()
+            return 0
+
+        query = {"last_update": {"$exists": True}}
+        if self.since:
+            query["last_update"] = {"$gt": self.since}
+
+        count = 0
+        for doc in col.find(query, {"last_update": True}):
+            self.add_event(constants.COL_DATASETS, doc["_id"])
+            if not self.since or doc["last_update"] > self.since:
+                self.since = doc["last_update"]
+            count += 1
+
+        self.last_poll = time.time()
+        return count
+
+    def open_streams(self):
+        streams = {}
+        pipeline = [{"$match": {"operationType": {"$in": WATCH_OPERATIONS}}}]
+        for col_name in [constants.COL_DATASETS, constants.COL_SERIES]:
+            streams[col_name] = self.db[col_name].watch(pipeline,
+                                                        resume_after=self.resume_tokens.get(col_name))
+        return streams
+
+    def close_streams(self):
+        if self.streams:
+            for stream in self.streams.values():
+                stream.close()
+        self.streams = None
+
+    def read_streams(self):
+        """Read available events without blocking - return count of events
+
+        Stop when max_batch documents are pending: run() flush them before
+        next read (the rest of events stay in the streams).
+        """
+        count = 0
+        for col_name, stream in self.streams.items():
+            while self.count_pending() < self.max_batch:
+                event = stream.try_next()
+                if event is None:
+                    break
+                self.resume_tokens[col_name] = event["_id"]
+                if is_tags_event(event):
+                    continue
+                self.add_event(col_name, event["documentKey"]["_id"])
+                count += 1
+        return count
+
+    def next_delay(self, delay):
+        """Exponential delay from reconnect_delay to reconnect_max_delay"""
+        if delay is None:
+            return self.reconnect_delay
+        return min(delay * 2, self.reconnect_max_delay)
+
+    def schedule_reopen(self):
+        self.reopen_delay = self.next_delay(self.reopen_delay)
+        self.reopen_at = time.time() + self.reopen_delay
+
+    def try_flush(self):
+        """Flush - on error, retry later - return True if flushed"""
+        if self.flush_at is not None and time.time() < self.flush_at:
+            return False
+        try:
+            self.flush()
+        except PyMongoError as err:
+            self.flush_delay = self.next_delay(self.flush_delay)
+            self.flush_at = time.time() + self.flush_delay
+            logger.error("flush tags error (retry in %.1fs - pending[%s]): %s" % (self.flush_delay,
+                                                                                  self.count_pending(),
+                                                                                  str(err)))
+            return False
+        self.flush_at = None
+        self.flush_delay = None
+        return True
+
+    def reopen_streams(self):
+        """Return True if change streams are opened - retry later otherwise"""
+        try:
+            self.streams = self.open_streams()
+        except PyMongoError as err:
+            self.schedule_reopen()
+            logger.error("change streams reopen error (retry in %.1fs): %s" % (self.reopen_delay, str(err)))
+            return False
+        logger.info("change streams reopened")
+        self.reopen_at = None
+        self.reopen_delay = None
+        return True
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, sleep=0.5, max_iterations=None):
+        """Main loop - stop with stop() or after max_iterations"""
+
+        if self.use_change_streams and change_streams_available(self.db):
+            try:
+                self.streams = self.open_streams()
+                logger.info("tags watcher use change streams")
+            except OperationFailure as err:
+                logger.warning("change streams not available: %s" % str(err))
+                self.streams = None
+            except PyMongoError as err:
+                '''server not available: retry later'''
+                self.schedule_reopen()
+                logger.error("change streams open error (retry in %.1fs): %s" % (self.reopen_delay, str(err)))
+
+        if not self.streams and self.reopen_at is None:
+            logger.info("tags watcher use polling on datasets last_update")
+
+        iterations = 0
+        try:
+            while not self.stopped:
+                if self.streams:
+                    try:
+                        self.read_streams()
+                    except PyMongoError as err:
+                        logger.error("change streams error: %s" % str(err))
+                        self.close_streams()
+                        self.schedule_reopen()
+
+                elif self.reopen_at is not None:
+                    if time.time() >= self.reopen_at:
+                        self.reopen_streams()
+
+                elif not self.last_poll or time.time() - self.last_poll >= self.poll_interval:
+                    self.poll()
+
+                if self.is_ready():
+                    self.try_flush()
+
+                iterations += 1
+                if max_iterations and iterations >= max_iterations:
+                    break
+
+                time.sleep(sleep)
+        finally:
+            self.flush_at = None
+            if self.count_pending() and not self.try_flush():
+                logger.error("tags watcher stopped - pending documents not flushed[%s]" % self.count_pending())
+            self.close_streams()
@@ -5,12 +5,32 @@ import unittest
 from io import StringIO
 
 import mongomock
+import pandas
 
 from widukind_common.utils import get_mongo_client, create_or_update_indexes
 from widukind_common import tests_tools as utils
 
 from widukind_common import constants
 
+def series_fixture(key, start, values, freq="A", provider_name="p1", dataset_code="d1",
+                   **dimensions):
+    """Series document with values from start period (str) - dimensions: FREQ
+    and keywords arguments"""
+    periods = pandas.period_range(pandas.Period(start, freq=freq), periods=len(values), freq=freq)
+    return {
+        "provider_name": provider_name,
+        "dataset_code": dataset_code,
+        "key": key,
+        "slug": "%s-%s-%s" % (provider_name, dataset_code, key.lower()),
+        "name": key,
+        "frequency": freq,
+        "dimensions": dict(FREQ=freq, **dimensions),
+        "start_date": periods[0].ordinal,
+        "end_date": periods[-1].ordinal,
+        "values": [{"period": str(p), "value": v, "attributes": None}
+                   for p, v in zip(periods, values)],
+    }
+
 class BaseTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import pandas
+
+from widukind_common import dataframe
+from widukind_common import constants
+from widukind_common.tests.base import BaseDBTestCase, series_fixture
+
+class DataFrameTestCase(BaseDBTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_dataframe:DataFrameTestCase
+
+    def test_series_to_dataframe(self):
+
+        # nosetests -s -v widukind_common.tests.test_dataframe:DataFrameTestCase.test_series_to_dataframe
+
+        series_list = [series_fixture("X1", "1995", ["1", "2.5", "NaN"]),
+                       series_fixture("X2", "1996", ["4", "", "6", "7"])]
+        dmin = pandas.Period("1995", freq="A").ordinal
+        dmax = pandas.Period("1999", freq="A").ordinal
+
+        df = dataframe.series_to_dataframe(series_list, "A", dmin, dmax, column="key")
+
+        self.assertEqual(list(df.columns), ["X1", "X2"])
+        self.assertIsInstance(df.index, pandas.PeriodIndex)
+        self.assertEqual([str(p) for p in df.index], ["1995", "1996", "1997", "1998", "1999"])
+        self.assertEqual(df["X1"].dtype, numpy.float64)
+        self.assertEqual(df["X1"]["1996"], 2.5)
+        self.assertTrue(numpy.isnan(df["X1"]["1997"]))
+        self.assertTrue(numpy.isnan(df["X1"]["1999"]))
+        self.assertTrue(numpy.isnan(df["X2"]["1995"]))
+        self.assertTrue(numpy.isnan(df["X2"]["1997"]))
+        self.assertEqual(df["X2"]["1999"], 7.0)
+
+    def test_load_series_dataframe(self):
+
+        # nosetests -s -v widukind_common.tests.test_dataframe:DataFrameTestCase.test_load_series_dataframe
+
+        self.db[constants.COL_SERIES].insert(series_fixture("X1", "1995", ["1", "2"]))
+        self.db[constants.COL_SERIES].insert(series_fixture("X2", "1996", ["3", "4"]))
+        self.db[constants.COL_SERIES].insert(series_fixture("X3", "2000-01", ["5"], freq="M"))
+        self.db[constants.COL_SERIES].insert(series_fixture("X4", "2000", ["6"], dataset_code="d2"))
+
+        df = dataframe.load_dataset_dataframe(self.db, "p1", "d1", frequency="A")
+        self.assertEqual(sorted(df.columns), ["X1", "X2"])
+        self.assertEqual([str(p) for p in df.index], ["1995", "1996", "1997"])
+        self.assertEqual(df["X2"]["1997"], 4.0)
+
+        with self.assertRaises(ValueError):
+            dataframe.load_dataset_dataframe(self.db, "p1", "d1")
+
+        df = dataframe.load_series_dataframe(self.db, slugs=["p1-d1-x1", "p1-d2-x4"])
+        self.assertEqual(sorted(df.columns), ["p1-d1-x1", "p1-d2-x4"])
+        self.assertEqual(len(df.index), 6)
+
+        df = dataframe.load_series_dataframe(self.db, slugs=["p1-d1-x3"])
+        self.assertEqual(df.index.freqstr, "M")
+
+        df = dataframe.load_series_dataframe(self.db, slugs=["unknown"])
+        self.assertTrue(df.empty)
+
+        with self.assertRaises(ValueError):
+            dataframe.load_series_dataframe(self.db)
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
+from datetime import datetime
 from pprint import pprint
 import pymongo 
 
 from widukind_common import tags as tags_utils
 from widukind_common import constants
+from widukind_common import utils
 
 from widukind_common.tests.base import BaseTestCase, BaseDBTestCase
 
@@ -15,14 +18,14 @@ class TagsUtilsTestCase(BaseTestCase):
     
     def test_tags_map(self):
         
+        tokenizer = tags_utils.TagsTokenizer(exclude_words=[], min_char=1)
+
         query = "The a France Quaterly"
-        #result = sorted(tags_utils.tags_map(query))
-        result = sorted(tags_utils._translate(query))
+        result = sorted(tokenizer.tokenize(query))
         self.assertEqual(result, ["a", "france", "quaterly", "the"])
         
-        result = tags_utils._translate(None)
-        #result = tags_utils.tags_map(None)
-        self.assertIsNone(result)
+        result = tokenizer.tokenize(None)
+        self.assertEqual(result, ())
         
     def test_str_to_tags(self):
         
@@ -36,8 +39,30 @@ class TagsUtilsTestCase(BaseTestCase):
 
         self.assertEqual(tags_utils.str_to_tags("The a France Quaterly"), ["france", "quaterly"])        
 
-        self.assertEqual(tags_utils.str_to_tags(None), [])        
-        
+        self.assertEqual(tags_utils.str_to_tags(None), [])
+
+    def test_tokenizer(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:TagsUtilsTestCase.test_tokenizer
+
+        tokenizer = tags_utils.TagsTokenizer(exclude_words=["of"])
+
+        self.assertEqual(tokenizer("Bank's of France 2015 - _"), ['bank', 'france'])
+        self.assertEqual(tokenizer.tokenize("Bank's of France"), ('bank', 'france'))
+        self.assertEqual(tokenizer.tokenize(None), ())
+        self.assertEqual(tokenizer.tokenize("a"), ())
+
+        '''result is cached by raw string'''
+        tokenizer.cache_clear()
+        tokenizer("Bank's of France")
+        tokenizer("Bank's of France")
+        info = tokenizer.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 1)
+
+        self.assertEqual(tokenizer.tags(["France", "Bank of France", None]),
+                         ['bank', 'france'])
+
 
 class GenerateTagsTestCase(BaseDBTestCase):
 
@@ -133,6 +158,61 @@ class GenerateTagsTestCase(BaseDBTestCase):
                                                dataset)
         self.assertEqual(tags, ['country', 'd1', 'dataset', 'estimate', 'france', 'mars', 'monthly', 'observation', 'p1', 'provider', 'series', 'status', 'test', 'x1'])
 
+    def test_series_tags_builder(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:GenerateTagsTestCase.test_series_tags_builder
+
+        dataset = {
+            "enable": True,
+            "provider_name": self.doc_provider["name"],
+            "dataset_code": "d1",
+            "name": "dataset 1",
+            "slug": "%s-d1" % self.doc_provider["slug"],
+            "concepts": {
+                "FREQ": "Frequency",
+                "COUNTRY": "Country"
+            },
+            "codelists": {
+                "COUNTRY": {
+                    "FRA": "France"
+                }
+            },
+            "dimension_keys": ["FREQ", "COUNTRY"],
+        }
+
+        builder = tags_utils.SeriesTagsBuilder(self.doc_provider, dataset)
+        self.assertEqual(sorted(builder.base_tags), ['d1', 'dataset', 'mars', 'p1', 'provider', 'test'])
+        self.assertEqual(builder.concepts_tags["COUNTRY"], frozenset(['country']))
+
+        series1 = {
+            "dataset_code": "d1",
+            "key": "x1",
+            "name": "series 1",
+            "frequency": "A",
+            "dimensions": {
+                "COUNTRY": "FRA"
+            },
+        }
+        series2 = {
+            "dataset_code": "d1",
+            "key": "x2",
+            "name": "series 2",
+            "frequency": "A",
+            "dimensions": {
+                "COUNTRY": "DEU"
+            },
+        }
+
+        self.assertEqual(builder(series1), ['annually', 'country', 'd1', 'dataset', 'france', 'mars', 'p1', 'provider', 'series', 'test', 'x1'])
+        '''code not in codelists: use code'''
+        self.assertEqual(builder(series2), ['annually', 'country', 'd1', 'dataset', 'deu', 'mars', 'p1', 'provider', 'series', 'test', 'x2'])
+        self.assertEqual(builder.codes_tags, {("COUNTRY", "FRA"): frozenset(["france"]),
+                                              ("COUNTRY", "DEU"): frozenset(["deu"])})
+
+        self.assertEqual(tags_utils.generate_tags_series(series1, self.doc_provider, dataset,
+                                                         tags_builder=builder),
+                         tags_utils.generate_tags_series(series1, self.doc_provider, dataset))
+
 class UpdateTagsTestCase(BaseDBTestCase):
     
     # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase
@@ -274,7 +354,327 @@ class UpdateTagsTestCase(BaseDBTestCase):
         series_doc = self.db[constants.COL_SERIES].find_one(query)
         self.assertIsNotNone(series_doc)
         self.assertEqual(series_doc["tags"], ['country', 'd1', 'dataset', 'estimate', 'france', 'mars', 'monthly', 'observation', 'p1', 'provider', 'series', 'status', 'test', 'x1'])
+
+    def test_update_tags_series_skip_unchanged(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_skip_unchanged
+
+        self._insert_dataset_with_series(count_series=3)
+
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"])
+        self.assertEqual(result["nModified"], 3)
+        self.assertEqual(result["nChanged"], 3)
+        self.assertEqual(result["nSkipped"], 0)
+
+        '''all tags are unchanged: no write'''
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"])
+        self.assertEqual(result["nMatched"], 0)
+        self.assertEqual(result["nModified"], 0)
+        self.assertEqual(result["nChanged"], 0)
+        self.assertEqual(result["nSkipped"], 3)
+
+        self.db[constants.COL_SERIES].update_one({"key": "x1"},
+                                                 {"$set": {"name": "series 1 changed"}})
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"])
+        self.assertEqual(result["nModified"], 1)
+        self.assertEqual(result["nChanged"], 1)
+        self.assertEqual(result["nSkipped"], 2)
+
+        series_doc = self.db[constants.COL_SERIES].find_one({"key": "x1"})
+        self.assertTrue("changed" in series_doc["tags"])
+
+    def test_update_tags_series_incremental(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_incremental
+
+        self._insert_dataset_with_series(count_series=2)
+        self.db[constants.COL_DATASETS].update_one({"dataset_code": "d1"},
+                                                   {"$set": {"last_update": datetime(2016, 1, 1)}})
+
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                               incremental=True)
+        self.assertEqual(result["nModified"], 2)
+        self.assertEqual(tags_utils.get_tags_watermark(self.db, self.doc_provider["name"]),
+                         datetime(2016, 1, 1))
+
+        '''dataset not updated since last run: series are not read'''
+        self.db[constants.COL_SERIES].update_many({}, {"$unset": {"tags": True}})
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                               incremental=True)
+        self.assertEqual(result["nChanged"], 0)
+        self.assertEqual(result["nSkipped"], 0)
+
+        self.db[constants.COL_DATASETS].update_one({"dataset_code": "d1"},
+                                                   {"$set": {"last_update": datetime(2016, 1, 2)}})
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                               incremental=True)
+        self.assertEqual(result["nModified"], 2)
+        self.assertEqual(tags_utils.get_tags_watermark(self.db, self.doc_provider["name"]),
+                         datetime(2016, 1, 2))
+
+        '''datasets watermark is independent'''
+        self.assertIsNone(tags_utils.get_tags_watermark(self.db, self.doc_provider["name"],
+                                                        target=constants.COL_DATASETS))
+        result = tags_utils.update_tags_datasets(self.db, self.doc_provider["name"],
+                                                 incremental=True)
+        self.assertEqual(result["nModified"], 1)
+        result = tags_utils.update_tags_datasets(self.db, self.doc_provider["name"],
+                                                 incremental=True)
+        self.assertEqual(result["nMatched"], 0)
+
+    def test_update_tags_series_incremental_disabled_provider(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_incremental_disabled_provider
+
+        self._insert_dataset_with_series(count_series=2)
+        self.db[constants.COL_DATASETS].update_one({"dataset_code": "d1"},
+                                                   {"$set": {"last_update": datetime(2016, 1, 1)}})
+        self.db[constants.COL_PROVIDERS].update_one({"name": self.doc_provider["name"]},
+                                                    {"$set": {"enable": False}})
+
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                               incremental=True)
+        self.assertIsNone(result)
+        self.assertIsNone(tags_utils.get_tags_watermark(self.db, self.doc_provider["name"]))
+
+        self.db[constants.COL_PROVIDERS].update_one({"name": self.doc_provider["name"]},
+                                                    {"$set": {"enable": True}})
+        result = tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                               incremental=True)
+        self.assertEqual(result["nModified"], 2)
+
+    def test_update_tags_series_counters(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_counters
+
+        self._insert_dataset_with_series(count_series=2)
+
+        tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                      update_counters=True)
+
+        tag = self.db[constants.COL_TAGS].find_one({"name": "france"})
+        self.assertEqual(tag["count"], 2)
+        self.assertEqual(tag["count_series"], 2)
+        self.assertEqual(tag["count_series_providers"], {"p1": 2})
+        self.assertEqual(tag["provider_name"], ["p1"])
+        self.assertEqual(tag["dataset_code"], ["d1"])
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "x1"})["count_series"], 1)
+
+        '''unchanged series: no delta'''
+        tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                      update_counters=True)
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "france"})["count_series"], 2)
+
+        self.db[constants.COL_SERIES].update_one({"key": "x1"},
+                                                 {"$set": {"dimensions.COUNTRY": "DEU"}})
+        tags_utils.update_tags_series(self.db, self.doc_provider["name"],
+                                      update_counters=True)
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "france"})["count_series"], 1)
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "deu"})["count_series"], 1)
+
+    def test_reconcile_tags_series(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_reconcile_tags_series
+
+        self._insert_dataset_with_series(count_series=2)
+        tags_utils.update_tags_series(self.db, self.doc_provider["name"])
+
+        '''legacy counters: aggregate twice'''
+        tags_utils.aggregate_tags_series(self.db)
+        tags_utils.aggregate_tags_series(self.db)
+        self.db[constants.COL_TAGS].insert({"name": "obsolete", "count": 3, "count_series": 3,
+                                            "count_series_providers": {"p1": 3}})
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "france"})["count_series"], 4)
+
+        result = tags_utils.reconcile_tags_series(self.db, self.doc_provider["name"],
+                                                  batch_size=3)
+        self.assertEqual(result["count_tags"], 13)
+
+        tag = self.db[constants.COL_TAGS].find_one({"name": "france"})
+        self.assertEqual(tag["count"], 2)
+        self.assertEqual(tag["count_series"], 2)
+        self.assertEqual(tag["count_series_providers"], {"p1": 2})
+
+        tag = self.db[constants.COL_TAGS].find_one({"name": "obsolete"})
+        self.assertEqual(tag["count_series"], 0)
+        self.assertEqual(tag["count_series_providers"], {})
+
+        '''idempotent'''
+        tags_utils.reconcile_tags_series(self.db, self.doc_provider["name"])
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "france"})["count_series"], 2)
+
+        '''counts of other providers are kept'''
+        self.db[constants.COL_TAGS].update_one({"name": "france"},
+                                               {"$set": {"count": 5, "count_series": 5,
+                                                         "count_series_providers": {"p1": 2, "p2": 3}}})
+        self.db[constants.COL_TAGS].update_one({"name": "x1"},
+                                               {"$set": {"count": 4, "count_series": 4},
+                                                "$unset": {"count_series_providers": True}})
+        tags_utils.reconcile_tags_series(self.db, self.doc_provider["name"])
+
+        tag = self.db[constants.COL_TAGS].find_one({"name": "france"})
+        self.assertEqual(tag["count_series"], 5)
+        self.assertEqual(tag["count_series_providers"], {"p1": 2, "p2": 3})
+
+        '''not seeded: only the counter of the provider is set'''
+        tag = self.db[constants.COL_TAGS].find_one({"name": "x1"})
+        self.assertEqual(tag["count_series"], 4)
+        self.assertEqual(tag["count_series_providers"], {"p1": 1})
+
+    def test_aggregate_tags_series_partitions(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_aggregate_tags_series_partitions
+
+        self._insert_dataset_with_series(count_series=3)
+        self.db[constants.COL_DATASETS].insert({"enable": True, "provider_name": "p1",
+                                                "dataset_code": "d2", "name": "dataset 2",
+                                                "slug": "p1-d2"})
+        self.db[constants.COL_SERIES].insert({"provider_name": "p1", "dataset_code": "d2",
+                                              "key": "x0", "name": "series 0", "slug": "p1-d2-x0",
+                                              "frequency": "A"})
+        tags_utils.update_tags_series(self.db, self.doc_provider["name"])
+
+        def _counters():
+            return dict([(doc["name"], (doc["count_series"], sorted(doc["dataset_code"])))
+                         for doc in self.db[constants.COL_TAGS].find()])
+
+        tags_utils.aggregate_tags_series(self.db)
+        expected = _counters()
+        self.assertEqual(self.db[constants.COL_TAGS].find_one({"name": "x0"})["count_series_providers"],
+                         {"p1": 2})
+        self.assertEqual(expected["series"], (4, ["d1", "d2"]))
+        self.assertEqual(expected["x0"], (2, ["d1", "d2"]))
+
+        for partition_by in ["provider_name", "dataset_code"]:
+            self.db[constants.COL_TAGS].delete_many({})
+            result = tags_utils.aggregate_tags_series(self.db,
+                                                      partition_by=partition_by,
+                                                      max_workers=2)
+            self.assertEqual(result["nUpserted"], len(expected))
+            self.assertEqual(_counters(), expected)
+
+        '''series without dataset document'''
+        self.db[constants.COL_SERIES].insert({"provider_name": "p1", "dataset_code": "d3",
+                                              "key": "y0", "slug": "p1-d3-y0",
+                                              "tags": ["france"]})
+        self.db[constants.COL_TAGS].delete_many({})
+        tags_utils.aggregate_tags_series(self.db)
+        expected = _counters()
+        self.assertEqual(expected["france"][1], ["d1", "d3"])
+        for partition_by in ["provider_name", "dataset_code"]:
+            self.db[constants.COL_TAGS].delete_many({})
+            tags_utils.aggregate_tags_series(self.db, partition_by=partition_by)
+            self.assertEqual(_counters(), expected)
+
+        with self.assertRaises(ValueError):
+            tags_utils.aggregate_tags_series(self.db, partition_by="unknown")
+
+        '''no slugs collected for series'''
+        pipeline = tags_utils._aggregate_tags_pipeline({}, with_slug=False)
+        self.assertFalse("slug" in pipeline[1]["$project"])
+        self.assertFalse("slug" in pipeline[-1]["$group"])
+        merged = list(tags_utils._aggregate_tags_merge(
+            [[{"_id": "france", "count": 2, "provider_name": ["p1"], "dataset_code": ["d1"],
+               "providers": [{"provider_name": "p1", "count": 2}]}],
+             [{"_id": "france", "count": 1, "provider_name": ["p1"], "dataset_code": ["d2"],
+               "providers": [{"provider_name": "p1", "count": 1}]}]],
+            with_slug=False))
+        self.assertEqual(merged, [{"_id": "france", "count": 3, "provider_name": ["p1"],
+                                   "dataset_code": ["d1", "d2"],
+                                   "providers": [{"provider_name": "p1", "count": 2},
+                                                 {"provider_name": "p1", "count": 1}]}])
+
+    def _insert_dataset_with_series(self, count_series=5):
+        self.db[constants.COL_PROVIDERS].insert(self.doc_provider)
+
+        dataset = {
+            "enable": True,
+            "provider_name": self.doc_provider["name"],
+            "dataset_code": "d1",
+            "name": "dataset 1",
+            "slug": "%s-d1" % self.doc_provider["slug"],
+            "concepts": {
+                "COUNTRY": "Country"
+            },
+            "codelists": {
+                "COUNTRY": {
+                    "FRA": "France"
+                }
+            },
+            "dimension_keys": ["COUNTRY"],
+        }
+        self.db[constants.COL_DATASETS].insert(dataset)
+
+        for i in range(count_series):
+            self.db[constants.COL_SERIES].insert({
+                "provider_name": self.doc_provider["name"],
+                "dataset_code": dataset["dataset_code"],
+                "key": "x%s" % i,
+                "name": "series %s" % i,
+                "slug": "%s-d1-x%s" % (self.doc_provider["slug"], i),
+                "frequency": "A",
+                "dimensions": {
+                    "COUNTRY": "FRA"
+                },
+            })
+
+        return dataset
+
+    def test_update_tags_series_worker(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_worker
+
+        self._insert_dataset_with_series(count_series=5)
+        doc_dataset = self.db[constants.COL_DATASETS].find_one()
+
+        id_ranges = tags_utils._series_id_ranges(self.db, doc_dataset, max_series=2)
+        self.assertEqual(len(id_ranges), 3)
+        self.assertIsNone(id_ranges[0][0])
+        self.assertIsNone(id_ranges[-1][1])
+        self.assertEqual(id_ranges[0][1], id_ranges[1][0])
+
+        results = []
+        for id_range in id_ranges:
+            _results, skipped = tags_utils._update_tags_series_worker(self.db,
+                                                                      self.doc_provider,
+                                                                      doc_dataset,
+                                                                      id_range=id_range)
+            self.assertEqual(skipped, 0)
+            results.extend(_results)
+
+        self.assertEqual(sorted([r[1] for r in results]), ["x0", "x1", "x2", "x3", "x4"])
+        _id, key, tags, old_tags = [r for r in results if r[1] == "x1"][0]
+        self.assertEqual(tags, ['annually', 'country', 'd1', 'dataset', 'france', 'mars', 'p1', 'provider', 'series', 'test', 'x1'])
+        self.assertIsNone(old_tags)
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_update_tags_series_process(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_process
+
+        self._insert_dataset_with_series(count_series=5)
+
+        result = tags_utils.update_tags_series(self.db,
+                                               self.doc_provider["name"],
+                                               async_mode="process",
+                                               max_workers=2, max_bulk=2)
+        self.assertEqual(result["nMatched"], 5)
+        self.assertEqual(result["nModified"], 5)
+
+        series_doc = self.db[constants.COL_SERIES].find_one({"key": "x1"})
+        self.assertEqual(series_doc["tags"], ['annually', 'country', 'd1', 'dataset', 'france', 'mars', 'p1', 'provider', 'series', 'test', 'x1'])
         
+    def test_update_tags_series_process_mongo_url(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:UpdateTagsTestCase.test_update_tags_series_process_mongo_url
+
+        if 'USE_MONGO_SERVER' in os.environ:
+            self.assertIsNotNone(utils.client_mongo_url(self.db.client))
+        else:
+            '''URL of mongomock client can not be derived'''
+            with self.assertRaises(ValueError):
+                tags_utils.update_tags_series(self.db, "p1", async_mode="process")
+
 @unittest.skipIf(True, "TODO")    
 class SearchTagsTestCase(BaseDBTestCase):
     
@@ -390,3 +790,171 @@ class SearchTagsTestCase(BaseDBTestCase):
         tags_utils.update_tags_series(self.db, self.doc_provider["name"], self.doc_dataset["dataset_code"])
 
 
+
+class SearchTagsModeTestCase(BaseDBTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_tags:SearchTagsModeTestCase
+
+    def setUp(self):
+        super().setUp()
+
+        self.db[constants.COL_SERIES].insert_many([
+            {"provider_name": "p1", "dataset_code": "d1", "key": "x1",
+             "slug": "p1-d1-x1", "tags": ["france", "monthly", "unemployment"]},
+            {"provider_name": "p1", "dataset_code": "d1", "key": "x2",
+             "slug": "p1-d1-x2", "tags": ["francs", "monthly"]},
+            {"provider_name": "p1", "dataset_code": "d1", "key": "x3",
+             "slug": "p1-d1-x3", "tags": ["belgium", "monthly", "rate"]},
+        ])
+        self.db[constants.COL_TAGS].insert_many([
+            {"name": "belgium"}, {"name": "france"}, {"name": "francs"},
+            {"name": "monthly"}, {"name": "rate"}, {"name": "unemployment"},
+        ])
+
+    def _search_keys(self, search_tags, search_mode):
+        cursor, query = tags_utils.search_series_tags(self.db,
+                                                      search_tags=search_tags,
+                                                      search_mode=search_mode)
+        return sorted([doc["key"] for doc in cursor])
+
+    def test_search_modes(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:SearchTagsModeTestCase.test_search_modes
+
+        self.assertEqual(self._search_keys("fran monthly", "regex"), ["x1", "x2"])
+        self.assertEqual(self._search_keys("rate", "regex"), ["x3"])
+
+        self.assertEqual(self._search_keys("france monthly", "exact"), ["x1"])
+        self.assertEqual(self._search_keys("fran monthly", "exact"), [])
+
+        self.assertEqual(self._search_keys("fran monthly", "prefix"), ["x1", "x2"])
+        '''anchored: "rate" is not a prefix of unemployment'''
+        self.assertEqual(self._search_keys("ate", "prefix"), [])
+
+        self.assertEqual(tags_utils.expand_tags(self.db, "fran"), ["france", "francs"])
+        self.assertEqual(self._search_keys("fran monthly", "expand"), ["x1", "x2"])
+        self.assertEqual(self._search_keys("fran", "expand"), ["x1", "x2"])
+        self.assertEqual(self._search_keys("unknown", "expand"), [])
+        self.assertEqual(self._search_keys("", "exact"), [])
+
+        with self.assertRaises(ValueError):
+            self._search_keys("fran", "unknown")
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_search_modes_use_index(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:SearchTagsModeTestCase.test_search_modes_use_index
+
+        for search_mode in ["exact", "prefix", "expand"]:
+            cursor, query = tags_utils.search_series_tags(self.db,
+                                                          search_tags="france monthly",
+                                                          search_mode=search_mode)
+            explain = cursor.explain()
+            stage = self.get_plan_stage(explain['queryPlanner']['winningPlan'], 'IXSCAN')
+            self.assertEqual(stage.get('indexName'), "series4", search_mode)
+
+        query = {"name": {"$regex": "^fran"}}
+        explain = self.db[constants.COL_TAGS].find(query).explain()
+        stage = self.get_plan_stage(explain['queryPlanner']['winningPlan'], 'IXSCAN')
+        self.assertEqual(stage.get('indexName'), "name_idx")
+
+class TagsCompleterTestCase(BaseDBTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_tags:TagsCompleterTestCase
+
+    def setUp(self):
+        super().setUp()
+        self.db[constants.COL_TAGS].insert_many([
+            {"name": "fr", "count": 1, "enable": True},
+            {"name": "france", "count": 30, "count_series": 3, "enable": True},
+            {"name": "francs", "count": 50, "count_series": 5, "enable": True},
+            {"name": "frankfurt", "count": 10, "enable": True},
+            {"name": "franc", "count": 100, "enable": False},
+            {"name": "germany", "count": 90, "enable": True},
+        ])
+
+    def test_complete(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:TagsCompleterTestCase.test_complete
+
+        completer = tags_utils.TagsCompleter(self.db)
+        self.assertTrue(completer.is_expired())
+
+        self.assertEqual(completer.complete("fra"),
+                         [{"name": "francs", "count": 50},
+                          {"name": "france", "count": 30},
+                          {"name": "frankfurt", "count": 10}])
+        self.assertEqual(completer.complete(" FR ", limit=2),
+                         [{"name": "francs", "count": 50},
+                          {"name": "france", "count": 30}])
+        self.assertEqual(completer.complete("franz"), [])
+        self.assertEqual(completer.complete(""), [])
+
+        '''snapshot: no query before refresh'''
+        self.assertFalse(completer.is_expired())
+        self.db[constants.COL_TAGS].insert_one({"name": "fraction", "count": 1000})
+        self.assertEqual(completer.complete("fra", limit=1), [{"name": "francs", "count": 50}])
+
+        self.assertTrue(completer.is_expired(now=completer.loaded + completer.refresh_interval))
+        completer.refresh()
+        self.assertEqual(completer.complete("fra", limit=1), [{"name": "fraction", "count": 1000}])
+
+    def test_complete_concurrent_load(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:TagsCompleterTestCase.test_complete_concurrent_load
+
+        import threading
+
+        snapshots = [[("fa", 1), ("fb", 2)], [("fa", 3), ("fb", 2), ("fc", 1), ("fd", 0)]]
+        expected = [[{"name": "fb", "count": 2}, {"name": "fa", "count": 1}],
+                    [{"name": "fa", "count": 3}, {"name": "fb", "count": 2},
+                     {"name": "fc", "count": 1}, {"name": "fd", "count": 0}]]
+
+        completer = tags_utils.TagsCompleter(None, refresh_interval=3600)
+        completer.load(snapshots[0])
+        stopped = threading.Event()
+
+        def _load():
+            i = 0
+            while not stopped.is_set():
+                i += 1
+                completer.load(snapshots[i % 2])
+
+        thread = threading.Thread(target=_load)
+        thread.start()
+        try:
+            for i in range(2000):
+                self.assertIn(completer.complete("f", limit=10), expected)
+        finally:
+            stopped.set()
+            thread.join()
+
+    def test_complete_tags(self):
+
+        # nosetests -s -v widukind_common.tests.test_tags:TagsCompleterTestCase.test_complete_tags
+
+        tags_utils._TAGS_COMPLETERS.clear()
+
+        result = tags_utils.complete_tags(self.db, "fra", count_field="count_series")
+        self.assertEqual(result, [{"name": "francs", "count": 5},
+                                  {"name": "france", "count": 3},
+                                  {"name": "frankfurt", "count": 0}])
+
+        '''copy of the cached result'''
+        result[0]["count"] = 0
+        result.pop()
+        self.assertEqual(tags_utils.complete_tags(self.db, "fra", count_field="count_series"),
+                         [{"name": "francs", "count": 5},
+                          {"name": "france", "count": 3},
+                          {"name": "frankfurt", "count": 0}])
+
+        '''refresh_interval of each call'''
+        self.db[constants.COL_TAGS].insert_one({"name": "fraction", "count_series": 10})
+        self.assertEqual(tags_utils.complete_tags(self.db, "fra", limit=1, count_field="count_series"),
+                         [{"name": "francs", "count": 5}])
+        self.assertEqual(tags_utils.complete_tags(self.db, "fra", limit=1, count_field="count_series",
+                                                  refresh_interval=0),
+                         [{"name": "fraction", "count": 10}])
+
+        self.assertEqual(list(tags_utils._TAGS_COMPLETERS.keys()),
+                         [(self.db.client.address, self.db.name, "count_series")])
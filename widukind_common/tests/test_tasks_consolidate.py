@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import os
+import unittest
+from unittest import mock
+from datetime import datetime
+
 from widukind_common.tasks import consolidate
 
 from widukind_common import constants
+from widukind_common import utils
 from widukind_common.tests.base import BaseDBTestCase
 
 class ConsolidateTasksTestCase(BaseDBTestCase):
@@ -140,6 +146,25 @@ class ConsolidateTasksTestCase(BaseDBTestCase):
         self.assertIsNone(modified)
         
         
+    def test_consolidate_dataset_packed(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_dataset_packed
+
+        series = dict(self.series, start_date=480, end_date=481)
+        series["values"] = [dict(v, period=p, value="1") for v, p in zip(series["values"], ["2010-01", "2010-02"])]
+
+        self.db[constants.COL_DATASETS].insert(self.dataset)
+        self.db[constants.COL_SERIES].insert(utils.series_pack(series))
+
+        modified = consolidate.consolidate_dataset(provider_name=self.dataset["provider_name"],
+                                                   dataset_code=self.dataset["dataset_code"],
+                                                   db=self.db)
+        self.assertEqual(modified, 1)
+
+        dataset = self.db[constants.COL_DATASETS].find_one({"slug": self.dataset["slug"]})
+        self.assertEqual(dataset["concepts"], self.datas_after["concepts"])
+        self.assertEqual(dataset["codelists"], self.datas_after["codelists"])
+
     def test_consolidate_all_dataset(self):
     
         self.db[constants.COL_DATASETS].insert(self.dataset)
@@ -169,4 +194,205 @@ class ConsolidateTasksTestCase(BaseDBTestCase):
         
         self.assertEqual(result, 
                          {"matched_count": 0, "modified_count": 0})
-    
\ No newline at end of file
+    
+    def test_consolidate_accumulator(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_accumulator
+
+        accumulator = consolidate.ConsolidateAccumulator(self.dataset)
+        accumulator.add(self.series)
+
+        self.assertEqual(accumulator.count_series, 1)
+        self.assertEqual(accumulator.codelists, {
+            "COUNTRY": {"FRA"},
+            "B": {"VALUE1"},
+            "CURRENCY": {"D"},
+            "OBS_STATUS": {"E"},
+            "OBS_COM": {"not"},
+        })
+
+        query_modify = accumulator.query_modify()
+        self.assertEqual(query_modify["$set"]["codelists"], self.datas_after["codelists"])
+        self.assertEqual(query_modify["$set"]["concepts"], self.datas_after["concepts"])
+        self.assertEqual(query_modify["$set"]["dimension_keys"], self.datas_after["dimension_keys"])
+        self.assertEqual(query_modify["$set"]["attribute_keys"], self.datas_after["attribute_keys"])
+
+        '''OBS_STATUS complete: next observations attributes are ignored'''
+        series = dict(self.series, values=[{"attributes": {"OBS_STATUS": "T"}},
+                                           {"attributes": {"OBS_STATUS": "X"}}])
+        accumulator.add(series)
+        self.assertEqual(accumulator.count_series, 2)
+        self.assertEqual(accumulator.codelists["OBS_STATUS"], {"E", "T"})
+
+        '''dataset already consolidated'''
+        dataset = dict(self.dataset, **self.datas_after)
+        accumulator = consolidate.ConsolidateAccumulator(dataset)
+        accumulator.add(self.series)
+        self.assertIsNone(accumulator.query_modify())
+
+    def test_series_codelists_pipelines(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_series_codelists_pipelines
+
+        query = {"provider_name": "p1", "dataset_code": "d1"}
+
+        pipelines = consolidate._series_codelists_pipelines(query, {})
+        self.assertEqual(len(pipelines), 1)
+
+        pipelines = consolidate._series_codelists_pipelines(query, self.dataset["codelists"])
+        self.assertEqual(len(pipelines), 3)
+        self.assertEqual(pipelines[1][0], {"$match": query})
+        for pipeline in pipelines[1:]:
+            self.assertEqual(sorted(pipeline[-2]["$match"]["codes.k"]["$in"]),
+                             sorted(self.dataset["codelists"].keys()))
+        self.assertEqual(pipelines[2][0], {"$match": {"$and": [query, {"values_packed.obs": {"$type": "object"}}]}})
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_consolidate_dataset_aggregate(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_dataset_aggregate
+
+        self.db[constants.COL_DATASETS].insert(self.dataset)
+        self.db[constants.COL_SERIES].insert(self.series)
+
+        series = dict(self.series, key="x2", slug="p1-d1-x2", attributes=None)
+        series["dimensions"] = {"COUNTRY": "AUS", "B": "VALUE1"}
+        series["values"] = [{"attributes": {"OBS_STATUS": "T", "UNKNOWN": "X"}}]
+        self.db[constants.COL_SERIES].insert(series)
+
+        query = {"provider_name": "p1", "dataset_code": "d1"}
+        old_codelists = self.dataset["codelists"]
+        projection = {"_id": False, "dimensions": True, "attributes": True, "values.attributes": True}
+        cursor = self.db[constants.COL_SERIES].find(query, projection)
+
+        codelists_python = consolidate._series_codelists(cursor, old_codelists)
+        codelists_aggregate = consolidate._series_codelists_aggregate(self.db, query, old_codelists)
+
+        '''observations attributes are collected until codelist is complete'''
+        self.assertEqual(sorted(codelists_python.keys()), sorted(codelists_aggregate.keys()))
+        for k, values in old_codelists.items():
+            if k in codelists_python:
+                self.assertEqual(codelists_python[k] & set(values),
+                                 codelists_aggregate[k] & set(values))
+
+        _query, query_modify = consolidate.consolidate_dataset("p1", "d1", db=self.db,
+                                                               execute=False)
+        _query, query_modify_aggregate = consolidate.consolidate_dataset("p1", "d1", db=self.db,
+                                                                         execute=False,
+                                                                         use_aggregate=True)
+        self.assertEqual(query_modify, query_modify_aggregate)
+
+    def test_consolidate_all_dataset_workers(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_all_dataset_workers
+
+        dataset_codes = ["d%s" % i for i in range(1, 6)]
+        for dataset_code in dataset_codes:
+            dataset = dict(self.dataset, dataset_code=dataset_code,
+                           slug="p1-%s" % dataset_code)
+            series = dict(self.series, dataset_code=dataset_code,
+                          slug="p1-%s-x1" % dataset_code)
+            self.db[constants.COL_DATASETS].insert(dataset)
+            self.db[constants.COL_SERIES].insert(series)
+
+        '''dataset without change'''
+        dataset = dict(self.dataset, dataset_code="d6", slug="p1-d6", **self.datas_after)
+        self.db[constants.COL_DATASETS].insert(dataset)
+        self.db[constants.COL_SERIES].insert(dict(self.series, dataset_code="d6", slug="p1-d6-x1"))
+
+        result = consolidate.consolidate_all_dataset(provider_name="p1", db=self.db,
+                                                     max_bulk=2, max_workers=3)
+
+        self.assertEqual(result,
+                         {"matched_count": 5, "modified_count": 5})
+
+        for dataset_code in dataset_codes + ["d6"]:
+            dataset = self.db[constants.COL_DATASETS].find_one({"dataset_code": dataset_code})
+            self.assertEqual(dataset["codelists"], self.datas_after["codelists"])
+            self.assertEqual(dataset["dimension_keys"], self.datas_after["dimension_keys"])
+
+        result = consolidate.consolidate_all_dataset(provider_name="p1", db=self.db,
+                                                     max_workers=3)
+        self.assertEqual(result,
+                         {"matched_count": 0, "modified_count": 0})
+
+    def test_consolidate_all_dataset_error(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_all_dataset_error
+
+        for dataset_code in ["d1", "d2"]:
+            self.db[constants.COL_DATASETS].insert(dict(self.dataset, dataset_code=dataset_code,
+                                                        slug="p1-%s" % dataset_code))
+
+        def _consolidate_dataset(provider_name, dataset_code, **kwargs):
+            raise ValueError("consolidate error [%s]" % dataset_code)
+
+        with mock.patch.object(consolidate, "consolidate_dataset", _consolidate_dataset):
+            with self.assertRaises(ValueError):
+                consolidate.consolidate_all_dataset(provider_name="p1", db=self.db)
+
+            with self.assertRaises(ValueError):
+                consolidate.consolidate_all_dataset(provider_name="p1", db=self.db,
+                                                    max_workers=2)
+
+    def test_consolidate_dataset_skip_unchanged(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_consolidate:ConsolidateTasksTestCase.test_consolidate_dataset_skip_unchanged
+
+        self.db[constants.COL_DATASETS].insert(dict(self.dataset, last_update=datetime(2016, 1, 1)))
+        self.db[constants.COL_SERIES].insert(self.series)
+
+        modified = consolidate.consolidate_dataset(provider_name="p1", dataset_code="d1",
+                                                   db=self.db, skip_unchanged=True)
+        self.assertEqual(modified, 1)
+
+        dataset = self.db[constants.COL_DATASETS].find_one({"slug": self.dataset["slug"]})
+        self.assertEqual(dataset["codelists"], self.datas_after["codelists"])
+        state = dataset["consolidate"]
+        self.assertEqual(state["series_count"], 1)
+        self.assertEqual(state["last_update"], datetime(2016, 1, 1))
+        self.assertIsNotNone(state["max_id"])
+        self.assertEqual(state["hash"], consolidate.dataset_hash(self.datas_after["codelists"],
+                                                                 self.datas_after["concepts"]))
+
+        '''series not changed'''
+        query, query_modify = consolidate.consolidate_dataset(provider_name="p1", dataset_code="d1",
+                                                              db=self.db, execute=False,
+                                                              skip_unchanged=True)
+        self.assertIsNone(query)
+
+        '''new series: only consolidation state is updated'''
+        series = dict(self.series, key="x2", slug="p1-d1-x2")
+        series.pop("_id")
+        self.db[constants.COL_SERIES].insert(series)
+        query, query_modify = consolidate.consolidate_dataset(provider_name="p1", dataset_code="d1",
+                                                              db=self.db, execute=False,
+                                                              skip_unchanged=True)
+        self.assertEqual(list(query_modify["$set"].keys()), ["consolidate"])
+        self.assertEqual(query_modify["$set"]["consolidate"]["series_count"], 2)
+        self.assertEqual(query_modify["$set"]["consolidate"]["hash"], state["hash"])
+
+        '''dataset updated'''
+        self.db[constants.COL_DATASETS].update_one({"slug": self.dataset["slug"]},
+                                                   {"$set": {"last_update": datetime(2016, 2, 1)}})
+        result = consolidate.consolidate_all_dataset(provider_name="p1", db=self.db,
+                                                     skip_unchanged=True)
+        self.assertEqual(result, {"matched_count": 1, "modified_count": 1})
+
+        result = consolidate.consolidate_all_dataset(provider_name="p1", db=self.db,
+                                                     skip_unchanged=True)
+        self.assertEqual(result, {"matched_count": 0, "modified_count": 0})
+
+        '''dataset codelists rewritten (fetcher run) with unchanged series'''
+        self.db[constants.COL_DATASETS].update_one({"slug": self.dataset["slug"]},
+                                                   {"$set": {"codelists": self.dataset["codelists"],
+                                                             "concepts": self.dataset["concepts"]}})
+        modified = consolidate.consolidate_dataset(provider_name="p1", dataset_code="d1",
+                                                   db=self.db, skip_unchanged=True)
+        self.assertEqual(modified, 1)
+        dataset = self.db[constants.COL_DATASETS].find_one({"slug": self.dataset["slug"]})
+        self.assertEqual(dataset["codelists"], self.datas_after["codelists"])
+
+        modified = consolidate.consolidate_dataset(provider_name="p1", dataset_code="d1",
+                                                   db=self.db, skip_unchanged=True)
+        self.assertIsNone(modified)
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import csv
+import gzip
+import unittest
+from datetime import datetime
+
+import numpy
+import pandas
+
+from widukind_common.tasks import export_files
+
+from widukind_common import constants
+from widukind_common.tests.base import BaseDBTestCase, series_fixture
+
+class ExportFilesTestCase(BaseDBTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase
+
+    def setUp(self):
+        BaseDBTestCase.setUp(self)
+
+        self.dataset = {
+            "enable": True,
+            "provider_name": "p1",
+            "dataset_code": "d1",
+            "name": "dataset 1",
+            "slug": "p1-d1",
+            "dimension_keys": ["FREQ", "COUNTRY"],
+        }
+
+    def _series(self, key, start, values, freq="A", country="FRA"):
+        return series_fixture(key, start, values, freq=freq, COUNTRY=country)
+
+    def _insert_fixtures(self):
+        self.db[constants.COL_DATASETS].insert(self.dataset)
+        self.db[constants.COL_SERIES].insert(self._series("X1", "1995", ["1", "2", "3"]))
+        self.db[constants.COL_SERIES].insert(self._series("X2", "1996", ["4", "5", "6", "7"],
+                                                          country="AUS"))
+
+    def test_iter_export_dataset(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_iter_export_dataset
+
+        self._insert_fixtures()
+
+        rows = export_files.iter_export_dataset(self.db, self.dataset)
+        self.assertFalse(isinstance(rows, list))
+
+        rows = list(rows)
+        self.assertEqual(rows, [
+            ["key", "FREQ", "COUNTRY", "1995", "1996", "1997", "1998", "1999"],
+            ["X1", "A", "FRA", "1", "2", "3", None, None],
+            ["X2", "A", "AUS", None, "4", "5", "6", "7"],
+        ])
+
+        self.assertEqual(export_files.export_dataset(self.db, self.dataset), rows)
+
+    def test_write_csv(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_write_csv
+
+        class Recorder(io.StringIO):
+            blocks = 0
+            def write(self, value):
+                self.blocks += 1
+                return super().write(value)
+
+        rows = (["key%s" % i, "A", "1.5"] for i in range(100))
+
+        fp = Recorder()
+        count = export_files.write_csv(fp, rows, buffer_size=50)
+
+        self.assertEqual(count, 100)
+        self.assertTrue(fp.blocks > 1)
+
+        lines = fp.getvalue().split("\n")
+        self.assertEqual(lines[0], '"key0","A","1.5"')
+        self.assertEqual(len(lines), 101)
+
+        fp.seek(0)
+        self.assertEqual(list(csv.reader(fp))[99], ["key99", "A", "1.5"])
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_record_csv_file(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_record_csv_file
+
+        import gridfs
+
+        self._insert_fixtures()
+
+        _id = export_files.record_csv_file(self.db,
+                                           export_files.iter_export_dataset(self.db, self.dataset),
+                                           provider_name="p1", dataset_code="d1",
+                                           slug="p1-d1", prefix="dataset")
+
+        grid_out = gridfs.GridFS(self.db).get(_id)
+        self.assertEqual(grid_out.filename, "widukind-dataset-p1-d1.csv")
+        self.assertEqual(grid_out.metadata["dataset_code"], "d1")
+
+        lines = grid_out.read().decode("utf8").splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], '"key","FREQ","COUNTRY","1995","1996","1997","1998","1999"')
+
+    def test_dataset_date_bounds(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_dataset_date_bounds
+
+        self.assertEqual(export_files.dataset_date_bounds(self.db, self.dataset), {})
+        self.assertEqual(export_files.export_dataset(self.db, self.dataset),
+                         [["key", "FREQ", "COUNTRY"]])
+
+        self._insert_fixtures()
+        self.db[constants.COL_SERIES].insert(self._series("X3", "2000-01", ["1", "2"], freq="M"))
+
+        bounds = export_files.dataset_date_bounds(self.db, self.dataset)
+        self.assertEqual(sorted(bounds.keys()), ["A", "M"])
+        self.assertEqual(bounds["A"], {"start_date": pandas.Period("1995", freq="A").ordinal,
+                                       "end_date": pandas.Period("1999", freq="A").ordinal,
+                                       "count": 2})
+        self.assertEqual(bounds["M"]["count"], 1)
+
+        '''mixed frequencies: frequency is required'''
+        with self.assertRaises(ValueError):
+            export_files.export_dataset(self.db, self.dataset)
+
+        rows = export_files.export_dataset(self.db, self.dataset, frequency="A")
+        self.assertEqual([row[0] for row in rows[1:]], ["X1", "X2"])
+
+    def test_export_row(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_export_row
+
+        series = self._series("X1", "1996", ["1", "2"])
+        dmin = pandas.Period("1995", freq="A").ordinal
+        dmax = pandas.Period("1999", freq="A").ordinal
+
+        self.assertEqual(export_files.export_row(series, ["FREQ", "UNIT"], dmin, dmax),
+                         ["X1", "A", "", None, "1", "2", None, None])
+
+        self.assertEqual(export_files.export_row(series, ["FREQ"], series["start_date"], series["end_date"]),
+                         ["X1", "A", "1", "2"])
+
+    def test_iter_export_dataset_by_frequency(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_iter_export_dataset_by_frequency
+
+        self._insert_fixtures()
+        self.db[constants.COL_SERIES].insert(self._series("X3", "2000-02", ["1", "2"], freq="M"))
+        self.db[constants.COL_SERIES].insert(self._series("X4", "2000-01", ["3"], freq="M"))
+
+        rows = list(export_files.iter_export_dataset_by_frequency(self.db, self.dataset))
+        self.assertEqual(rows, [
+            ("A", ["key", "FREQ", "COUNTRY", "1995", "1996", "1997", "1998", "1999"]),
+            ("M", ["key", "FREQ", "COUNTRY", "2000-01", "2000-02", "2000-03"]),
+            ("A", ["X1", "A", "FRA", "1", "2", "3", None, None]),
+            ("A", ["X2", "A", "AUS", None, "4", "5", "6", "7"]),
+            ("M", ["X3", "M", "FRA", None, "1", "2"]),
+            ("M", ["X4", "M", "FRA", "3", None, None]),
+        ])
+
+        rows = list(export_files.iter_export_dataset(self.db, self.dataset, frequency="M"))
+        self.assertEqual(rows, [
+            ["key", "FREQ", "COUNTRY", "2000-01", "2000-02", "2000-03"],
+            ["X3", "M", "FRA", None, "1", "2"],
+            ["X4", "M", "FRA", "3", None, None],
+        ])
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_record_csv_files_by_frequency(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_record_csv_files_by_frequency
+
+        import gridfs
+
+        self._insert_fixtures()
+        self.db[constants.COL_SERIES].insert(self._series("X3", "2000-02", ["1", "2"], freq="M"))
+
+        values = export_files.iter_export_dataset_by_frequency(self.db, self.dataset)
+        ids = export_files.record_csv_files_by_frequency(self.db, values,
+                                                         provider_name="p1", dataset_code="d1",
+                                                         slug="p1-d1", prefix="dataset")
+        self.assertEqual(sorted(ids.keys()), ["A", "M"])
+
+        fs = gridfs.GridFS(self.db)
+        grid_out = fs.get(ids["M"])
+        self.assertEqual(grid_out.filename, "widukind-dataset-p1-d1-m.csv")
+        self.assertEqual(grid_out.metadata["frequency"], "M")
+        self.assertEqual(len(grid_out.read().decode("utf8").splitlines()), 2)
+        self.assertEqual(len(fs.get(ids["A"]).read().decode("utf8").splitlines()), 3)
+
+    def test_npz_export_writer(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_npz_export_writer
+
+        self._insert_fixtures()
+
+        fp = io.BytesIO()
+        writer = export_files.get_export_writer("npz")(fp, label_columns=3)
+        for row in export_files.iter_export_dataset(self.db, self.dataset):
+            writer.writerow(row)
+        writer.close()
+
+        self.assertEqual(writer.count, 3)
+
+        fp.seek(0)
+        columns = export_files.read_npz_export(fp)
+        self.assertEqual([name for name, data in columns],
+                         ["key", "FREQ", "COUNTRY", "1995", "1996", "1997", "1998", "1999"])
+        columns = dict(columns)
+        self.assertEqual(list(columns["key"]), ["X1", "X2"])
+        self.assertEqual(columns["1996"].dtype, numpy.float64)
+        self.assertEqual(list(columns["1996"]), [2.0, 4.0])
+        self.assertTrue(numpy.isnan(columns["1995"][1]))
+
+    def test_npz_export_writer_label_columns(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_npz_export_writer_label_columns
+
+        rows = [["key", "FREQ", "GEO", "1995"],
+                ["001", "A", "01", "1.5"],
+                ["002", "A", "02", ""]]
+
+        fp = io.BytesIO()
+        writer = export_files.get_export_writer("npz")(fp, label_columns=3)
+        for row in rows:
+            writer.writerow(row)
+        writer.close()
+
+        fp.seek(0)
+        columns = dict(export_files.read_npz_export(fp))
+        self.assertEqual(list(columns["key"]), ["001", "002"])
+        self.assertEqual(list(columns["GEO"]), ["01", "02"])
+        self.assertEqual(columns["1995"].dtype, numpy.float64)
+        self.assertEqual(columns["1995"][0], 1.5)
+
+    @unittest.skipIf(not export_files.HAVE_PYARROW, "require pyarrow")
+    def test_parquet_export_writer(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_parquet_export_writer
+
+        self._insert_fixtures()
+
+        fp = io.BytesIO()
+        writer = export_files.get_export_writer("parquet")(fp, label_columns=3)
+        for row in export_files.iter_export_dataset(self.db, self.dataset):
+            writer.writerow(row)
+        writer.close()
+
+        fp.seek(0)
+        df = pandas.read_parquet(fp)
+        self.assertEqual(list(df.columns),
+                         ["key", "FREQ", "COUNTRY", "1995", "1996", "1997", "1998", "1999"])
+        self.assertEqual(list(df["1996"]), [2.0, 4.0])
+
+    def test_get_export_writer(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_get_export_writer
+
+        self.assertEqual(export_files.get_export_writer("csv"), export_files.BufferedCSVWriter)
+        with self.assertRaises(ValueError):
+            export_files.get_export_writer("xls")
+
+    def test_dataset_version(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_dataset_version
+
+        self._insert_fixtures()
+
+        version = export_files.dataset_version(self.db, self.dataset)
+        self.assertEqual(export_files.dataset_version(self.db, self.dataset), version)
+
+        self.db[constants.COL_SERIES].insert(self._series("X3", "1995", ["1"]))
+        version2 = export_files.dataset_version(self.db, self.dataset)
+        self.assertNotEqual(version2, version)
+
+        dataset = dict(self.dataset, last_update=datetime(2016, 1, 1))
+        self.assertNotEqual(export_files.dataset_version(self.db, dataset), version2)
+
+    def test_export_versions(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_export_versions
+
+        def _file(version, upload_date, export_format="csv", frequency=None):
+            metadata = {"doc_type": "dataset", "provider_name": "p1", "dataset_code": "d1",
+                        "slug": "p1-d1", "format": export_format, "version": version}
+            if frequency:
+                metadata["frequency"] = frequency
+            _id = self.db[export_files.FS_FILES].insert({"filename": "widukind-dataset-p1-d1.csv",
+                                                         "uploadDate": upload_date,
+                                                         "metadata": metadata})
+            self.db[export_files.FS_CHUNKS].insert({"files_id": _id, "n": 0, "data": b"x"})
+            return _id
+
+        id_v1 = _file("v1", datetime(2016, 1, 1))
+        id_v2_m = _file("v2", datetime(2016, 2, 1), frequency="M")
+        id_v2_a = _file("v2", datetime(2016, 2, 1), frequency="A")
+        id_v3 = _file("v3", datetime(2016, 3, 1))
+        id_npz = _file("v1", datetime(2016, 1, 1), export_format="npz")
+
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v1"), [id_v1])
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v2"), [id_v2_a, id_v2_m])
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v1", export_format="npz"),
+                         [id_npz])
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v4"), [])
+
+        removed = export_files.remove_export_versions(self.db, "p1", "d1", keep_versions=2)
+        self.assertEqual(removed, 1)
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v1"), [])
+        self.assertEqual(self.db[export_files.FS_CHUNKS].count({"files_id": id_v1}), 0)
+
+        removed = export_files.remove_export_versions(self.db, "p1", "d1")
+        self.assertEqual(removed, 2)
+        self.assertEqual(self.db[export_files.FS_FILES].count({"metadata.format": "csv"}), 1)
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v3"), [id_v3])
+
+        '''other formats are not removed'''
+        self.assertEqual(export_files.find_export_files(self.db, "p1", "d1", "v1", export_format="npz"),
+                         [id_npz])
+
+    def test_export_datasets_job_resume(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_export_datasets_job_resume
+
+        self._insert_fixtures()
+        dataset2 = dict(self.dataset, dataset_code="d2", slug="p1-d2")
+        dataset2.pop("_id")
+        self.db[constants.COL_DATASETS].insert(dataset2)
+
+        '''exports of a previous run'''
+        for dataset in [self.dataset, dataset2]:
+            version = export_files.dataset_version(self.db, dataset)
+            self.db[export_files.FS_FILES].insert({"metadata": {"doc_type": "dataset", "provider_name": "p1",
+                                                                "dataset_code": dataset["dataset_code"],
+                                                                "format": "csv", "version": version}})
+
+        calls = []
+        stats = export_files.export_datasets_job(provider_name="p1", max_workers=2, db=self.db,
+                                                 progress=lambda count, total, result: calls.append((count, total)))
+
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["skipped"], 2)
+        self.assertEqual(stats["exported"], 0)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(sorted(calls), [(1, 2), (2, 2)])
+        self.assertEqual(sorted([r["slug"] for r in stats["datasets"]]), ["p1-d1", "p1-d2"])
+        for result in stats["datasets"]:
+            self.assertEqual(len(result["ids"]), 1)
+            self.assertTrue(result["duration"] >= 0)
+
+        stats = export_files.export_datasets_job(slugs=["p1-d2"], db=self.db)
+        self.assertEqual(stats["count"], 1)
+        self.assertEqual(stats["skipped"], 1)
+
+        with self.assertRaises(ValueError):
+            export_files.export_datasets_job(db=self.db)
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_export_datasets_job(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_export_datasets_job
+
+        self._insert_fixtures()
+
+        stats = export_files.export_datasets_job(provider_name="p1", db=self.db)
+        self.assertEqual(stats["exported"], 1)
+        self.assertEqual(stats["errors"], 0)
+
+        '''second run: already exported'''
+        stats = export_files.export_datasets_job(provider_name="p1", db=self.db)
+        self.assertEqual(stats["exported"], 0)
+        self.assertEqual(stats["skipped"], 1)
+
+    def test_iter_export_series_bulk(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_iter_export_series_bulk
+
+        self._insert_fixtures()
+        self.db[constants.COL_SERIES].insert(self._series("X3", "2000-02", ["1", "2"], freq="M"))
+
+        rows = list(export_files.iter_export_series_bulk(self.db, slugs=["p1-d1-x1", "p1-d1-x3"]))
+        self.assertEqual(rows, [
+            ("A", ["slug", "provider_name", "dataset_code", "key", "1995", "1996", "1997"]),
+            ("M", ["slug", "provider_name", "dataset_code", "key", "2000-02", "2000-03"]),
+            ("A", ["p1-d1-x1", "p1", "d1", "X1", "1", "2", "3"]),
+            ("M", ["p1-d1-x3", "p1", "d1", "X3", "1", "2"]),
+        ])
+
+        rows = list(export_files.iter_export_series_bulk(self.db, query={"frequency": "A"},
+                                                         batch_size=1))
+        self.assertEqual(rows[0][1][4:], ["1995", "1996", "1997", "1998", "1999"])
+        self.assertEqual(sorted([row[1][0] for row in rows[1:]]), ["p1-d1-x1", "p1-d1-x2"])
+
+        self.assertEqual(export_files.series_bulk_query(slugs=["a"], query={"frequency": "A"}),
+                         {"$and": [{"slug": {"$in": ["a"]}}, {"frequency": "A"}]})
+        with self.assertRaises(ValueError):
+            export_files.series_bulk_query()
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_export_file_series_bulk(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_export_file_series_bulk
+
+        import gridfs
+
+        self._insert_fixtures()
+
+        _id = export_files.export_file_series_bulk(slugs=["p1-d1-x1", "p1-d1-x2"], db=self.db)
+
+        grid_out = gridfs.GridFS(self.db).get(_id)
+        self.assertEqual(grid_out.filename, "widukind-series-bulk-basket.csv")
+        self.assertEqual(grid_out.metadata["count_series"], 2)
+        self.assertEqual(len(grid_out.read().decode("utf8").splitlines()), 3)
+
+    def test_gridfs_buffered_writer(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_gridfs_buffered_writer
+
+        class GridInRecorder(object):
+            chunk_size = 100
+            def __init__(self):
+                self.blocks = []
+            def write(self, data):
+                self.blocks.append(data)
+
+        rows = [["key%s" % i, "A", "1.5"] for i in range(200)]
+
+        grid_in = GridInRecorder()
+        fp = export_files.GridFSBufferedWriter(grid_in)
+        export_files.write_csv(fp, rows, buffer_size=10)
+        fp.close()
+
+        self.assertTrue(len(grid_in.blocks) > 1)
+        for data in grid_in.blocks[:-1]:
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(len(data) % GridInRecorder.chunk_size, 0)
+        content = b"".join(grid_in.blocks)
+        self.assertEqual(fp.size, len(content))
+        self.assertEqual(content.decode("utf8").splitlines()[199], '"key199","A","1.5"')
+
+        grid_in_gz = GridInRecorder()
+        fp = export_files.GridFSBufferedWriter(grid_in_gz, compress=True)
+        export_files.write_csv(fp, rows, buffer_size=10)
+        fp.close()
+
+        for data in grid_in_gz.blocks[:-1]:
+            self.assertEqual(len(data) % GridInRecorder.chunk_size, 0)
+        self.assertEqual(gzip.decompress(b"".join(grid_in_gz.blocks)), content)
+        self.assertTrue(len(b"".join(grid_in_gz.blocks)) < len(content))
+
+    @unittest.skipIf(not 'USE_MONGO_SERVER' in os.environ, "require MongoDB server")
+    def test_record_export_file_compress(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_export_files:ExportFilesTestCase.test_record_export_file_compress
+
+        import gridfs
+
+        self._insert_fixtures()
+
+        _id = export_files.record_export_file(self.db,
+                                              export_files.iter_export_dataset(self.db, self.dataset),
+                                              provider_name="p1", dataset_code="d1",
+                                              slug="p1-d1", prefix="dataset", compress=True)
+
+        grid_out = gridfs.GridFS(self.db).get(_id)
+        self.assertEqual(grid_out.filename, "widukind-dataset-p1-d1.csv.gz")
+        self.assertEqual(grid_out.metadata["contentEncoding"], "gzip")
+        lines = gzip.decompress(grid_out.read()).decode("utf8").splitlines()
+        self.assertEqual(len(lines), 3)
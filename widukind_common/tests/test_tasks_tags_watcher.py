@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import time
+from datetime import datetime
+
+from unittest import mock
+
+from pymongo.errors import PyMongoError, AutoReconnect, ServerSelectionTimeoutError
+
+from widukind_common.tasks import tags_watcher
+
+from widukind_common import constants
+from widukind_common.tests.base import BaseTestCase, BaseDBTestCase
+
+class TagsEventTestCase(BaseTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsEventTestCase
+
+    def test_is_tags_event(self):
+
+        event = {"operationType": "update",
+                 "updateDescription": {"updatedFields": {"tags": ["a"]},
+                                       "removedFields": []}}
+        self.assertTrue(tags_watcher.is_tags_event(event))
+
+        event["updateDescription"]["updatedFields"] = {"tags.1": "b"}
+        self.assertTrue(tags_watcher.is_tags_event(event))
+
+        event["updateDescription"]["updatedFields"] = {"tags": ["a"], "name": "x"}
+        self.assertFalse(tags_watcher.is_tags_event(event))
+
+        self.assertFalse(tags_watcher.is_tags_event({"operationType": "insert"}))
+
+class TagsWatcherTestCase(BaseDBTestCase):
+
+    # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase
+
+    def setUp(self):
+        BaseDBTestCase.setUp(self)
+
+        self.doc_provider = {
+            "enable": True,
+            "name": "p1",
+            "long_name": "Provider Test",
+            "region": "Mars",
+            "slug": "p1"
+        }
+        self.dataset = {
+            "enable": True,
+            "provider_name": "p1",
+            "dataset_code": "d1",
+            "name": "dataset 1",
+            "slug": "p1-d1",
+            "last_update": datetime(2016, 1, 1),
+            "concepts": {
+                "COUNTRY": "Country"
+            },
+            "codelists": {
+                "COUNTRY": {
+                    "FRA": "France"
+                }
+            },
+            "dimension_keys": ["COUNTRY"],
+        }
+        self.series = {
+            "provider_name": "p1",
+            "dataset_code": "d1",
+            "key": "x1",
+            "name": "series 1",
+            "slug": "p1-d1-x1",
+            "frequency": "A",
+            "dimensions": {
+                "COUNTRY": "FRA"
+            },
+        }
+        self.db[constants.COL_PROVIDERS].insert(self.doc_provider)
+        self.db[constants.COL_DATASETS].insert(self.dataset)
+        self.db[constants.COL_SERIES].insert(self.series)
+
+    def test_flush_series(self):
+
+        watcher = tags_watcher.TagsWatcher(self.db, debounce=60)
+        self.assertFalse(watcher.is_ready())
+
+        series_id = self.db[constants.COL_SERIES].find_one()["_id"]
+        watcher.add_event(constants.COL_SERIES, series_id)
+        watcher.add_event(constants.COL_SERIES, series_id)
+        self.assertEqual(watcher.count_pending(), 1)
+
+        '''debounce'''
+        self.assertFalse(watcher.is_ready())
+        self.assertTrue(watcher.is_ready(now=watcher.last_event + 60))
+
+        stats = watcher.flush()
+        self.assertEqual(stats, {"count_datasets": 0, "count_series": 1, "count_modified": 1})
+        self.assertEqual(watcher.count_pending(), 0)
+
+        series = self.db[constants.COL_SERIES].find_one()
+        self.assertEqual(series["tags"], ['annually', 'country', 'd1', 'dataset', 'france', 'mars', 'p1', 'provider', 'series', 'test', 'x1'])
+
+        '''tags unchanged: no write'''
+        watcher.add_event(constants.COL_SERIES, series_id)
+        stats = watcher.flush()
+        self.assertEqual(stats["count_modified"], 0)
+
+    def test_poll(self):
+
+        watcher = tags_watcher.TagsWatcher(self.db, debounce=0, max_batch=1)
+
+        '''first poll: init watermark'''
+        self.assertEqual(watcher.poll(), 0)
+        self.assertEqual(watcher.since, datetime(2016, 1, 1))
+        self.assertEqual(watcher.poll(), 0)
+
+        self.db[constants.COL_DATASETS].update_one({"slug": "p1-d1"},
+                                                   {"$set": {"name": "dataset updated",
+                                                             "last_update": datetime(2016, 1, 2)}})
+        self.assertEqual(watcher.poll(), 1)
+        self.assertEqual(watcher.since, datetime(2016, 1, 2))
+        self.assertTrue(watcher.is_ready())
+
+        stats = watcher.flush()
+        self.assertEqual(stats["count_datasets"], 1)
+        self.assertEqual(stats["count_modified"], 1)
+
+        series = self.db[constants.COL_SERIES].find_one()
+        self.assertTrue("updated" in series["tags"])
+        dataset = self.db[constants.COL_DATASETS].find_one()
+        self.assertTrue("updated" in dataset["tags"])
+
+    def test_run_polling(self):
+
+        watcher = tags_watcher.TagsWatcher(self.db, poll_interval=0, since=datetime(2015, 1, 1))
+        watcher.run(sleep=0, max_iterations=1)
+
+        self.assertEqual(watcher.count_pending(), 0)
+        series = self.db[constants.COL_SERIES].find_one()
+        self.assertEqual(series["tags"], ['annually', 'country', 'd1', 'dataset', 'france', 'mars', 'p1', 'provider', 'series', 'test', 'x1'])
+
+    def test_run_reopen_streams(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase.test_run_reopen_streams
+
+        class FailingWatcher(tags_watcher.TagsWatcher):
+            open_errors = 2
+            read_errors = 1
+            count_open = 0
+
+            def open_streams(self):
+                self.count_open += 1
+                if self.count_open <= self.open_errors:
+                    raise PyMongoError("server down")
+                return {constants.COL_SERIES: None}
+
+            def read_streams(self):
+                if self.read_errors:
+                    self.read_errors -= 1
+                    raise PyMongoError("connection lost")
+                return 0
+
+            def close_streams(self):
+                self.streams = None
+
+        watcher = FailingWatcher(self.db, reconnect_delay=0, reconnect_max_delay=0)
+        watcher.streams = {constants.COL_SERIES: None}
+        watcher.run(sleep=0, max_iterations=5)
+
+        self.assertEqual(watcher.count_open, 3)
+        self.assertIsNone(watcher.reopen_at)
+        self.assertIsNone(watcher.last_poll)
+
+    def test_schedule_reopen(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase.test_schedule_reopen
+
+        watcher = tags_watcher.TagsWatcher(self.db, reconnect_delay=1, reconnect_max_delay=5)
+        delays = []
+        for i in range(5):
+            watcher.schedule_reopen()
+            delays.append(watcher.reopen_delay)
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+    def test_read_streams_max_batch(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase.test_read_streams_max_batch
+
+        class FakeStream(object):
+            def __init__(self, count):
+                self.events = [{"_id": {"token": i}, "operationType": "insert",
+                                "documentKey": {"_id": i}} for i in range(count)]
+
+            def try_next(self):
+                return self.events.pop(0) if self.events else None
+
+        stream = FakeStream(25)
+        watcher = tags_watcher.TagsWatcher(self.db, max_batch=10)
+        watcher.streams = {constants.COL_SERIES: stream}
+
+        self.assertEqual(watcher.read_streams(), 10)
+        self.assertEqual(watcher.count_pending(), 10)
+        self.assertEqual(len(stream.events), 15)
+        self.assertEqual(watcher.resume_tokens[constants.COL_SERIES], {"token": 9})
+        self.assertTrue(watcher.is_ready())
+        self.assertEqual(watcher.read_streams(), 0)
+
+        watcher.pending_series = set()
+        self.assertEqual(watcher.read_streams(), 10)
+
+    def test_run_flush_error(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase.test_run_flush_error
+
+        class FailingWatcher(tags_watcher.TagsWatcher):
+            flush_errors = 2
+            flushed = None
+
+            def _flush_series(self, series_ids, bypass_datasets=[]):
+                if self.flush_errors:
+                    self.flush_errors -= 1
+                    raise AutoReconnect("connection lost")
+                self.flushed = set(series_ids)
+                return 0
+
+        watcher = FailingWatcher(self.db, debounce=0, poll_interval=3600,
+                                 reconnect_delay=0, reconnect_max_delay=0)
+        watcher.last_poll = time.time()
+        watcher.add_event(constants.COL_SERIES, 1)
+        watcher.add_event(constants.COL_SERIES, 2)
+
+        self.assertFalse(watcher.try_flush())
+        self.assertEqual(watcher.pending_series, {1, 2})
+        self.assertEqual(watcher.flush_delay, 0)
+
+        watcher.run(sleep=0, max_iterations=2)
+        self.assertEqual(watcher.flushed, {1, 2})
+        self.assertEqual(watcher.count_pending(), 0)
+        self.assertIsNone(watcher.flush_at)
+
+    def test_run_open_streams_error(self):
+
+        # nosetests -s -v widukind_common.tests.test_tasks_tags_watcher:TagsWatcherTestCase.test_run_open_streams_error
+
+        class FailingWatcher(tags_watcher.TagsWatcher):
+            count_open = 0
+
+            def open_streams(self):
+                self.count_open += 1
+                if self.count_open == 1:
+                    raise ServerSelectionTimeoutError("server not available")
+                return {constants.COL_SERIES: None}
+
+            def read_streams(self):
+                return 0
+
+            def close_streams(self):
+                self.streams = None
+
+        watcher = FailingWatcher(self.db, reconnect_delay=0, reconnect_max_delay=0)
+        with mock.patch.object(tags_watcher, "change_streams_available", return_value=True):
+            watcher.run(sleep=0, max_iterations=2)
+
+        self.assertEqual(watcher.count_open, 2)
+        self.assertIsNone(watcher.reopen_at)
+        self.assertIsNone(watcher.last_poll)
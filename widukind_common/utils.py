@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import array
 import logging
 import logging.config
-from functools import wraps
+from functools import wraps, lru_cache
 import time
 
 import arrow
@@ -12,6 +13,7 @@ from pymongo import MongoClient
 from pymongo import ASCENDING, DESCENDING, TEXT
 from pymongo.errors import AutoReconnect
 from bson import json_util
+from bson.binary import Binary
 
 import six
 import zlib
@@ -28,8 +30,15 @@ def get_mongo_client(url=None, connect=False):
     # TODO: tz_aware
     url = url or get_mongo_url()
     client = MongoClient(url, connect=connect)
+    '''URL of the client for child processes - see client_mongo_url'''
+    client.widukind_url = url
     return client
 
+def client_mongo_url(client):
+    """Return URL of a client created by get_mongo_client or None"""
+    '''not getattr: MongoClient return a Database for unknown attributes'''
+    return vars(client).get("widukind_url")
+
 def get_mongo_db(url=None, **kwargs):
     # TODO: tz_aware
     url = url or get_mongo_url()
@@ -209,6 +218,14 @@ def create_or_update_indexes(db, force_mode=False, background=False):
         name="series1",
         background=background)
 
+    '''********* EXPORTS (GridFS) *********'''
+
+    db["fs.files"].create_index([
+        ("metadata.provider_name", ASCENDING),
+        ("metadata.dataset_code", ASCENDING),
+        ("metadata.doc_type", ASCENDING)],
+        name="exports_idx", background=background)
+
     '''********* TAGS ***********'''
 
     db[constants.COL_TAGS].create_index([
@@ -360,6 +377,20 @@ def retry_on_reconnect_error(retry_count=2, exponential_delay=True):
         return decorated_function
     return decorator
 
+def series_date_bounds(db, query):
+    """Return first and last period ordinals by frequency of series matching query"""
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": "$frequency",
+                    "start_date": {"$min": "$start_date"},
+                    "end_date": {"$max": "$end_date"},
+                    "count": {"$sum": 1}}},
+    ]
+    bounds = {}
+    for doc in db[constants.COL_SERIES].aggregate(pipeline, allowDiskUse=True):
+        bounds[doc.pop("_id")] = doc
+    return bounds
+
 def series_archives_store(series):
     '''Compress one series document for store in mongodb'''
     store = {
@@ -377,3 +408,134 @@ def series_archives_load(store):
     series["slug"] = store["slug"]
     series["version"] = store["version"]
     return series
+
+'''Compact encoding of series values
+
+values_packed: {
+    "start_date": period ordinal of first value,
+    "count": count of values,
+    "data": float64 little-endian array (BSON binary),
+    "raw": {index: value} - values not restored from data (not numbers, "1.50", ...),
+    "periods": {index: period} - periods not following start_date,
+    "obs": {index: {field: value}} - other fields of observations (attributes, ...),
+    "missing": {index: [field]} - period, value or attributes absent from observation,
+}
+
+Observations are decoded with period, value and attributes (None) unless
+recorded in missing: decoding is lossless.
+'''
+VALUES_PACKED = "values_packed"
+
+VALUES_PACKED_FIELDS = ("period", "value", "attributes")
+
+def _value_to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+def _float_to_value(value):
+    if value != value:
+        return "NaN"
+    return "%.15g" % value
+
+@lru_cache(maxsize=256)
+def _period_strings(frequency, start_date, count):
+    '''series of a dataset share frequency and bounds: cached'''
+    import pandas
+    index = pandas.period_range(start=pandas.Period(ordinal=start_date, freq=frequency),
+                                periods=count, freq=frequency)
+    return tuple(index.astype(str))
+
+def series_values_encode(series):
+    '''Pack values of one series document - lossless with series_values_decode'''
+    values = series["values"]
+    start_date = series["start_date"]
+    periods = _period_strings(series["frequency"], start_date, len(values))
+
+    data = array.array("d")
+    packed_raw, packed_periods, packed_obs, packed_missing = {}, {}, {}, {}
+
+    for i, obs in enumerate(values):
+        value = obs.get("value")
+        f = _value_to_float(value)
+        data.append(f)
+        if not isinstance(value, str) or _float_to_value(f) != value:
+            packed_raw[str(i)] = value
+        if obs.get("period") != periods[i]:
+            packed_periods[str(i)] = obs.get("period")
+        '''attributes None is the default of decoding'''
+        extra = {k: v for k, v in obs.items()
+                 if not k in ("period", "value") and not (k == "attributes" and v is None)}
+        if extra:
+            packed_obs[str(i)] = extra
+        missing = [k for k in VALUES_PACKED_FIELDS if not k in obs]
+        if missing:
+            packed_missing[str(i)] = missing
+
+    if sys.byteorder == "big":
+        data.byteswap()
+
+    packed = {
+        "start_date": start_date,
+        "count": len(values),
+        "data": Binary(data.tobytes()),
+    }
+    if packed_raw:
+        packed["raw"] = packed_raw
+    if packed_periods:
+        packed["periods"] = packed_periods
+    if packed_obs:
+        packed["obs"] = packed_obs
+    if packed_missing:
+        packed["missing"] = packed_missing
+    return packed
+
+def series_values_floats(packed):
+    '''Values as float64 array.array (not numbers are NaN) - no decoding of periods'''
+    data = array.array("d")
+    data.frombytes(bytes(packed["data"]))
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data
+
+def series_values_strings(packed):
+    '''Original values (list) - no decoding of periods'''
+    values = [_float_to_value(f) for f in series_values_floats(packed)]
+    for i, value in (packed.get("raw") or {}).items():
+        values[int(i)] = value
+    return values
+
+def series_values_decode(packed, frequency):
+    '''Unpack values of one series - list of observations with period, value and attributes'''
+    values = series_values_strings(packed)
+    periods = list(_period_strings(frequency, packed["start_date"], len(values)))
+    for i, period in (packed.get("periods") or {}).items():
+        periods[int(i)] = period
+
+    packed_obs = packed.get("obs") or {}
+    packed_missing = packed.get("missing") or {}
+    result = []
+    for i, (period, value) in enumerate(zip(periods, values)):
+        obs = {"period": period, "value": value, "attributes": None}
+        extra = packed_obs.get(str(i))
+        if extra:
+            obs.update(extra)
+        for k in packed_missing.get(str(i), []):
+            del obs[k]
+        result.append(obs)
+    return result
+
+def series_pack(series):
+    '''Return a copy of series document with values_packed in place of values'''
+    series = dict(series)
+    series[VALUES_PACKED] = series_values_encode(series)
+    del series["values"]
+    return series
+
+def series_unpack(series):
+    '''Restore values of a packed series document (in place) - no-op if not packed'''
+    packed = series.pop(VALUES_PACKED, None)
+    if packed is not None:
+        series["values"] = series_values_decode(packed, series["frequency"])
+    return series